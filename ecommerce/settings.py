@@ -36,6 +36,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Primo della lista: misura query, template e cache di tutta la richiesta (attivo solo con INSTRUMENTATION_ENABLED)
+    'shop.instrumentation.InstrumentationMiddleware',
+    # Metriche per Prometheus (/metrics): prima di SessionMiddleware per contare anche i salvataggi della sessione
+    'shop.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -43,6 +47,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    # Ultimo: profila solo la vista (shop/profiling.py), spento finché PROFILING_SAMPLE_RATE e PROFILING_SLOW_MS sono 0
+    'shop.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'ecommerce.urls'
@@ -59,6 +65,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'shop.context_processors.cart',
+                'shop.context_processors.personalization',
             ],
         },
     },
@@ -119,6 +126,10 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Versioni ridotte delle immagini prodotto (larghezze in px e formati), salvate accanto all'originale
+PRODUCT_IMAGE_WIDTHS = [160, 400, 800, 1200]
+PRODUCT_IMAGE_FORMATS = ['webp', 'jpg']
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
@@ -135,7 +146,169 @@ LOGOUT_REDIRECT_URL = 'shop:product_list'
 
 # Cart session
 CART_SESSION_ID = 'cart'
+# Ordini creati dalla sessione: un ospite può simulare il pagamento (gateway finto) solo dei propri
+ORDERS_SESSION_ID = 'orders'
+# Dove salvare il carrello: in sessione (default) oppure nei modelli Cart/CartItem
+# ('shop.cart_storage.DatabaseCartStorage'), con unione del carrello ospite al login
+CART_STORAGE = 'shop.cart_storage.SessionCartStorage'
+# Prenotazioni di stock: i pezzi nel carrello restano trattenuti per questi secondi dall'ultima modifica;
+# in sessione c'è solo il token che identifica le prenotazioni del carrello
+STOCK_RESERVATION_TTL = 60 * 15
+STOCK_RESERVATION_SESSION_ID = 'stock_hold'
+# Righe su cui è diviso il contatore dei pezzi liberi di ogni prodotto (shop/inventory.py):
+# più righe = più checkout contemporanei sullo stesso prodotto senza attese sul lock
+STOCK_SHARDS = 8
+# Invii doppi del checkout (shop/idempotency.py): per quanti secondi un reinvio dello stesso modulo
+# riceve l'ordine già creato (se il primo invio è ancora in corso aspetta nella pagina shop:order_pending)
+CHECKOUT_IDEMPOTENCY_TTL = 60 * 10
+
+# Controllo degli ingressi per i lanci (shop/admission.py), su aggiunta al carrello e checkout.
+# Modificabili a runtime senza riavvio con il comando admission_control.
+# Spento di default: si accende per un lancio con admission_control --enable (o la variabile d'ambiente ADMISSION=1)
+ADMISSION_ENABLED = os.getenv('ADMISSION', '') == '1'
+# Ingressi al secondo e picco massimo (secchio di gettoni che si ricarica di RATE al secondo): oltre si va nella pagina di attesa
+ADMISSION_RATE = 20
+ADMISSION_BURST = 40
+# Richieste di carrello/checkout servite contemporaneamente
+ADMISSION_MAX_CONCURRENT = 50
+# Persone in coda oltre le quali si risponde subito con la pagina 503 "riprova tra poco"
+ADMISSION_QUEUE_LIMIT = 5000
+# Secondi per cui un acquirente ammesso non ripassa dalla coda
+ADMISSION_PASS_TTL = 60 * 10
+# Secondi suggeriti (header Retry-After e pagina 503) prima di riprovare
+ADMISSION_RETRY_AFTER = 30
+
+# Coda dei lavori in background (shop/jobs.py, comando run_jobs)
+# Tentativi prima di segnare un lavoro come fallito; attesa (secondi) dopo il primo errore, raddoppiata ogni volta
+JOBS_MAX_ATTEMPTS = 5
+JOBS_RETRY_BACKOFF = 30
+JOBS_RETRY_MAX_DELAY = 60 * 60
+# Secondi dopo i quali un lavoro preso da un worker che non risponde torna disponibile agli altri
+JOBS_LEASE = 60 * 5
+# Giorni per cui si conservano i lavori completati
+JOBS_KEEP_DONE_DAYS = 7
+# Chiavi per i lavori messi in coda da ogni checkout (compattazione, email): i checkout contemporanei
+# si dividono su tante chiavi invece di aspettarsi a vicenda sull'indice univoco (jobs.shared_key)
+JOBS_DEDUPE_SHARDS = 8
+# Dopo un checkout la compattazione del magazzino parte entro questi secondi (un solo lavoro per tutti i checkout)
+STOCK_COMPACT_DELAY = 10
+
+# Email ai clienti (conferma ordine, spedizione), inviate a blocchi dal worker run_jobs (shop/notifications.py).
+# In sviluppo sono stampate sulla console; in produzione EMAIL_BACKEND=django.core.mail.backends.smtp.EmailBackend
+# (per provarle in locale: python -m aiosmtpd -n -l localhost:1025 con EMAIL_PORT=1025)
+EMAIL_BACKEND = os.getenv('EMAIL_BACKEND', 'django.core.mail.backends.console.EmailBackend')
+EMAIL_HOST = os.getenv('EMAIL_HOST', 'localhost')
+EMAIL_PORT = int(os.getenv('EMAIL_PORT', '25'))
+EMAIL_HOST_USER = os.getenv('EMAIL_HOST_USER', '')
+EMAIL_HOST_PASSWORD = os.getenv('EMAIL_HOST_PASSWORD', '')
+EMAIL_USE_TLS = os.getenv('EMAIL_USE_TLS', '') == '1'
+DEFAULT_FROM_EMAIL = os.getenv('DEFAULT_FROM_EMAIL', 'MMOS Moda Donna <ordini@mmos-moda-donna.it>')
+# Email inviate sulla stessa connessione SMTP prima di segnarle come inviate
+ORDER_EMAIL_BATCH_SIZE = 100
+# Indirizzo del sito per i link nelle email (il worker non ha una richiesta da cui ricavarlo)
+SHOP_BASE_URL = os.getenv('SHOP_BASE_URL', 'http://localhost:8000')
+
+# Strumentazione (shop/instrumentation.py): query, tempo SQL, template e cache di ogni richiesta
+# negli header della risposta e nelle ultime INSTRUMENTATION_BUFFER_SIZE richieste (/debug/requests/, solo staff).
+# Spenta di default: si attiva con la variabile d'ambiente INSTRUMENTATION=1
+INSTRUMENTATION_ENABLED = os.getenv('INSTRUMENTATION', '') == '1'
+INSTRUMENTATION_BUFFER_SIZE = 500
+
+# Metriche per Prometheus (shop/metrics.py) su /metrics: latenza per vista, checkout, carrelli, sessioni, cache.
+# Con più processi (gunicorn) ognuno scrive i suoi valori in METRICS_DIR ogni METRICS_FLUSH_INTERVAL secondi
+# e /metrics li somma: la cartella va svuotata prima di avviare gunicorn. Vuota = solo il processo che risponde.
+# Spente di default: si attivano con la variabile d'ambiente METRICS=1
+METRICS_ENABLED = os.getenv('METRICS', '') == '1'
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+METRICS_FLUSH_INTERVAL = 5
+# Chi può leggere /metrics oltre allo staff: lo scraper con "Authorization: Bearer <METRICS_TOKEN>" o gli IP
+# indicati (REMOTE_ADDR: dietro un proxy locale sarebbe quello di tutti, meglio il token)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = []
+
+if INSTRUMENTATION_ENABLED:
+    # Tempo di render misurato dal backend dei template di shop/instrumentation.py (solo quando serve)
+    TEMPLATES[0]['BACKEND'] = 'shop.instrumentation.DjangoTemplates'
+
+# Profilazione delle viste dello shop (shop/profiling.py): cProfile su una richiesta ogni PROFILING_SAMPLE_RATE
+# (0 = mai) e stack campionati ogni PROFILING_SAMPLE_INTERVAL secondi per le richieste oltre PROFILING_SLOW_MS
+# (0 = mai). Lo staff profila una singola richiesta con /debug/profile/?path=... anche con entrambi a 0
+PROFILING_SAMPLE_RATE = int(os.getenv('PROFILING_SAMPLE_RATE', '0'))
+PROFILING_SLOW_MS = int(os.getenv('PROFILING_SLOW_MS', '0'))
+PROFILING_SAMPLE_INTERVAL = 0.005
+PROFILING_DIR = os.getenv('PROFILING_DIR', BASE_DIR / 'profiles')
+# Profili conservati: i più vecchi vengono eliminati
+PROFILING_KEEP = 200
+# Validità in secondi del link firmato per profilare una richiesta
+PROFILING_LINK_MAX_AGE = 600
+
+# Limiti di frequenza (shop/ratelimit.py): nome -> (richieste, secondi), contati per sessione e utente.
+# Si applicano con @rate_limited('nome') oppure con shop.ratelimit.RateLimitMiddleware e RATE_LIMIT_VIEWS
+RATE_LIMITS = {
+    # Aggiunte e rimozioni dal carrello
+    'cart': (30, 60),
+}
+# Limite per IP (richieste nella stessa finestra): più alto, perché molti clienti possono avere lo stesso IP
+# (NAT, reti aziendali e mobili); serve contro chi cambia sessione a ogni richiesta. Senza voce, nessun limite per IP
+RATE_LIMITS_IP = {
+    'cart': 600,
+}
+RATE_LIMIT_VIEWS = {}
+# Header con l'IP del client: dietro un reverse proxy usare 'HTTP_X_FORWARDED_FOR'
+# (solo se il proxy sovrascrive l'header, altrimenti il client può falsificarlo)
+RATE_LIMIT_IP_HEADER = 'REMOTE_ADDR'
+
+# Catalogo: prodotti per pagina (paginazione a cursore) e massimo richiedibile con ?per_page=
+CATALOG_PAGE_SIZE = 12
+CATALOG_MAX_PAGE_SIZE = 48
+# Filtri della vetrina: fasce di prezzo in euro (min incluso, max escluso; None = senza limite)
+# e giorni per cui un prodotto compare tra le "Novità"
+CATALOG_PRICE_BANDS = [(None, 50), (50, 100), (100, 200), (200, None)]
+CATALOG_NEW_DAYS = 30
+# Durata (secondi) dei frammenti del catalogo in cache; vengono comunque invalidati a ogni modifica
+CATALOG_CACHE_TIMEOUT = 60 * 15
+
+# Ricerca prodotti: snapshot dell'indice invertito (il journal delle modifiche è <percorso>.journal)
+SEARCH_INDEX_PATH = BASE_DIR / 'search_index' / 'products.pickle'
+# Numero massimo di risultati considerati per una ricerca (vetrina e admin), i più rilevanti:
+# oltre questo numero l'admin avvisa di restringere la ricerca
+SEARCH_MAX_RESULTS = 500
+
+# Suggerimenti mostrati dall'autocompletamento della barra di ricerca
+AUTOCOMPLETE_LIMIT = 8
+
+# Parti personalizzate delle pagine catalogo (badge carrello, utente, messaggi):
+# 'inline' = rese dal server in ogni pagina (default);
+# 'client' = catalogo e scheda prodotto sono uguali per tutti e inviati con Cache-Control: public,
+#            il browser riempie le parti personali chiamando l'endpoint JSON shop:session_state
+SHOP_PERSONALIZATION = 'inline'
+# max-age (secondi) delle pagine pubbliche in modalità 'client'
+SHOP_PUBLIC_CACHE_SECONDS = 300
+
+# Cache
+# Locale al processo in sviluppo. Con più worker usare un backend condiviso, ad esempio:
+# 'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': BASE_DIR / 'cache'
+# Con strumentazione o metriche attive si usa la stessa LocMemCache con il conteggio delle letture
+CACHES = {
+    'default': {
+        'BACKEND': (
+            'shop.instrumentation.LocMemCache' if INSTRUMENTATION_ENABLED or METRICS_ENABLED
+            else 'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': 'mmos-moda-donna',
+    }
+}
 
 STRIPE_PUBLIC_KEY = os.getenv('STRIPE_PUBLIC_KEY', '')
 STRIPE_SECRET_KEY = os.getenv('STRIPE_SECRET_KEY', '')
-STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET', '')
\ No newline at end of file
+STRIPE_WEBHOOK_SECRET = os.getenv('STRIPE_WEBHOOK_SECRET', '')
+# Gateway dei pagamenti con carta (shop/payments.py): senza chiave Stripe si usa quello finto di sviluppo
+PAYMENT_GATEWAY = os.getenv(
+    'PAYMENT_GATEWAY', 'shop.payments.StripeGateway' if STRIPE_SECRET_KEY else 'shop.payments.FakeGateway',
+)
+# Il gateway finto segna pagati gli ordini senza addebito: ammesso solo con DEBUG o con PAYMENT_FAKE=1
+# (es. un ambiente di prova). Altrimenti il sito non parte finché non si configura Stripe
+PAYMENT_FAKE_ENABLED = DEBUG or os.getenv('PAYMENT_FAKE', '') == '1'
+PAYMENT_CURRENCY = 'eur'
+# Secondi entro cui pagare un ordine con carta: poi viene annullato e i pezzi tornano in vendita
+PAYMENT_EXPIRY = 60 * 60
\ No newline at end of file
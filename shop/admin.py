@@ -1,7 +1,14 @@
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ORDER_VAR, ChangeList
 from django.forms import MediaDefiningClass
 from django.contrib.auth.models import User
-from .models import Category, Product, Cart, CartItem, Order, OrderItem
+from django.db import transaction
+from django.db.models import Case, IntegerField, When
+from . import inventory, jobs, notifications
+from .forms import ProductAdminForm
+from .models import Category, Product, Cart, CartItem, Job, Order, OrderItem, OrderNotification, WebhookEvent, StockMovement, StockReservation
+from .search import search_products
 
 # --- CLASSE BASE PERSONALIZZATA PER LAYOUT ADMIN ---
 class CustomAdminMixin(metaclass=MediaDefiningClass):
@@ -19,18 +26,78 @@ class CategoryAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('name',)}
 
 # --- CONFIGURAZIONE PRODOTTI ---
+class ProductChangeList(ChangeList):
+    def get_ordering(self, request, queryset):
+        # Ricerca senza una colonna scelta per l'ordinamento: stesso ordine di rilevanza della vetrina
+        if 'search_rank' in queryset.query.annotations and ORDER_VAR not in self.params:
+            return ['search_rank', '-pk']
+        return super().get_ordering(request, queryset)
+
+
 @admin.register(Product)
 class ProductAdmin(CustomAdminMixin, admin.ModelAdmin):
+    form = ProductAdminForm
     # Colonne visualizzate nella tabella prodotti
-    list_display = ['name', 'slug', 'price', 'available', 'stock', 'created', 'updated']
+    list_display = ['name', 'slug', 'price', 'available', 'stock', 'reserved', 'sold', 'created', 'updated']
     # Pannello filtri laterale (molto utile quando hai molti prodotti)
     list_filter = ['available', 'created', 'updated', 'category']
-    # Permette di modificare prezzo, disponibilità e scorte direttamente dalla lista, senza cliccare sul prodotto
-    list_editable = ['price', 'available', 'stock']
+    # Permette di modificare prezzo e disponibilità direttamente dalla lista, senza cliccare sul prodotto.
+    # Lo stock no: si cambia dalla scheda con "Rifornimento" (vedi save_model)
+    list_editable = ['price', 'available']
+    # Contatori aggiornati da checkout e prenotazioni: non si modificano a mano
+    readonly_fields = ['reserved', 'sold']
     # Generazione automatica dello slug dal nome
     prepopulated_fields = {'slug': ('name',)}
-    # Ricerca per nome e descrizione
+    # Ricerca per nome, descrizione e categoria (usa l'indice di ricerca, vedi get_search_results)
     search_fields = ['name', 'description']
+    # Fotografia aggiornata dalla compattazione (inventory.compact): un salvataggio non la riscrive mai
+    stock_fields = ['stock', 'reserved', 'sold']
+
+    def get_fields(self, request, obj=None):
+        fields = super().get_fields(request, obj)
+        # Il rifornimento ha senso solo per un prodotto esistente: alla creazione si indica lo stock
+        return [field for field in fields if obj is not None or field != 'stock_delta']
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj is None:
+            return self.readonly_fields
+        return self.stock_fields
+
+    def save_model(self, request, obj, form, change):
+        if not change:
+            super().save_model(request, obj, form, change)
+            return
+        # La scheda o la lista possono essere aperte da ore: stock, venduti e pezzi nei carrelli
+        # letti allora non devono sovrascrivere quelli aggiornati nel frattempo
+        obj.save(update_fields=[
+            field.name for field in obj._meta.concrete_fields
+            if not field.primary_key and field.name not in self.stock_fields
+        ])
+        delta = form.cleaned_data.get('stock_delta')
+        if delta and not inventory.adjust_stock(obj.pk, delta):
+            self.message_user(
+                request, f'"{obj}": non ci sono abbastanza pezzi liberi da togliere, stock non modificato.',
+                messages.WARNING,
+            )
+
+    def get_changelist(self, request, **kwargs):
+        return ProductChangeList
+
+    def get_search_results(self, request, queryset, search_term):
+        # Stesso indice della vetrina invece di icontains su tutta la tabella
+        if not search_term:
+            return super().get_search_results(request, queryset, search_term)
+        ids = search_products(search_term, limit=settings.SEARCH_MAX_RESULTS)
+        if not ids:
+            return queryset.none(), False
+        if len(ids) == settings.SEARCH_MAX_RESULTS:
+            self.message_user(
+                request, f'Mostrati i {len(ids)} risultati più rilevanti (SEARCH_MAX_RESULTS): restringi la ricerca.',
+                messages.WARNING,
+            )
+        # Posizione nell'indice, usata da ProductChangeList quando non si ordina per una colonna
+        rank = Case(*[When(id=pk, then=position) for position, pk in enumerate(ids)], output_field=IntegerField())
+        return queryset.filter(id__in=ids).annotate(search_rank=rank), False
 
 # --- GESTIONE CARRELLO (Visualizzazione In-line) ---
 # TabularInline permette di vedere i prodotti nel carrello dentro la scheda del carrello stesso
@@ -45,6 +112,81 @@ class CartAdmin(admin.ModelAdmin):
     # Mostra gli oggetti nel carrello come una tabella dentro la pagina del Carrello
     inlines = [CartItemInline]
 
+# --- PRENOTAZIONI DI STOCK ---
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ['product', 'token', 'quantity', 'created', 'expires_at']
+    list_select_related = ['product']
+    search_fields = ['token']
+    # Prenotazioni e Product.reserved vanno modificati insieme (reservations.py), non dall'admin
+    readonly_fields = ['product', 'token', 'quantity', 'created', 'expires_at']
+
+    def has_add_permission(self, request):
+        return False
+
+# --- REGISTRO MOVIMENTI DI MAGAZZINO (sola lettura) ---
+@admin.register(StockMovement)
+class StockMovementAdmin(admin.ModelAdmin):
+    list_display = ['id', 'product', 'kind', 'quantity', 'order', 'compacted', 'created']
+    list_filter = ['kind', 'compacted', 'created']
+    list_select_related = ['product']
+    raw_id_fields = ['product', 'order']
+
+    # Il registro si scrive solo con inserimenti dal codice (inventory.py)
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+# --- WEBHOOK DEI PAGAMENTI (sola lettura, elaborati da payments.py) ---
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ['event_id', 'type', 'received', 'processed_at']
+    list_filter = ['type', 'received']
+    search_fields = ['event_id']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+# --- EMAIL AI CLIENTI (sola lettura, inviate da notifications.py) ---
+@admin.register(OrderNotification)
+class OrderNotificationAdmin(admin.ModelAdmin):
+    list_display = ['id', 'order', 'kind', 'created', 'sent_at']
+    list_filter = ['kind', 'created']
+    raw_id_fields = ['order']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+# --- LAVORI IN BACKGROUND (sola lettura, eseguiti da run_jobs) ---
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'task', 'status', 'attempts', 'max_attempts', 'run_after', 'created', 'finished']
+    list_filter = ['status', 'task']
+    search_fields = ['task', 'dedupe_key']
+    actions = ['retry_jobs']
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    @admin.action(description='Rimetti in coda i lavori falliti selezionati')
+    def retry_jobs(self, request, queryset):
+        retried = jobs.retry(queryset)
+        self.message_user(request, f'Lavori rimessi in coda: {retried}.')
+
 # --- GESTIONE ORDINI (Visualizzazione In-line) ---
 # Permette di visualizzare gli articoli acquistati direttamente dentro la pagina dell'Ordine
 class OrderItemInline(admin.TabularInline):
@@ -55,35 +197,56 @@ class OrderItemInline(admin.TabularInline):
 @admin.register(Order)
 class OrderAdmin(admin.ModelAdmin):
     # Dettagli rapidi visibili nella lista ordini
-    list_display = ['id', 'user', 'first_name', 'last_name', 'email', 'paid', 'status', 'created']
+    list_display = ['id', 'user', 'first_name', 'last_name', 'email', 'total_cost', 'item_count', 'paid', 'status', 'refund_required', 'created']
     # Permette di modificare rapidamente lo stato 'paid' direttamente dalla lista ordini
     list_editable = ['paid']
     # Filtri rapidi per stato pagamento, stato ordine e data
-    list_filter = ['paid', 'status', 'created']
+    list_filter = ['paid', 'status', 'refund_required', 'created']
     # Mostra gli articoli dell'ordine (OrderItem) in fondo alla pagina del dettaglio ordine
     inlines = [OrderItemInline]
+    # I totali sono denormalizzati: si aggiornano da soli quando cambiano le righe
+    readonly_fields = ['total_cost', 'item_count', 'payment_intent_id']
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        # Dopo aver salvato gli OrderItem dell'inline, ricalcola i totali salvati sull'ordine
+        form.instance.update_totals()
+        if change and 'status' in form.changed_data and form.instance.status == 'shipped':
+            # Spedito dal modulo: stessa email dell'azione "Segna come spediti"
+            notifications.notify([form.instance], notifications.SHIPPED)
+        if form.instance.status == 'cancelled':
+            # Ordine annullato dal modulo: i pezzi tornano in magazzino (una volta sola)
+            inventory.cancel_order(form.instance)
 
     # AGGIUNTA: Registriamo l'azione personalizzata nell'elenco azioni
-    actions = ['make_shipped']
+    actions = ['make_shipped', 'cancel_orders']
 
     # DEFINIZIONE DELL'AZIONE:
     @admin.action(description='Segna gli ordini selezionati come Spediti')
     def make_shipped(self, request, queryset):
-        # Aggiorna il campo 'status' per tutti gli ordini selezionati
-        updated_count = queryset.update(status='shipped')
+        # Aggiorna il campo 'status' per tutti gli ordini selezionati; email solo a chi non era già spedito
+        with transaction.atomic():
+            orders = list(queryset.exclude(status='shipped').only('id'))
+            updated_count = queryset.update(status='shipped')
+            notifications.notify(orders, notifications.SHIPPED)
         # Invia un messaggio di conferma all'amministratore
         self.message_user(request, f'Successo! {updated_count} ordini sono stati segnati come spediti.')
 
+    @admin.action(description='Annulla gli ordini selezionati e restituisci i pezzi al magazzino')
+    def cancel_orders(self, request, queryset):
+        # Lista prima dell'UPDATE: con il filtro per stato attivo il queryset non li troverebbe più
+        orders = list(queryset)
+        queryset.update(status='cancelled')
+        restocked = sum(1 for order in orders if inventory.cancel_order(order))
+        self.message_user(request, f'Ordini annullati: {len(orders)} ({restocked} con pezzi restituiti al magazzino).')
+
 # --- GESTIONE UTENTI (CLIENTI) CON ORDINI ---
 class OrderInline(admin.TabularInline):
     model = Order
     extra = 0
-    readonly_fields = ['id', 'first_name', 'last_name', 'email', 'paid', 'status', 'created', 'get_total_cost']
-    fields = ['id', 'first_name', 'last_name', 'email', 'paid', 'status', 'created', 'get_total_cost']
-    
-    def get_total_cost(self, obj):
-        return obj.get_total_cost()
-    get_total_cost.short_description = 'Total Cost'
+    # total_cost è salvato sull'ordine: nessuna query sulle righe per ogni ordine dell'utente
+    readonly_fields = ['id', 'first_name', 'last_name', 'email', 'paid', 'status', 'created', 'total_cost']
+    fields = ['id', 'first_name', 'last_name', 'email', 'paid', 'status', 'created', 'total_cost']
 
 # Unregister the default User admin and register our custom one
 admin.site.unregister(User)
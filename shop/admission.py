@@ -0,0 +1,233 @@
+import random
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Valori modificabili a runtime (comando admission_control): chiave -> nome del setting con il default
+SETTINGS = {
+    'enabled': 'ADMISSION_ENABLED',
+    'rate': 'ADMISSION_RATE',
+    'burst': 'ADMISSION_BURST',
+    'max_concurrent': 'ADMISSION_MAX_CONCURRENT',
+    'queue_limit': 'ADMISSION_QUEUE_LIMIT',
+    'pass_ttl': 'ADMISSION_PASS_TTL',
+}
+OVERRIDES_KEY = 'admission:overrides'
+BUCKET_KEY = 'admission:bucket'
+HEAD_KEY = 'admission:queue:head'
+TAIL_KEY = 'admission:queue:tail'
+# Un posto di checkout occupato da un processo morto si libera da solo dopo questi secondi
+SLOT_TIMEOUT = 60
+# Ingressi concessi al massimo da una singola richiesta di stato della coda
+MAX_ADVANCE = 20
+
+# Esito di admit()
+ADMITTED = 'admitted'
+QUEUED = 'queued'
+BUSY = 'busy'
+
+TICKET_SESSION_KEY = 'admission_ticket'
+PASS_SESSION_KEY = 'admission_pass'
+NEXT_SESSION_KEY = 'admission_next'
+
+
+def get_config():
+    """ Limiti attuali: i valori dei settings con sopra quelli modificati a runtime. """
+    config = {name: getattr(settings, setting) for name, setting in SETTINGS.items()}
+    config.update(cache.get(OVERRIDES_KEY) or {})
+    return config
+
+
+def set_overrides(**values):
+    """ Modifica i limiti a runtime per tutti i processi (restano finché non si chiama reset_overrides). """
+    overrides = cache.get(OVERRIDES_KEY) or {}
+    overrides.update(values)
+    cache.set(OVERRIDES_KEY, overrides, timeout=None)
+    return get_config()
+
+
+def reset_overrides():
+    cache.delete(OVERRIDES_KEY)
+    return get_config()
+
+
+def incr_counter(key, timeout=None, delta=1):
+    """ Incremento atomico di un contatore in cache, creato a `delta` se non esiste (usato anche da ratelimit.py). """
+    # incr() fallisce se la chiave non esiste: add() la crea senza sovrascrivere quella di un altro processo
+    try:
+        return cache.incr(key, delta)
+    except ValueError:
+        if cache.add(key, delta, timeout):
+            return delta
+        return cache.incr(key, delta)
+
+
+# --- SECCHIO DI GETTONI (ritmo degli ingressi) ---
+def take_token(config):
+    """
+    Consuma un gettone: il secchio contiene al massimo `burst` gettoni e se ne ricarica uno ogni
+    1/rate secondi, quindi in media entrano `rate` acquirenti al secondo con picchi fino a `burst`.
+    In cache c'è un solo numero (GCRA): l'istante, in microsecondi, in cui il secchio sarebbe di
+    nuovo pieno. Ogni gettone lo sposta avanti di 1/rate secondi con un incr() atomico; se finisce
+    oltre `burst` gettoni da adesso il secchio è vuoto e lo spostamento si annulla.
+    """
+    interval = max(round(1_000_000 / config['rate']), 1)
+    now = int(time.time() * 1_000_000)
+    full_at = incr_counter(BUCKET_KEY, delta=interval)
+    if full_at < now + interval:
+        # Secchio già pieno (istante nel passato o chiave nuova): si riparte da adesso. Due processi che
+        # arrivano qui insieme entrano entrambi contando un gettone solo: al più qualche ingresso in più
+        cache.set(BUCKET_KEY, now + interval, timeout=None)
+        return True
+    if full_at - now > config['burst'] * interval:
+        try:
+            cache.decr(BUCKET_KEY, interval)
+        except ValueError:
+            # Chiave tolta dalla cache nel frattempo: il secchio riparte pieno
+            pass
+        return False
+    return True
+
+
+# --- POSTI DI CHECKOUT (richieste contemporanee) ---
+def acquire_slot(config):
+    """
+    Occupa uno dei `max_concurrent` posti di checkout e restituisce (chiave, lease) da passare
+    a release_slot; None se sono tutti occupati.
+    """
+    keys = [f'admission:slot:{index}' for index in range(config['max_concurrent'])]
+    taken = cache.get_many(keys)
+    free = [key for key in keys if key not in taken]
+    # Ordine casuale: processi concorrenti non provano tutti lo stesso posto
+    random.shuffle(free)
+    lease = uuid.uuid4().hex
+    for key in free:
+        if cache.add(key, lease, SLOT_TIMEOUT):
+            return key, lease
+    return None
+
+
+def release_slot(slot):
+    """ Libera il posto solo se è ancora di questa richiesta (dopo SLOT_TIMEOUT può averlo preso un'altra). """
+    key, lease = slot
+    # La cache di Django non ha un confronto-e-cancella atomico: resta solo la finestra tra get e delete
+    if cache.get(key) == lease:
+        cache.delete(key)
+
+
+# --- CODA DI ATTESA ---
+def _queue_state():
+    state = cache.get_many([HEAD_KEY, TAIL_KEY])
+    return state.get(HEAD_KEY, 0), state.get(TAIL_KEY, 0)
+
+
+def queue_length():
+    head, tail = _queue_state()
+    return max(tail - head, 0)
+
+
+def join_queue():
+    """ Biglietto numerato: si entra in ordine di arrivo. """
+    return incr_counter(TAIL_KEY)
+
+
+def advance(config):
+    """
+    Fa entrare i prossimi in coda finché ci sono gettoni. Lo chiama ogni richiesta di stato:
+    la coda avanza anche se chi è in testa ha chiuso la pagina. Restituisce (testa, fondo) della coda.
+    """
+    head, tail = _queue_state()
+    for _ in range(MAX_ADVANCE):
+        if head >= tail or not take_token(config):
+            break
+        head = incr_counter(HEAD_KEY)
+        if head > tail:
+            # Due richieste hanno fatto entrare l'ultimo insieme: la testa non supera la coda
+            cache.decr(HEAD_KEY)
+            head -= 1
+            break
+    return head, tail
+
+
+def position(ticket, head):
+    """ Persone davanti al biglietto (0 = tocca a lui). """
+    return max(ticket - head, 0)
+
+
+# --- STATO DELL'ACQUIRENTE IN SESSIONE ---
+def has_pass(session):
+    """ True se l'acquirente è già stato ammesso e il suo pass non è scaduto. """
+    return session.get(PASS_SESSION_KEY, 0) > time.time()
+
+
+def grant_pass(session, config):
+    """ Ammesso: per `pass_ttl` secondi le sue richieste di checkout non passano dalla coda. """
+    session[PASS_SESSION_KEY] = time.time() + config['pass_ttl']
+    session.pop(TICKET_SESSION_KEY, None)
+
+
+def enqueue(session):
+    """ Mette l'acquirente in fondo alla coda (se non ci è già) e restituisce il suo biglietto. """
+    if TICKET_SESSION_KEY not in session:
+        session[TICKET_SESSION_KEY] = join_queue()
+    return session[TICKET_SESSION_KEY]
+
+
+def check_ticket(session, config):
+    """ Posizione in coda dell'acquirente (None se non è in coda); a turno arrivato concede l'ingresso. """
+    ticket = session.get(TICKET_SESSION_KEY)
+    if ticket is None:
+        return None
+    head, tail = advance(config)
+    if ticket > tail:
+        # Cache svuotata o riavviata: il biglietto non esiste più, si riparte da capo
+        session.pop(TICKET_SESSION_KEY, None)
+        return None
+    remaining = position(ticket, head)
+    if remaining == 0:
+        grant_pass(session, config)
+    return remaining
+
+
+def admit(session, config):
+    """
+    Decide se l'acquirente può entrare nel checkout adesso: ADMITTED, QUEUED (ha un biglietto
+    e aspetta il suo turno) oppure BUSY (coda piena, la richiesta va rifiutata subito).
+    """
+    if has_pass(session):
+        return ADMITTED
+    remaining = check_ticket(session, config)
+    if remaining == 0:
+        return ADMITTED
+    if remaining is not None:
+        return QUEUED
+    # Nuovo arrivo: entra subito solo se nessuno aspetta, altrimenti passerebbe davanti a chi è in coda
+    length = queue_length()
+    if length == 0 and take_token(config):
+        grant_pass(session, config)
+        return ADMITTED
+    if length >= config['queue_limit']:
+        return BUSY
+    enqueue(session)
+    return QUEUED
+
+
+"""
+Controllo degli ingressi per i lanci di collezione: aggiunta al carrello e checkout
+sono limitati da tre meccanismi, tutti nella cache di Django (nessuna query al DB):
+
+- secchio di gettoni: al massimo ADMISSION_RATE ingressi al secondo (picchi fino a ADMISSION_BURST);
+- posti di checkout: al massimo ADMISSION_MAX_CONCURRENT richieste contemporanee;
+- coda: chi non trova un gettone prende un biglietto numerato e aspetta il suo turno
+  (la pagina di attesa chiede la posizione a shop:admission_status); oltre
+  ADMISSION_QUEUE_LIMIT persone in coda si risponde subito con una pagina 503.
+
+Chi entra riceve un pass in sessione valido ADMISSION_PASS_TTL secondi, così carrello
+e checkout dello stesso acquisto non lo rimettono in coda. Chi sta solo guardando
+il catalogo non passa mai da qui.
+
+Come per catalog_cache.py, con più worker serve un backend di cache condiviso
+(Memcached, Redis): con LocMemCache ogni processo avrebbe secchio, posti e coda propri.
+"""
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class ShopConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'shop'
+
+    def ready(self):
+        # Registra i receiver dei segnali (es. unione del carrello al login)
+        from . import signals  # noqa: F401
+        # Il gateway finto fuori da sviluppo e prove blocca l'avvio invece di accettare pagamenti falsi
+        from .payments import check_gateway
+        check_gateway()
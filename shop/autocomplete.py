@@ -0,0 +1,185 @@
+import heapq
+import threading
+from bisect import bisect_left
+
+from django.conf import settings
+from django.urls import reverse
+
+from .catalog_cache import get_catalog_version
+from .search import TOKEN_RE, fold
+
+
+def _normalize(text):
+    """ "  Abito  LÌNO" -> "abito lino": minuscolo, senza accenti, spazi singoli. """
+    return ' '.join(TOKEN_RE.findall(fold(text or '')))
+
+
+class _PrefixArray:
+    """
+    Array ordinato di coppie (chiave, id) per la ricerca per prefisso con bisect.
+    Gli id sono la posizione in classifica (0 = il suggerimento migliore), quindi
+    i migliori di un intervallo sono quelli con id più basso.
+    """
+
+    # Intervalli più corti di così si scorrono a ogni richiesta; per i più lunghi si memorizzano i migliori
+    SCAN_LIMIT = 500
+    TOP_SIZE = 64
+    MAX_MEMOIZED = 20000
+
+    def __init__(self, pairs):
+        pairs.sort()
+        self.keys = [key for key, _ in pairs]
+        self.ids = [entry_id for _, entry_id in pairs]
+        self._top = {}
+
+    def range(self, prefix):
+        lo = bisect_left(self.keys, prefix)
+        return lo, bisect_left(self.keys, prefix + '\uffff', lo)
+
+    def count(self, prefix):
+        lo, hi = self.range(prefix)
+        return hi - lo
+
+    def matching(self, prefix):
+        """ Insieme di tutti gli id con una chiave che inizia per `prefix`. """
+        lo, hi = self.range(prefix)
+        return set(self.ids[lo:hi])
+
+    def top(self, prefix, limit):
+        """ I `limit` id migliori con una chiave che inizia per `prefix`. """
+        lo, hi = self.range(prefix)
+        if hi - lo <= self.SCAN_LIMIT:
+            return heapq.nsmallest(limit, set(self.ids[lo:hi]))
+        # Prefissi corti ("a", "ab") coprono migliaia di voci: il calcolo si fa una volta sola
+        # per prefisso e poi i tasti successivi rispondono dalla memoria
+        top = self._top.get(prefix)
+        if top is None or (len(top) < limit < hi - lo):
+            if len(self._top) >= self.MAX_MEMOIZED:
+                self._top.clear()
+            top = heapq.nsmallest(max(limit, self.TOP_SIZE), set(self.ids[lo:hi]))
+            self._top[prefix] = top
+        return top[:limit]
+
+
+class AutocompleteIndex:
+    """
+    Indice dei suggerimenti: categorie e prodotti disponibili, in classifica per popolarità
+    (pezzi venduti). Tutto in memoria: una richiesta non tocca mai il database.
+    """
+
+    def __init__(self, entries):
+        # entries: tuple (tipo, nome, id, slug, venduti). Prima le categorie, poi i prodotti
+        # più venduti; a parità di vendite i più recenti (ID più alto)
+        entries.sort(key=lambda entry: (entry[0] != 'category', -entry[4], -entry[2]))
+        self.entries = entries
+        self.names = [_normalize(entry[1]) for entry in entries]
+        self.by_name = _PrefixArray([(name, i) for i, name in enumerate(self.names)])
+        self.by_word = _PrefixArray(
+            [(word, i) for i, name in enumerate(self.names) for word in set(name.split())]
+        )
+        self._urls = {}
+        self._memo = {}
+
+    def suggest(self, query, limit):
+        query = _normalize(query)
+        if not query:
+            return []
+        # Le stesse query arrivano da molti utenti (ogni tasto di "abito" è un prefisso comune)
+        key = (query, limit)
+        chosen = self._memo.get(key)
+        if chosen is None:
+            chosen = self._choose(query, limit)
+            if len(self._memo) >= _PrefixArray.MAX_MEMOIZED:
+                self._memo.clear()
+            self._memo[key] = chosen
+        return [self._result(entry_id) for entry_id in chosen]
+
+    def _choose(self, query, limit):
+        # Prima i nomi che iniziano con la query, poi quelli in cui ogni parola della query
+        # è l'inizio di una parola del nome ("abito li" -> "Abito in lino"); a parità vince il più venduto
+        chosen = self.by_name.top(query, limit)
+        missing = limit - len(chosen)
+        if missing > 0:
+            tokens = sorted(set(query.split()), key=self.by_word.count)
+            if len(tokens) == 1:
+                candidates = self.by_word.top(tokens[0], limit + len(chosen))
+            else:
+                # Intersezione in C partendo dalla parola più selettiva
+                candidates = self.by_word.matching(tokens[0])
+                for token in tokens[1:]:
+                    if not candidates:
+                        break
+                    lo, hi = self.by_word.range(token)
+                    candidates = candidates.intersection(self.by_word.ids[lo:hi])
+                candidates = heapq.nsmallest(limit + len(chosen), candidates)
+            already = set(chosen)
+            chosen += [entry_id for entry_id in candidates if entry_id not in already][:missing]
+        return chosen
+
+    def _result(self, entry_id):
+        kind, name, pk, slug, _ = self.entries[entry_id]
+        url = self._urls.get(entry_id)
+        if url is None:
+            # reverse() costa: l'URL si calcola solo per i suggerimenti davvero mostrati
+            if kind == 'category':
+                url = reverse('shop:product_list_by_category', args=[slug])
+            else:
+                url = reverse('shop:product_detail', args=[pk, slug])
+            self._urls[entry_id] = url
+        return {'type': kind, 'name': name, 'url': url}
+
+
+def build_index():
+    from .models import Category, Product
+
+    entries = []
+    category_sold = {}
+    # Popolarità dal contatore Product.sold, aggiornato al checkout
+    products = Product.objects.filter(available=True).values_list('id', 'name', 'slug', 'category_id', 'sold')
+    for pk, name, slug, category_id, product_sold in products.iterator(chunk_size=5000):
+        category_sold[category_id] = category_sold.get(category_id, 0) + product_sold
+        entries.append(('product', name, pk, slug, product_sold))
+    for pk, name, slug in Category.objects.values_list('id', 'name', 'slug'):
+        entries.append(('category', name, pk, slug, category_sold.get(pk, 0)))
+    return AutocompleteIndex(entries)
+
+
+class _State:
+    index = None
+    version = None
+
+
+_state = _State()
+_lock = threading.Lock()
+
+
+def get_index():
+    """ Indice del processo corrente, ricostruito solo quando cambia la versione del catalogo. """
+    version = get_catalog_version()
+    if _state.version != version:
+        with _lock:
+            # Un altro thread potrebbe averlo già ricostruito mentre aspettavamo il lock
+            if _state.version != version:
+                _state.index = build_index()
+                _state.version = version
+    return _state.index
+
+
+def suggest(query, limit=None):
+    """ Suggerimenti per la barra di ricerca: lista di dict {'type', 'name', 'url'}. """
+    return get_index().suggest(query, limit or settings.AUTOCOMPLETE_LIMIT)
+
+
+"""
+Autocompletamento mentre si scrive: una richiesta per ogni tasto premuto.
+Con una query `name__istartswith` per tasto il traffico dei suggerimenti
+finirebbe tutto sulla tabella Product; qui invece ogni processo tiene in memoria
+due array ordinati (nomi completi e singole parole, normalizzati senza accenti)
+e trova l'intervallo del prefisso con una ricerca binaria (bisect).
+I prefissi corti, che coprono migliaia di prodotti, tengono in memoria i loro
+migliori risultati dopo la prima richiesta.
+
+Il database si legge solo per ricostruire l'indice, quando cambia la versione
+del catalogo (catalog_cache.py): la popolarità (Product.sold, pezzi venduti)
+si aggiorna quindi alla prossima modifica del catalogo.
+"""
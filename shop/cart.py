@@ -1,20 +1,60 @@
+from collections import namedtuple
 from decimal import Decimal
-from django.conf import settings
-from shop.models import Product, Cart as CartModel, CartItem
+from shop.models import Product
+from shop.cart_storage import get_cart_storage
+
+
+# Riga del carrello pronta per i template: immutabile, non finisce mai nella sessione
+CartLine = namedtuple('CartLine', ['product', 'quantity', 'price', 'total_price'])
+
+
+class HydratedCart:
+    """
+    Vista in sola lettura del carrello con i prodotti già caricati dal database.
+    Totali e righe vengono calcolati una volta sola alla creazione.
+    """
+
+    def __init__(self, lines, missing=()):
+        self.lines = tuple(lines)
+        # ID dei prodotti presenti in sessione ma non più nel catalogo
+        self.missing = tuple(missing)
+        self.total_price = sum((line.total_price for line in self.lines), Decimal('0'))
+        self.total_items = sum(line.quantity for line in self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        # Come Cart.__len__: numero di pezzi, così {{ cart|length }} resta invariato nei template
+        return self.total_items
+
+    def get_total_price(self):
+        return self.total_price
+
+    def get_total_items(self):
+        return self.total_items
 
 
 class Cart:
     def __init__(self, request):
         """
-        Inizializza il carrello recuperandolo dalla sessione corrente.
+        Inizializza il carrello usando il backend configurato in settings.CART_STORAGE
+        (sessione o database). Il contenuto viene letto solo al primo accesso e,
+        se il carrello non esiste, nulla viene scritto finché non c'è una modifica
+        reale (add/remove): la semplice navigazione non genera righe in django_session
+        né cookie di sessione.
         """
         self.session = request.session
-        # Prova a recuperare il carrello usando l'ID definito nei settings
-        cart = self.session.get(settings.CART_SESSION_ID)
-        if not cart:
-            ## Se non esiste, crea un carrello vuoto (un dizionario) nella sessione
-            cart = self.session[settings.CART_SESSION_ID] = {}
-        self.cart = cart
+        self.storage = get_cart_storage(request)
+        self._cart = None
+        self._hydrated = None
+
+    @property
+    def cart(self):
+        """ Dizionario {'<product_id>': {'quantity': int, 'price': str}} caricato dal backend. """
+        if self._cart is None:
+            self._cart = self.storage.load()
+        return self._cart
     
     def add(self, product, quantity=1, override_quantity=False):
         """
@@ -30,11 +70,17 @@ class Cart:
         else:
             # Incrementa la quantità esistente (utile dal tasto "Aggiungi")
             self.cart[product_id]['quantity'] += quantity
-        self.save()
+        self.save([product_id])
     
-    def save(self):
-        #Notifica a Django che la sessione è stata modificata e deve essere salvata.
-        self.session.modified = True
+    def save(self, changed_ids=None):
+        """
+        Salva il carrello tramite il backend. `changed_ids` indica le righe modificate
+        (None = tutte): il backend su database scrive solo quelle.
+        """
+        if changed_ids is None:
+            changed_ids = list(self.cart)
+        self.storage.save(self.cart, changed_ids)
+        self._hydrated = None
     
     def remove(self, product):
         """
@@ -43,30 +89,43 @@ class Cart:
         product_id = str(product.id)
         if product_id in self.cart:
             del self.cart[product_id]
-            self.save()
-    
+            self.save([product_id])
+
+    def hydrate(self):
+        """
+        Restituisce il carrello "idratato" (HydratedCart) con i Product caricati in una sola query.
+        Il risultato è memorizzato sull'istanza: cicli nei template, totali e checkout
+        della stessa richiesta non rifanno la query. Viene invalidato a ogni modifica.
+        """
+        if self._hydrated is None:
+            # Recupera tutti i prodotti presenti nel carrello dal database (con la categoria)
+            products = Product.objects.select_related('category').in_bulk(
+                [int(product_id) for product_id in self.cart]
+            )
+            lines = []
+            missing = []
+            for product_id, item in self.cart.items():
+                product = products.get(int(product_id))
+                if product is None:
+                    missing.append(int(product_id))
+                    continue
+                # Converte il prezzo da stringa a Decimal senza toccare il dizionario in sessione
+                price = Decimal(item['price'])
+                lines.append(CartLine(product, item['quantity'], price, price * item['quantity']))
+            self._hydrated = HydratedCart(lines, missing)
+        return self._hydrated
+
     def __iter__(self):
         """
         Permette di ciclare sugli elementi del carrello (es. in un ciclo for nel template).
-        Recupera gli oggetti Product dal database per avere i dati aggiornati.
-        """
-        product_ids = self.cart.keys()
-        # Recupera tutti i prodotti presenti nel carrello dal database
-        products = Product.objects.filter(id__in=product_ids)
-        cart = self.cart.copy()
-        for product in products:
-            # Aggiunge l'oggetto prodotto reale al dizionario del carrello
-            cart[str(product.id)]['product'] = product
-        for item in cart.values():
-            # Converte il prezzo da stringa a Decimal per i calcoli
-            item['price'] = Decimal(item['price'])
-            # Calcola il subtotale per ogni riga
-            item['total_price'] = item['price'] * item['quantity']
-            yield item
+        Ogni elemento è una CartLine con product, quantity, price e total_price.
+        """
+        return iter(self.hydrate())
     
     def __len__(self):
         """
         Conta il numero totale di pezzi presenti nel carrello (somma delle quantità).
+        Non richiede query: usa solo i dati in sessione.
         """
         return sum(item['quantity'] for item in self.cart.values())
     
@@ -74,13 +133,25 @@ class Cart:
         """
         Calcola il costo totale complessivo del carrello.
         """
-        return sum(Decimal(item['price']) * item['quantity'] for item in self.cart.values())
+        return self.hydrate().total_price
     
     def get_total_items(self):
         """
         Restituisce il numero totale di articoli (equivalente a __len__).
         """
-        return sum(item['quantity'] for item in self.cart.values())
+        return len(self)
+    
+    def discard_missing(self):
+        """
+        Elimina dal carrello i prodotti che non esistono più nel catalogo.
+        Restituisce quanti articoli (righe) sono stati rimossi.
+        """
+        missing = [str(product_id) for product_id in self.hydrate().missing]
+        for product_id in missing:
+            self.cart.pop(product_id, None)
+        if missing:
+            self.save(missing)
+        return len(missing)
     
     def get_item_quantity(self, product_id):
         """
@@ -93,10 +164,11 @@ class Cart:
     
     def clear(self):
         """
-        Svuota completamente il carrello eliminandolo dalla sessione.
+        Svuota completamente il carrello (sessione o database, secondo il backend).
         """
-        del self.session[settings.CART_SESSION_ID]
-        self.save()
+        self.storage.clear()
+        self._cart = {}
+        self._hydrated = None
 
 """
 Velocità: Usare le sessioni (spesso salvate in cache o database temporanei)
@@ -106,10 +178,11 @@ senza rallentare il server con continue query SQL "pesanti".
 JSON friendly: Memorizziamo il prezzo come str (stringa)
 perché il formato JSON delle sessioni non supporta nativamente il tipo Decimal.
 Lo riconvertiamo in numero solo quando dobbiamo fare i calcoli
-(metodo __iter__ e get_total_price).
+(metodo hydrate), senza mai riscrivere il dizionario salvato in sessione.
 
 Indipendenza: Grazie al metodo __iter__,
 nei template HTML si può scrivere semplicemente {% for item in cart %}
 per accesso immediato a item.product.name, item.total_price, ecc.
+I prodotti vengono caricati una sola volta per richiesta (hydrate).
 
 """
\ No newline at end of file
@@ -0,0 +1,163 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils.functional import cached_property
+from django.utils.module_loading import import_string
+
+from .models import Cart as CartModel, CartItem
+
+
+def get_cart_storage(request):
+    """ Istanzia il backend di memorizzazione del carrello scelto in settings.CART_STORAGE. """
+    return import_string(settings.CART_STORAGE)(request)
+
+
+class SessionCartStorage:
+    """
+    Carrello salvato nella sessione (comportamento storico).
+    Formato: {'<product_id>': {'quantity': int, 'price': 'str'}}.
+    """
+
+    def __init__(self, request):
+        self.session = request.session
+
+    def load(self):
+        # Se non esiste, restituisce un dizionario vuoto NON ancora legato alla sessione
+        cart = self.session.get(settings.CART_SESSION_ID)
+        return cart if isinstance(cart, dict) else {}
+
+    def save(self, cart, changed_ids):
+        # Lega il carrello alla sessione (solo ora, alla prima modifica) e
+        # notifica a Django che la sessione è stata modificata e deve essere salvata.
+        self.session[settings.CART_SESSION_ID] = cart
+        self.session.modified = True
+
+    def clear(self):
+        if settings.CART_SESSION_ID in self.session:
+            del self.session[settings.CART_SESSION_ID]
+            self.session.modified = True
+
+
+class DatabaseCartStorage:
+    """
+    Carrello salvato nei modelli Cart/CartItem.
+    - Utente loggato: il carrello è quello legato all'utente (sopravvive tra dispositivi).
+    - Ospite: in sessione c'è solo l'ID del Cart, non le righe.
+    Le righe modificate vengono scritte con un unico upsert (bulk_create con update_conflicts).
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self.session = request.session
+
+    @cached_property
+    def user(self):
+        # Letto al primo accesso al carrello, non alla creazione: leggere l'utente apre la sessione
+        # (Vary: Cookie), e le pagine del catalogo in cache pubblica creano il carrello senza usarlo
+        user = self.request.user
+        return user if user.is_authenticated else None
+
+    def _cart_filter(self):
+        """ Filtro per trovare il carrello corrente senza crearlo (None se non esiste ancora). """
+        if self.user is not None:
+            return {'cart__user': self.user}
+        cart_id = self.session.get(settings.CART_SESSION_ID)
+        if not isinstance(cart_id, int):
+            return None
+        return {'cart_id': cart_id}
+
+    def _get_or_create_cart(self):
+        if self.user is not None:
+            cart, _ = CartModel.objects.get_or_create(user=self.user)
+            return cart
+        cart_id = self.session.get(settings.CART_SESSION_ID)
+        if isinstance(cart_id, int):
+            cart = CartModel.objects.filter(id=cart_id, user__isnull=True).first()
+            if cart is not None:
+                return cart
+        if self.session.session_key is None:
+            # Serve una chiave di sessione da salvare sul carrello (visibile nell'admin)
+            self.session.save()
+        cart = CartModel.objects.create(session_key=self.session.session_key)
+        self.session[settings.CART_SESSION_ID] = cart.id
+        return cart
+
+    def load(self):
+        lookup = self._cart_filter()
+        if lookup is None:
+            return {}
+        # Una sola query: righe del carrello con il prezzo attuale del prodotto
+        rows = CartItem.objects.filter(**lookup).values_list('product_id', 'quantity', 'product__price')
+        return {
+            str(product_id): {'quantity': quantity, 'price': str(price)}
+            for product_id, quantity, price in rows
+        }
+
+    def save(self, cart, changed_ids):
+        db_cart = self._get_or_create_cart()
+        upserts = [
+            CartItem(cart=db_cart, product_id=int(product_id), quantity=cart[product_id]['quantity'])
+            for product_id in changed_ids if product_id in cart
+        ]
+        removed = [int(product_id) for product_id in changed_ids if product_id not in cart]
+        with transaction.atomic():
+            if upserts:
+                CartItem.objects.bulk_create(
+                    upserts,
+                    update_conflicts=True,
+                    unique_fields=['cart', 'product'],
+                    update_fields=['quantity'],
+                )
+            if removed:
+                CartItem.objects.filter(cart=db_cart, product_id__in=removed).delete()
+
+    def clear(self):
+        lookup = self._cart_filter()
+        if lookup is not None:
+            CartItem.objects.filter(**lookup).delete()
+        if settings.CART_SESSION_ID in self.session:
+            del self.session[settings.CART_SESSION_ID]
+            self.session.modified = True
+
+
+def merge_anonymous_cart(request, user):
+    """
+    Al login unisce il carrello dell'ospite (DatabaseCartStorage) a quello dell'utente:
+    le quantità degli stessi prodotti vengono sommate, poi il carrello ospite viene eliminato.
+    Con SessionCartStorage non serve nulla: i dati di sessione sopravvivono al login.
+    """
+    if import_string(settings.CART_STORAGE) is not DatabaseCartStorage:
+        return
+    cart_id = request.session.get(settings.CART_SESSION_ID)
+    if not isinstance(cart_id, int):
+        return
+    anonymous = CartModel.objects.filter(id=cart_id, user__isnull=True).first()
+    del request.session[settings.CART_SESSION_ID]
+    if anonymous is None:
+        return
+    with transaction.atomic():
+        user_cart, _ = CartModel.objects.get_or_create(user=user)
+        existing = dict(user_cart.items.values_list('product_id', 'quantity'))
+        merged = [
+            CartItem(cart=user_cart, product_id=product_id, quantity=existing.get(product_id, 0) + quantity)
+            for product_id, quantity in anonymous.items.values_list('product_id', 'quantity')
+        ]
+        if merged:
+            CartItem.objects.bulk_create(
+                merged,
+                update_conflicts=True,
+                unique_fields=['cart', 'product'],
+                update_fields=['quantity'],
+            )
+        anonymous.delete()
+
+
+"""
+Il backend si sceglie in settings.py:
+
+    CART_STORAGE = 'shop.cart_storage.SessionCartStorage'   # default, carrello in sessione
+    CART_STORAGE = 'shop.cart_storage.DatabaseCartStorage'  # carrello persistente su DB
+
+La classe Cart (cart.py) non cambia API: delega a `load`, `save` e `clear`.
+`save` riceve gli ID delle righe modificate, così il backend su database
+scrive solo quelle (upsert) invece di riscrivere tutto il carrello.
+"""
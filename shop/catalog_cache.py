@@ -0,0 +1,62 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.http import Http404
+
+from .models import Category
+
+# Chiave del numero di versione del catalogo: ogni modifica a prodotti o categorie la incrementa
+VERSION_KEY = 'catalog:version'
+
+
+def get_catalog_version():
+    """
+    Versione corrente del catalogo. Fa parte di tutte le chiavi dei frammenti in cache:
+    quando cambia, i vecchi frammenti non vengono più letti e scadono da soli.
+    """
+    version = cache.get(VERSION_KEY)
+    if version is None:
+        # add() non sovrascrive un valore scritto nel frattempo da un altro processo
+        cache.add(VERSION_KEY, 1, timeout=None)
+        version = cache.get(VERSION_KEY, 1)
+    return version
+
+
+def bump_catalog_version():
+    """ Invalida in un colpo solo tutti i frammenti del catalogo in cache. """
+    try:
+        return cache.incr(VERSION_KEY)
+    except ValueError:
+        # La chiave non esiste (cache svuotata o riavviata): ripartiamo da una versione nuova
+        cache.set(VERSION_KEY, 2, timeout=None)
+        return 2
+
+
+def make_key(*parts):
+    """ Chiave di cache legata alla versione corrente del catalogo. """
+    return ':'.join(['catalog', str(get_catalog_version())] + [str(part) for part in parts])
+
+
+def get_category(slug):
+    """ Categoria per slug, letta dalla cache finché il catalogo non cambia. Solleva Http404. """
+    key = make_key('category', slug)
+    category = cache.get(key)
+    if category is None:
+        category = Category.objects.filter(slug=slug).first()
+        if category is None:
+            raise Http404('Categoria non trovata.')
+        cache.set(key, category, settings.CATALOG_CACHE_TIMEOUT)
+    return category
+
+
+"""
+Invalidazione per versione: invece di cercare e cancellare ogni frammento
+legato a un prodotto modificato, tutte le chiavi contengono il numero di versione
+del catalogo. I segnali post_save/post_delete di Product e Category (signals.py)
+incrementano la versione: le chiavi vecchie non vengono più richieste e la cache
+le elimina alla scadenza (CATALOG_CACHE_TIMEOUT).
+
+Funziona con qualunque backend di cache di Django. Con LocMemCache ogni processo
+ha la sua cache e la sua versione: in produzione con più worker usare un backend
+condiviso (FileBasedCache, Memcached, Redis) così un salvataggio nell'admin
+invalida le pagine di tutti i worker.
+"""
@@ -0,0 +1,120 @@
+from django.db import transaction
+
+from . import inventory, metrics, notifications, payments
+from .models import OrderItem, Product, StockReservation
+
+
+class OutOfStock(Exception):
+    """
+    Sollevata quando almeno una riga del carrello non può essere evasa.
+    `products` contiene i prodotti senza stock sufficiente (vuota se il carrello non è più valido),
+    `reason` il motivo: carrello vuoto, prodotto eliminato o non più in vendita, pezzi esauriti.
+    """
+
+    EMPTY = 'empty_cart'
+    REMOVED = 'product_removed'
+    UNAVAILABLE = 'product_unavailable'
+    SOLD_OUT = 'sold_out'
+
+    def __init__(self, products, reason=SOLD_OUT):
+        self.products = products
+        self.reason = reason
+        super().__init__(', '.join(str(p) for p in products))
+
+
+def place_order(order, cart, hold_token=None):
+    """
+    Salva l'ordine e le sue righe, scalando lo stock, in un'unica transazione.
+
+    Per ogni riga i pezzi già trattenuti dal carrello (`hold_token`, vedi reservations.py)
+    vengono venduti così come sono; quelli mancanti si tolgono dal contatore dei pezzi liberi
+    con un unico UPDATE condizionale per tutte le righe (inventory.take_many): il numero di
+    query non dipende dalle righe del carrello, tranne a fine scorte. La vendita è registrata
+    come StockMovement (solo INSERT): il checkout non aggiorna mai la riga del prodotto.
+    Se anche una sola riga non può essere evasa (stock esaurito nel frattempo da un altro
+    acquisto) l'intera transazione viene annullata e si solleva OutOfStock.
+    """
+    hydrated = cart.hydrate()
+    metrics.observe('shop_checkout_cart_items', hydrated.total_items)
+    if not hydrated.lines or hydrated.missing:
+        # Carrello vuoto o con prodotti eliminati dal catalogo dopo l'aggiunta
+        reason = OutOfStock.REMOVED if hydrated.missing else OutOfStock.EMPTY
+        metrics.inc('shop_checkout_failures_total', reason=reason)
+        raise OutOfStock([], reason)
+    lines = [(line.product, line.quantity, line.price) for line in hydrated]
+    # Totali denormalizzati calcolati dal carrello idratato: stesse righe e stessi prezzi degli OrderItem
+    order.total_cost = hydrated.total_price
+    order.item_count = hydrated.total_items
+
+    held = {}
+    try:
+        with transaction.atomic():
+            order.save()
+            holds = StockReservation.objects.none()
+            if hold_token:
+                # Bloccate fino al commit: il comando che libera le scadute non può restituirle nel frattempo
+                holds = StockReservation.objects.filter(
+                    token=hold_token, product_id__in=[product.id for product, _, _ in lines],
+                )
+                held = dict(holds.select_for_update().values_list('product_id', 'quantity'))
+            missing = {}
+            for product, quantity, _ in lines:
+                own = held.get(product.id, 0)
+                if not product.available:
+                    raise OutOfStock([], OutOfStock.UNAVAILABLE)
+                if quantity > own:
+                    missing[product.id] = quantity - own
+                elif own > quantity:
+                    # La prenotazione era più grande della riga: il resto torna libero
+                    inventory.give(product.id, own - quantity)
+            # Pezzi non coperti dalle prenotazioni: un solo UPDATE per tutte le righe (inventory.take_many)
+            if not inventory.take_many(missing):
+                # Qualcuno ha comprato prima di noi: l'eccezione annulla ordine e pezzi già tolti
+                raise OutOfStock([], OutOfStock.SOLD_OUT)
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=product, price=price, quantity=quantity)
+                for product, quantity, price in lines
+            ])
+            inventory.record_sales(order, [(product, quantity) for product, quantity, _ in lines])
+            holds.delete()
+            # Email di conferma in coda nella stessa transazione: la invia il worker, non la richiesta
+            notifications.notify([order], notifications.CONFIRMATION)
+            if order.payment_method == 'card':
+                # Non pagato entro PAYMENT_EXPIRY: annullato dal worker, i pezzi tornano in vendita
+                payments.schedule_expiry(order)
+    except OutOfStock as e:
+        # Fuori dalla transazione annullata rileggiamo i pezzi liberi per il messaggio all'utente
+        order.pk = None
+        metrics.inc('shop_checkout_failures_total', reason=e.reason)
+        raise OutOfStock(_unavailable(lines, held), e.reason)
+    metrics.inc('shop_checkouts_total')
+    return order
+
+
+def _unavailable(lines, held):
+    """ Ricarica i pezzi liberi attuali per indicare all'utente quali prodotti non sono più disponibili. """
+    ids = [product.id for product, _, _ in lines]
+    available = set(Product.objects.filter(id__in=ids, available=True).values_list('id', flat=True))
+    free = inventory.available_to_sell(ids)
+    return [
+        product for product, quantity, _ in lines
+        if product.id not in available or free[product.id] + held.get(product.id, 0) < quantity
+    ]
+
+
+"""
+Perché un UPDATE condizionale invece di `product.stock -= q; product.save()`:
+il vecchio codice leggeva lo stock, lo modificava in Python e lo riscriveva.
+Due checkout contemporanei leggevano lo stesso valore e l'ultimo a salvare
+sovrascriveva l'altro (overselling e stock sbagliato).
+
+`UPDATE ... SET quantity = quantity - q WHERE ... AND quantity >= q` viene valutato
+dal database sotto lock: il secondo acquirente trova i pezzi già tolti e la
+condizione fallisce (0 righe aggiornate), quindi l'ordine viene annullato.
+
+Con le prenotazioni (reservations.py) i pezzi trattenuti da altri carrelli
+non sono nel contatore dei pezzi liberi, quelli trattenuti da questo carrello
+si vendono senza toccarlo. Il contatore è diviso su STOCK_SHARDS righe
+(inventory.py): durante un lancio i checkout sullo stesso prodotto aggiornano
+righe diverse invece di mettersi in coda sulla riga di Product.
+"""
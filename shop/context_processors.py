@@ -8,3 +8,11 @@ from .cart import Cart
 # che useremo nei template HTML (es. {{ cart|length }})
 def cart(request):
     return {'cart': Cart(request)}
+
+
+def personalization(request):
+    """
+    Indica al template base se la pagina è "pubblica" (vedi decorators.public_when_client_personalized):
+    in quel caso badge carrello, menu utente e messaggi vengono riempiti dal browser.
+    """
+    return {'public_page': getattr(request, 'public_page', False)}
@@ -0,0 +1,87 @@
+from functools import wraps
+
+from django.conf import settings
+from django.shortcuts import redirect, render
+from django.urls import reverse
+from django.utils.cache import add_never_cache_headers, patch_cache_control
+from django.utils.http import url_has_allowed_host_and_scheme
+
+from . import admission, ratelimit
+
+
+def public_when_client_personalized(view_func):
+    """
+    Con SHOP_PERSONALIZATION = 'client' la pagina viene resa senza dati personali
+    (badge carrello, utente, messaggi, token CSRF: li riempie il browser da
+    shop:session_state) e inviata con Cache-Control: public, così una cache condivisa
+    o un reverse proxy può servirla a tutti gli utenti.
+    In modalità 'inline' (default) la vista resta invariata.
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if settings.SHOP_PERSONALIZATION != 'client':
+            return view_func(request, *args, **kwargs)
+        # Letto da context_processors.personalization: il template non tocca sessione né cookie
+        request.public_page = True
+        response = view_func(request, *args, **kwargs)
+        if response.status_code == 200:
+            patch_cache_control(response, public=True, max_age=settings.SHOP_PUBLIC_CACHE_SECONDS)
+        return response
+    return wrapper
+
+
+def admission_controlled(view_func):
+    """
+    Fa passare la vista dal controllo degli ingressi (shop/admission.py): durante un lancio
+    chi arriva oltre il ritmo consentito va nella pagina di attesa con la sua posizione,
+    e con la coda piena riceve subito una pagina 503 invece di aspettare un timeout.
+    Con ADMISSION_ENABLED = False (e nessuna modifica a runtime) la vista resta invariata.
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        config = admission.get_config()
+        if not config['enabled']:
+            return view_func(request, *args, **kwargs)
+        state = admission.admit(request.session, config)
+        if state == admission.QUEUED:
+            # Un POST non si può ripetere dopo l'attesa: si torna alla pagina da cui è partito
+            if request.method == 'GET':
+                next_url = request.get_full_path()
+            else:
+                next_url = request.META.get('HTTP_REFERER', '')
+            if not url_has_allowed_host_and_scheme(next_url, {request.get_host()}, request.is_secure()):
+                next_url = reverse('shop:cart_detail')
+            request.session[admission.NEXT_SESSION_KEY] = next_url
+            return redirect('shop:admission_queue')
+        slot = admission.acquire_slot(config) if state == admission.ADMITTED else None
+        if slot is None:
+            return _busy(request)
+        try:
+            return view_func(request, *args, **kwargs)
+        finally:
+            admission.release_slot(slot)
+    return wrapper
+
+
+def _busy(request):
+    # 503 + Retry-After: browser, proxy e bilanciatori capiscono che è un rifiuto temporaneo
+    response = render(request, 'shop/admission/busy.html', {'retry_after': settings.ADMISSION_RETRY_AFTER}, status=503)
+    response['Retry-After'] = str(settings.ADMISSION_RETRY_AFTER)
+    add_never_cache_headers(response)
+    return response
+
+
+def rate_limited(name):
+    """
+    Limita la frequenza della vista con il limite `name` di RATE_LIMITS, contato per sessione
+    e utente, e con quello di RATE_LIMITS_IP per IP (shop/ratelimit.py). Oltre il limite risponde 429 con Retry-After, senza query.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            retry_after = ratelimit.hit(name, request)
+            if retry_after:
+                return ratelimit.too_many_requests(retry_after)
+            return view_func(request, *args, **kwargs)
+        return wrapper
+    return decorator
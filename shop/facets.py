@@ -0,0 +1,252 @@
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, F, Q
+from django.urls import reverse
+from django.utils import timezone
+
+from . import catalog_cache
+from .models import Category, Product
+
+# Ordinamenti della vetrina (?sort=): etichetta e chiavi della paginazione a cursore.
+# Ognuno ha i suoi indici composti in Product.Meta.indexes (verificati da check_catalog_indexes)
+SORT_ORDERS = {
+    'newest': ('Novità', ('-created', '-id')),
+    'price_asc': ('Prezzo crescente', ('price', 'id')),
+    'price_desc': ('Prezzo decrescente', ('-price', '-id')),
+    'bestseller': ('Più venduti', ('-sold', '-id')),
+}
+DEFAULT_SORT = 'newest'
+
+
+def price_bands():
+    """ Fasce di prezzo dai settings come {chiave: (min, max)}, es. {'50-100': (50, 100), '200-': (200, None)}. """
+    bands = {}
+    for low, high in settings.CATALOG_PRICE_BANDS:
+        key = f'{low if low is not None else ""}-{high if high is not None else ""}'
+        bands[key] = (low, high)
+    return bands
+
+
+def _band_label(low, high):
+    if low is None:
+        return f'Fino a {high} €'
+    if high is None:
+        return f'Da {low} €'
+    return f'{low} - {high} €'
+
+
+def _in_stock_q():
+    # Disponibili per la vendita: stock non trattenuto nei carrelli (vedi reservations.py)
+    return Q(stock__gt=F('reserved'))
+
+
+def _band_q(low, high):
+    q = Q()
+    if low is not None:
+        q &= Q(price__gte=Decimal(low))
+    if high is not None:
+        q &= Q(price__lt=Decimal(high))
+    return q
+
+
+def newest_cutoff():
+    """ Inizio del periodo "Novità": mezzanotte di CATALOG_NEW_DAYS giorni fa (stabile per tutto il giorno). """
+    today = timezone.localtime().replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=settings.CATALOG_NEW_DAYS)
+
+
+class FacetSelection:
+    """ Filtri scelti dall'utente: categoria (dall'URL) più fascia di prezzo, disponibilità e novità (da GET). """
+
+    def __init__(self, category=None, price=None, in_stock=False, new=False, sort=DEFAULT_SORT):
+        self.category = category
+        self.price = price
+        self.in_stock = in_stock
+        self.new = new
+        self.sort = sort
+
+    @classmethod
+    def from_request(cls, request, category=None):
+        # Valori non riconosciuti vengono ignorati: un link vecchio non deve dare errore
+        price = request.GET.get('price')
+        sort = request.GET.get('sort')
+        return cls(
+            category=category,
+            price=price if price in price_bands() else None,
+            in_stock=request.GET.get('in_stock') == '1',
+            new=request.GET.get('new') == '1',
+            sort=sort if sort in SORT_ORDERS else DEFAULT_SORT,
+        )
+
+    @property
+    def key(self):
+        """ Parte delle chiavi di cache che identifica filtri e ordinamento (categoria esclusa). """
+        return f'{self.price or ""}:{int(self.in_stock)}:{int(self.new)}:{self.sort}'
+
+    @property
+    def ordering(self):
+        """ Chiavi della paginazione a cursore per l'ordinamento scelto. """
+        return SORT_ORDERS[self.sort][1]
+
+    def conditions(self, cutoff):
+        """ Condizione di ogni filtro attivo, esclusa la categoria: {nome: Q}. """
+        conditions = {}
+        if self.price:
+            conditions['price'] = _band_q(*price_bands()[self.price])
+        if self.in_stock:
+            conditions['in_stock'] = _in_stock_q()
+        if self.new:
+            conditions['new'] = Q(created__gte=cutoff)
+        return conditions
+
+    def filter(self, queryset):
+        """ Applica al queryset dei prodotti tutti i filtri attivi. """
+        if self.category is not None:
+            queryset = queryset.filter(category=self.category)
+        for condition in self.conditions(newest_cutoff()).values():
+            queryset = queryset.filter(condition)
+        return queryset
+
+    def query_string(self, **changes):
+        """ Query string con i filtri attuali modificati da `changes` (None = filtro tolto). """
+        params = {
+            'price': self.price,
+            'in_stock': '1' if self.in_stock else None,
+            'new': '1' if self.new else None,
+            'sort': self.sort if self.sort != DEFAULT_SORT else None,
+        }
+        params.update(changes)
+        encoded = '&'.join(f'{name}={value}' for name, value in params.items() if value)
+        return f'?{encoded}' if encoded else ''
+
+
+def _count(condition):
+    # Count con filter=Q() vuoto non è valido: senza condizioni si contano tutte le righe del gruppo
+    return Count('id', filter=condition) if condition else Count('id')
+
+
+def _and(conditions):
+    combined = Q()
+    for condition in conditions:
+        combined &= condition
+    return combined
+
+
+def counts_queryset(selection, cutoff):
+    """
+    Tutti i conteggi dei filtri in UNA query: GROUP BY categoria con un COUNT condizionale
+    per ogni valore di filtro. Ogni conteggio applica gli altri filtri attivi ma non il proprio
+    (con "50-100 €" scelto, le altre fasce mostrano quanti prodotti si otterrebbero cambiandola).
+    """
+    conditions = selection.conditions(cutoff)
+
+    def others(excluded):
+        return _and(q for name, q in conditions.items() if name != excluded)
+
+    aggregates = {
+        'category_count': _count(others(None)),
+        'in_stock_count': _count(_in_stock_q() & others('in_stock')),
+        'new_count': _count(Q(created__gte=cutoff) & others('new')),
+    }
+    bands = price_bands()
+    for index, (low, high) in enumerate(bands.values()):
+        aggregates[f'price_{index}'] = _count(_band_q(low, high) & others('price'))
+    # order_by() vuoto: l'ordinamento di default (-created) finirebbe nel GROUP BY
+    return (
+        Product.objects.filter(available=True)
+        .values('category_id').order_by()
+        .annotate(**aggregates)
+    )
+
+
+def compute_counts(selection, cutoff):
+    """ Conteggi per categoria, fascia di prezzo, disponibilità e novità (vedi counts_queryset). """
+    bands = price_bands()
+    counts = {'category': {}, 'price': dict.fromkeys(bands, 0), 'in_stock': 0, 'new': 0, 'total': 0}
+    selected_id = selection.category.id if selection.category is not None else None
+    for row in counts_queryset(selection, cutoff):
+        counts['category'][row['category_id']] = row['category_count']
+        # La categoria scelta limita i conteggi degli altri filtri: sommiamo solo il suo gruppo
+        if selected_id is not None and row['category_id'] != selected_id:
+            continue
+        counts['total'] += row['category_count']
+        counts['in_stock'] += row['in_stock_count']
+        counts['new'] += row['new_count']
+        for index, key in enumerate(bands):
+            counts['price'][key] += row[f'price_{index}']
+    return counts
+
+
+def get_facets(selection):
+    """
+    Filtri da mostrare nella vetrina, con conteggi e link. In cache finché non cambia
+    il catalogo: ogni salvataggio di un prodotto e ogni esaurimento rilevato dalla compattazione
+    del magazzino (inventory.compact) incrementano la versione (catalog_cache.py), quindi anche
+    il filtro "Disponibili" resta corretto.
+    """
+    cutoff = newest_cutoff()
+    category_slug = selection.category.slug if selection.category is not None else ''
+    key = catalog_cache.make_key('facets', category_slug, selection.key, cutoff.date())
+    facets = cache.get(key)
+    if facets is None:
+        counts = compute_counts(selection, cutoff)
+        query = selection.query_string()
+        facets = {
+            'all': {
+                'url': reverse('shop:product_list') + query,
+                'count': sum(counts['category'].values()),
+                'selected': selection.category is None,
+            },
+            'categories': [
+                {
+                    'name': name,
+                    'url': reverse('shop:product_list_by_category', args=[slug]) + query,
+                    'count': counts['category'].get(category_id, 0),
+                    'selected': slug == category_slug,
+                }
+                for category_id, name, slug in Category.objects.values_list('id', 'name', 'slug')
+            ],
+            'prices': [
+                {
+                    'label': _band_label(low, high),
+                    # Un secondo clic sulla fascia scelta la toglie
+                    'url': selection.query_string(price=None if band == selection.price else band) or '?',
+                    'count': counts['price'][band],
+                    'selected': band == selection.price,
+                }
+                for band, (low, high) in price_bands().items()
+            ],
+            'in_stock': {
+                'url': selection.query_string(in_stock=None if selection.in_stock else '1') or '?',
+                'count': counts['in_stock'],
+                'selected': selection.in_stock,
+            },
+            'new': {
+                'url': selection.query_string(new=None if selection.new else '1') or '?',
+                'count': counts['new'],
+                'selected': selection.new,
+            },
+            'sorts': [
+                {
+                    'label': label,
+                    'url': selection.query_string(sort=None if sort == DEFAULT_SORT else sort) or '?',
+                    'selected': sort == selection.sort,
+                }
+                for sort, (label, _) in SORT_ORDERS.items()
+            ],
+            'total': counts['total'],
+        }
+        cache.set(key, facets, settings.CATALOG_CACHE_TIMEOUT)
+    return facets
+
+
+"""
+Perché una sola query: con un COUNT per ogni categoria e ogni fascia di prezzo
+una pagina del catalogo farebbe decine di query. Qui il database legge i prodotti
+disponibili una volta e calcola tutti i conteggi insieme (COUNT(...) FILTER / CASE WHEN),
+raggruppati per categoria; i totali degli altri filtri si sommano in Python.
+Il risultato resta in cache per versione del catalogo e combinazione di filtri.
+"""
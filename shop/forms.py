@@ -1,6 +1,9 @@
+import uuid
+
 from django import forms
 from django.contrib.auth.models import User
-from .models import Order
+from . import inventory
+from .models import Order, Product
 
 # --- FORM AGGIUNTA AL CARRELLO ---
 class CartAddProductForm(forms.Form):
@@ -56,6 +59,15 @@ class UserRegistrationForm(forms.ModelForm):
 # --- FORM CREAZIONE ORDINE ---
 class OrderCreateForm(forms.ModelForm):
     """ Form basato sul modello Order per raccogliere i dati di spedizione. """
+    # Chiave di idempotenza (shop/idempotency.py): nuova a ogni apertura del checkout, uguale nei reinvii
+    # dello stesso modulo. Facoltativa: un modulo senza chiave (pagina vecchia) crea l'ordine come prima
+    idempotency_key = forms.RegexField(regex=r'^[0-9a-f]{32}$', required=False, widget=forms.HiddenInput)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not self.is_bound:
+            self.fields['idempotency_key'].initial = uuid.uuid4().hex
+
     class Meta:
         model = Order
         # Campi che l'utente deve compilare per completare l'acquisto
@@ -71,6 +83,27 @@ class OrderCreateForm(forms.ModelForm):
             'payment_method': forms.RadioSelect(attrs={'class': 'form-check-input'}),
         }
 
+# --- FORM PRODOTTO NELL'ADMIN ---
+class ProductAdminForm(forms.ModelForm):
+    """ Scheda prodotto dell'admin: lo stock non si riscrive, si indicano i pezzi arrivati o tolti. """
+    stock_delta = forms.IntegerField(
+        required=False, label='Rifornimento',
+        help_text='Pezzi arrivati in magazzino (negativo per i pezzi tolti: resi difettosi, danneggiati).',
+    )
+
+    class Meta:
+        model = Product
+        fields = '__all__'
+
+    def clean_stock_delta(self):
+        """ Non si possono togliere più pezzi di quelli liberi (quelli nei carrelli restano trattenuti). """
+        delta = self.cleaned_data.get('stock_delta') or 0
+        if delta < 0 and self.instance.pk is not None:
+            free = inventory.available_to_sell([self.instance.pk])[self.instance.pk]
+            if -delta > free:
+                raise forms.ValidationError(f'Si possono togliere al massimo {free} pezzi.')
+        return delta
+
 """
 forms.ModelForm: viene usato per User e Order. 
 Django guarda il modello nel database e crea automaticamente i campi corrispondenti, 
@@ -0,0 +1,57 @@
+from django.conf import settings
+from django.core.cache import cache
+
+# Valore in cache mentre la prima richiesta con la chiave sta ancora creando l'ordine
+PENDING = 'pending'
+
+
+def _cache_key(token):
+    return f'checkout:idempotency:{token}'
+
+
+def begin(token):
+    """
+    Da chiamare prima di creare l'ordine del modulo con chiave `token`. Risponde subito, senza
+    aspettare: None se tocca a questa richiesta crearlo, l'ID dell'ordine se un invio precedente
+    dello stesso modulo lo ha già creato, oppure PENDING se quell'invio è ancora in corso
+    (il cliente aspetta nella pagina shop:order_pending, che richiede status()).
+    """
+    key = _cache_key(token)
+    # add() è atomico: tra più invii contemporanei uno solo ottiene la chiave
+    if cache.add(key, PENDING, settings.CHECKOUT_IDEMPOTENCY_TTL):
+        return None
+    result = cache.get(key)
+    if result is None:
+        # Il primo invio è fallito (es. stock esaurito) e ha appena liberato la chiave: si prova a prenderla
+        if cache.add(key, PENDING, settings.CHECKOUT_IDEMPOTENCY_TTL):
+            return None
+        return cache.get(key, PENDING)
+    return result
+
+
+def status(token):
+    """ ID dell'ordine creato con la chiave, PENDING se la creazione è in corso, None se non c'è (fallita o scaduta). """
+    return cache.get(_cache_key(token))
+
+
+def finish(token, order_id):
+    """ Ordine creato: gli invii successivi dello stesso modulo ricevono questo ordine. """
+    if token:
+        cache.set(_cache_key(token), order_id, settings.CHECKOUT_IDEMPOTENCY_TTL)
+
+
+def abort(token):
+    """ Ordine non creato: la chiave torna libera e il cliente può correggere e reinviare il modulo. """
+    if token:
+        cache.delete(_cache_key(token))
+
+
+"""
+Invii doppi del checkout: con una risposta lenta il cliente clicca di nuovo, o il browser
+ripete la richiesta, e ogni invio creava un altro ordine con altre righe e altri pezzi tolti
+dal magazzino. Il modulo contiene una chiave casuale (OrderCreateForm.idempotency_key),
+uguale in tutti i reinvii dello stesso modulo: il primo invio crea l'ordine, gli altri
+ricevono lo stesso ordine dalla cache senza transazioni né scritture sullo stock.
+La chiave vale CHECKOUT_IDEMPOTENCY_TTL secondi; come per admission.py, con più worker
+serve un backend di cache condiviso.
+"""
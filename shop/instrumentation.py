@@ -0,0 +1,210 @@
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache.backends import locmem
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends import django as django_templates
+
+# Misure della richiesta in corso (None fuori da una richiesta strumentata)
+_current = ContextVar('instrumentation_stats', default=None)
+# Ultime richieste misurate dal processo (le più vecchie escono da sole)
+_recent = deque(maxlen=1)
+_recent_lock = threading.Lock()
+_missing = object()
+
+
+class RequestStats:
+    """ Contatori di una richiesta: query SQL, tempo SQL, tempo dei template, letture dalla cache e salvataggi della sessione. """
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_time = 0.0
+        self.template_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.session_writes = 0
+        self.rendering = False
+
+
+def _record_sql(execute, sql, params, many, context):
+    stats = _current.get()
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        if stats is not None:
+            stats.queries += 1
+            stats.sql_time += time.perf_counter() - started
+
+
+class _TimedTemplate(django_templates.Template):
+
+    def render(self, context=None, request=None):
+        stats = _current.get()
+        # I template inclusi passano dal motore, non da qui: si misura solo il template principale
+        if stats is None or stats.rendering:
+            return super().render(context, request)
+        stats.rendering = True
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            stats.rendering = False
+            stats.template_time += time.perf_counter() - started
+
+
+class DjangoTemplates(django_templates.DjangoTemplates):
+    """ Backend dei template di Django che misura il tempo di render (TEMPLATES con INSTRUMENTATION_ENABLED). """
+
+    def from_string(self, template_code):
+        return _TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        return _TimedTemplate(super().get_template(template_name).template, self)
+
+
+class CountingCacheMixin:
+    """ Conta letture riuscite e mancate della richiesta in corso; da mettere prima della classe del backend. """
+
+    def get(self, key, default=None, version=None):
+        value = super().get(key, _missing, version=version)
+        stats = _current.get()
+        if stats is not None:
+            if value is _missing:
+                stats.cache_misses += 1
+            else:
+                stats.cache_hits += 1
+        return default if value is _missing else value
+
+    def get_many(self, keys, version=None):
+        keys = list(keys)
+        stats = _current.get()
+        if stats is None:
+            return super().get_many(keys, version=version)
+        hits, misses = stats.cache_hits, stats.cache_misses
+        found = super().get_many(keys, version=version)
+        # La get_many di BaseCache passa da get(): i conteggi si rifanno per chiave, senza contare due volte
+        stats.cache_hits = hits + len(found)
+        stats.cache_misses = misses + len(keys) - len(found)
+        return found
+
+
+class LocMemCache(CountingCacheMixin, locmem.LocMemCache):
+    """ LocMemCache con il conteggio delle letture (CACHES con INSTRUMENTATION_ENABLED o METRICS_ENABLED). """
+
+
+def session_writes(request, response):
+    """ 1 se SessionMiddleware salverà la sessione a fine richiesta (stesse condizioni di process_response), altrimenti 0. """
+    session = getattr(request, 'session', None)
+    if session is None or response.status_code == 500:
+        return 0
+    if not (session.modified or settings.SESSION_SAVE_EVERY_REQUEST):
+        return 0
+    # Sessione vuota: viene cancellata (o non creata), non salvata
+    return 0 if session.is_empty() else 1
+
+
+@contextmanager
+def collecting():
+    """
+    Contatori della richiesta in corso per chi li legge a fine richiesta (es. shop/metrics.py):
+    quelli di InstrumentationMiddleware se è attivo, altrimenti nuovi (senza le query SQL).
+    """
+    stats = _current.get()
+    if stats is not None:
+        yield stats
+        return
+    stats = RequestStats()
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+def recent():
+    """ Misure delle ultime richieste del processo, dalla più recente. """
+    with _recent_lock:
+        return list(reversed(_recent))
+
+
+class InstrumentationMiddleware:
+    """
+    Misura ogni richiesta: numero e tempo delle query SQL, tempo di render del template,
+    letture dalla cache riuscite e mancate, salvataggi della sessione. I valori finiscono negli header della risposta
+    (X-Query-Count, ..., e Server-Timing, visibile negli strumenti del browser) e nelle
+    ultime INSTRUMENTATION_BUFFER_SIZE richieste del processo (recent(), vista shop:instrumentation).
+    Attivo solo con INSTRUMENTATION_ENABLED = True: altrimenti Django lo toglie all'avvio.
+    """
+
+    def __init__(self, get_response):
+        if not settings.INSTRUMENTATION_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        global _recent
+        _recent = deque(maxlen=settings.INSTRUMENTATION_BUFFER_SIZE)
+
+    def __call__(self, request):
+        stats = RequestStats()
+        token = _current.set(stats)
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                # execute_wrapper su tutte le connessioni configurate, per la durata della richiesta
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(_record_sql))
+                response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        stats.session_writes += session_writes(request, response)
+        total = time.perf_counter() - started
+        match = request.resolver_match
+        with _recent_lock:
+            _recent.append({
+                'time': time.time(),
+                'method': request.method,
+                'path': request.path,
+                'view': match.view_name if match else '',
+                'status': response.status_code,
+                'queries': stats.queries,
+                'sql_ms': round(stats.sql_time * 1000, 2),
+                'template_ms': round(stats.template_time * 1000, 2),
+                'cache_hits': stats.cache_hits,
+                'cache_misses': stats.cache_misses,
+                'session_writes': stats.session_writes,
+                'total_ms': round(total * 1000, 2),
+            })
+        response['X-Query-Count'] = str(stats.queries)
+        response['X-Query-Time-Ms'] = f'{stats.sql_time * 1000:.2f}'
+        response['X-Template-Time-Ms'] = f'{stats.template_time * 1000:.2f}'
+        response['X-Cache-Hits'] = str(stats.cache_hits)
+        response['X-Cache-Misses'] = str(stats.cache_misses)
+        response['X-Session-Writes'] = str(stats.session_writes)
+        response['Server-Timing'] = (
+            f'db;desc="{stats.queries} query";dur={stats.sql_time * 1000:.2f}, '
+            f'tpl;dur={stats.template_time * 1000:.2f}, total;dur={total * 1000:.2f}'
+        )
+        return response
+
+
+"""
+Strumentazione delle viste, da attivare in sviluppo o per poco tempo in produzione
+(INSTRUMENTATION_ENABLED = True): rende visibili query ripetute per ogni riga (N+1),
+template lenti e frammenti che non arrivano mai dalla cache. Il tempo SQL delle query
+lanciate dal template (queryset pigri) è contato sia in db sia in tpl.
+
+Nessun metodo di Django viene sostituito: le query passano da execute_wrapper, il render
+dal backend DjangoTemplates di questo modulo e le letture dalla cache dal backend
+LocMemCache (o da CountingCacheMixin davanti a un altro backend, es. Redis), scelti in
+settings.py solo quando la strumentazione o le metriche sono attive. I salvataggi della
+sessione sono quelli di SessionMiddleware a fine richiesta, dedotti dallo stato della
+sessione (non quelli chiamati a mano con session.save()).
+
+Le stesse soglie si verificano in CI con shop/testing.py (budget di query per vista,
+comando check_query_budgets).
+"""
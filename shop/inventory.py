@@ -0,0 +1,315 @@
+import random
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, OuterRef, PositiveIntegerField, Q, Subquery, Sum, When
+from django.db.models.functions import Coalesce
+
+from . import jobs
+from .catalog_cache import bump_catalog_version
+from .models import Order, Product, StockMovement, StockReservation, StockShard
+
+SALE = 'sale'
+RESTOCK = 'restock'
+ADJUSTMENT = 'adjustment'
+CANCELLATION = 'cancellation'
+
+
+def _split(quantity, parts):
+    """ 10 pezzi su 4 righe -> [3, 3, 2, 2]. """
+    return [quantity // parts + (1 if index < quantity % parts else 0) for index in range(parts)]
+
+
+# --- CONTATORE DIVISO (pezzi liberi) ---
+def take(product_id, quantity):
+    """
+    Toglie `quantity` pezzi liberi al prodotto, da chiamare dentro una transazione.
+    Restituisce False, senza modificare nulla, se non bastano.
+    """
+    shards = settings.STOCK_SHARDS
+    # Riga di partenza casuale: i worker concorrenti si distribuiscono sulle righe invece di aspettarsi
+    for index in random.sample(range(shards), shards):
+        if StockShard.objects.filter(product_id=product_id, index=index, quantity__gte=quantity).update(
+            quantity=F('quantity') - quantity,
+        ):
+            return True
+    # Nessuna riga basta da sola (fine scorte o quantità grandi): si bloccano tutte le righe del prodotto
+    rows = list(StockShard.objects.select_for_update().filter(product_id=product_id).order_by('index'))
+    if not rows:
+        # Prodotto creato senza segnali (bulk_create): il contatore nasce dallo stock attuale
+        product = Product.objects.filter(id=product_id).first()
+        if product is None:
+            return False
+        set_stocks({product_id: current_stock(product)})
+        rows = list(StockShard.objects.select_for_update().filter(product_id=product_id).order_by('index'))
+    if sum(row.quantity for row in rows) < quantity:
+        return False
+    remaining = quantity
+    for row in rows:
+        part = min(row.quantity, remaining)
+        if part:
+            row.quantity -= part
+            row.save(update_fields=['quantity'])
+            remaining -= part
+    return True
+
+
+class _Short(Exception):
+    """ Una delle righe scelte da take_many non bastava: si annulla l'UPDATE e si passa a take(). """
+
+
+def take_many(quantities):
+    """
+    take() per più prodotti {product_id: pezzi}, da chiamare dentro una transazione.
+    Nel caso comune (ogni riga scelta a caso ha abbastanza pezzi) un solo UPDATE per tutto
+    il carrello; altrimenti (fine scorte) si riprova prodotto per prodotto con take(), quindi
+    al massimo STOCK_SHARDS + 2 query per riga. Restituisce False se un prodotto non basta:
+    il chiamante deve annullare la transazione (i prodotti già presi restano tolti).
+    """
+    if not quantities:
+        return True
+    shards = settings.STOCK_SHARDS
+    chosen = {product_id: random.randrange(shards) for product_id in quantities}
+    try:
+        with transaction.atomic():
+            updated = StockShard.objects.filter(reduce(or_, [
+                Q(product_id=product_id, index=chosen[product_id], quantity__gte=quantity)
+                for product_id, quantity in quantities.items()
+            ])).update(quantity=F('quantity') - Case(
+                *[When(product_id=product_id, then=quantity) for product_id, quantity in quantities.items()],
+                output_field=PositiveIntegerField(),
+            ))
+            if updated != len(quantities):
+                raise _Short
+        return True
+    except _Short:
+        pass
+    # In ordine di ID: due checkout sugli stessi prodotti bloccano le righe nello stesso ordine
+    return all(take(product_id, quantity) for product_id, quantity in sorted(quantities.items()))
+
+
+def give(product_id, quantity):
+    """ Restituisce `quantity` pezzi liberi al prodotto (prenotazione liberata, riga del carrello ridotta). """
+    index = random.randrange(settings.STOCK_SHARDS)
+    if not StockShard.objects.filter(product_id=product_id, index=index).update(quantity=F('quantity') + quantity):
+        # STOCK_SHARDS aumentato dopo la creazione del prodotto: la riga scelta non esiste ancora
+        row, _ = StockShard.objects.get_or_create(product_id=product_id, index=index)
+        StockShard.objects.filter(id=row.id).update(quantity=F('quantity') + quantity)
+
+
+def available_to_sell(product_ids):
+    """ Pezzi liberi esatti (somma delle righe del contatore): {product_id: pezzi}. """
+    totals = dict(
+        StockShard.objects.filter(product_id__in=product_ids)
+        .values('product_id').order_by()
+        .annotate(total=Sum('quantity')).values_list('product_id', 'total')
+    )
+    return {product_id: totals.get(product_id, 0) for product_id in product_ids}
+
+
+# --- REGISTRO MOVIMENTI ---
+def current_stock(product):
+    """ Stock attuale: fotografia in Product.stock più i movimenti non ancora compattati. """
+    pending = product.stock_movements.filter(compacted=False).aggregate(total=Sum('quantity'))['total']
+    return product.stock + (pending or 0)
+
+
+def schedule_compaction():
+    """
+    Mette in coda una compattazione (shop/jobs.py) nella transazione corrente: sparisce se questa
+    viene annullata e non si perde se il processo cade subito dopo il commit.
+    Pochi lavori in attesa per tutti i checkout (jobs.shared_key): gli altri inserimenti vengono
+    scartati, e compact() può girare in più worker insieme (righe prese con SKIP LOCKED).
+    """
+    jobs.enqueue(
+        'shop.inventory.compact', dedupe_key=jobs.shared_key('compact_stock_ledger'),
+        delay=settings.STOCK_COMPACT_DELAY,
+    )
+
+
+def record_sales(order, lines):
+    """ Un movimento di vendita per ogni riga (product, quantità) dell'ordine: solo INSERT. """
+    StockMovement.objects.bulk_create([
+        StockMovement(product=product, kind=SALE, quantity=-quantity, order=order)
+        for product, quantity in lines
+    ])
+    schedule_compaction()
+
+
+def set_stocks(targets, kind=ADJUSTMENT, previous=None):
+    """
+    Inventario: porta lo stock dei prodotti {product_id: pezzi} ai valori indicati (import, prodotti nuovi).
+    Il nuovo valore sostituisce fotografia e movimenti in sospeso (registrati come compattati),
+    e i pezzi liberi del contatore diventano stock - pezzi nei carrelli. Poche query per tutto il blocco.
+    `previous` ({product_id: pezzi}) è la fotografia precedente quando Product.stock è già stato
+    sovrascritto (bulk_update dell'import): serve a registrare la differenza giusta.
+    """
+    if not targets:
+        return
+    ids = list(targets)
+    with transaction.atomic():
+        # Le righe bloccate fermano checkout e prenotazioni sugli stessi prodotti fino al commit
+        list(StockShard.objects.select_for_update().filter(product_id__in=ids).values_list('id'))
+        current = dict(Product.objects.filter(id__in=ids).values_list('id', 'stock'))
+        current.update((product_id, stock) for product_id, stock in (previous or {}).items() if product_id in current)
+        pending = {}
+        for product_id, movement_kind, quantity in (
+            StockMovement.objects.filter(product_id__in=ids, compacted=False).values_list('product_id', 'kind', 'quantity')
+        ):
+            stock_delta, sold_delta = pending.get(product_id, (0, 0))
+            pending[product_id] = (stock_delta + quantity, sold_delta + _sold_delta(movement_kind, quantity))
+        held = dict(
+            StockReservation.objects.filter(product_id__in=ids)
+            .values('product_id').order_by()
+            .annotate(total=Sum('quantity')).values_list('product_id', 'total')
+        )
+        StockMovement.objects.filter(product_id__in=ids, compacted=False).update(compacted=True)
+        movements = []
+        shards = []
+        for product_id, target in targets.items():
+            if product_id not in current:
+                continue
+            stock_delta, _ = pending.get(product_id, (0, 0))
+            change = target - (current[product_id] + stock_delta)
+            if change:
+                movements.append(StockMovement(product_id=product_id, kind=kind, quantity=change, compacted=True))
+            free = max(target - held.get(product_id, 0), 0)
+            shards += [
+                StockShard(product_id=product_id, index=index, quantity=quantity)
+                for index, quantity in enumerate(_split(free, settings.STOCK_SHARDS))
+            ]
+        StockMovement.objects.bulk_create(movements)
+        # Upsert: crea le righe mancanti (prodotto nuovo) e riscrive le altre
+        StockShard.objects.bulk_create(
+            shards, update_conflicts=True, unique_fields=['product', 'index'], update_fields=['quantity'],
+        )
+        Product.objects.filter(id__in=ids).update(
+            stock=Case(*[When(id=product_id, then=target) for product_id, target in targets.items()],
+                       output_field=PositiveIntegerField()),
+            sold=Case(*[When(id=product_id, then=F('sold') + sold_delta)
+                        for product_id, (_, sold_delta) in pending.items()],
+                      default=F('sold'), output_field=PositiveIntegerField()),
+            reserved=Case(*[When(id=product_id, then=total) for product_id, total in held.items()],
+                          default=0, output_field=PositiveIntegerField()),
+        )
+
+
+def adjust_stock(product_id, quantity):
+    """
+    Rifornimento (quantity > 0) o pezzi tolti dal magazzino (quantity < 0: resi difettosi, danni)
+    dall'admin: un movimento nel registro e il contatore, senza scrivere la riga del prodotto.
+    Restituisce False, senza modificare nulla, se si tolgono più pezzi di quelli liberi.
+    """
+    with transaction.atomic():
+        if quantity > 0:
+            give(product_id, quantity)
+        elif not take(product_id, -quantity):
+            return False
+        StockMovement.objects.create(
+            product_id=product_id, kind=RESTOCK if quantity > 0 else ADJUSTMENT, quantity=quantity,
+        )
+        schedule_compaction()
+    return True
+
+
+def cancel_order(order):
+    """
+    Restituisce al magazzino i pezzi di un ordine annullato (movimenti 'cancellation').
+    Non fa nulla se l'ordine è già stato restituito: si può chiamare più volte.
+    """
+    with transaction.atomic():
+        # Il lock sull'ordine impedisce che due annullamenti contemporanei restituiscano due volte
+        Order.objects.select_for_update().filter(id=order.id).first()
+        if order.stock_movements.filter(kind=CANCELLATION).exists():
+            return 0
+        items = list(order.items.values_list('product_id', 'quantity'))
+        for product_id, quantity in items:
+            give(product_id, quantity)
+        StockMovement.objects.bulk_create([
+            StockMovement(product_id=product_id, kind=CANCELLATION, quantity=quantity, order=order)
+            for product_id, quantity in items
+        ])
+        schedule_compaction()
+    return len(items)
+
+
+# --- COMPATTAZIONE ---
+def _sold_delta(kind, quantity):
+    # Vendite (negative) aumentano i venduti, annullamenti (positivi) li riducono
+    return -quantity if kind in (SALE, CANCELLATION) else 0
+
+
+def _sold_out(product_ids):
+    return set(Product.objects.filter(id__in=product_ids, stock__lte=F('reserved')).values_list('id', flat=True))
+
+
+def compact(batch_size=1000):
+    """
+    Somma i movimenti non ancora compattati in Product.stock e Product.sold, a blocchi
+    (una transazione breve per blocco), poi aggiorna Product.reserved dalle prenotazioni.
+    Restituisce il numero di movimenti compattati.
+    """
+    compacted = 0
+    changed = False
+    while True:
+        with transaction.atomic():
+            rows = list(
+                StockMovement.objects.filter(compacted=False).order_by('id')
+                .select_for_update(skip_locked=True)[:batch_size]
+                .values_list('id', 'product_id', 'kind', 'quantity')
+            )
+            if not rows:
+                break
+            stock = {}
+            sold = {}
+            for _, product_id, kind, quantity in rows:
+                stock[product_id] = stock.get(product_id, 0) + quantity
+                sold[product_id] = sold.get(product_id, 0) + _sold_delta(kind, quantity)
+            before = _sold_out(stock)
+            Product.objects.filter(id__in=stock).update(
+                stock=Case(*[When(id=product_id, then=F('stock') + delta) for product_id, delta in stock.items()],
+                           output_field=PositiveIntegerField()),
+                sold=Case(*[When(id=product_id, then=F('sold') + delta) for product_id, delta in sold.items()],
+                          output_field=PositiveIntegerField()),
+            )
+            StockMovement.objects.filter(id__in=[row[0] for row in rows]).update(compacted=True)
+            changed = changed or _sold_out(stock) != before
+        compacted += len(rows)
+        if len(rows) < batch_size:
+            break
+    # Pezzi nei carrelli: solo i prodotti che ne hanno o ne avevano
+    held = StockReservation.objects.filter(product=OuterRef('pk')).values('product').annotate(
+        total=Sum('quantity'),
+    ).values('total')
+    ids = list(Product.objects.filter(
+        Q(reserved__gt=0) | Q(id__in=StockReservation.objects.values('product_id')),
+    ).values_list('id', flat=True))
+    before = _sold_out(ids)
+    Product.objects.filter(id__in=ids).update(reserved=Coalesce(Subquery(held, output_field=IntegerField()), 0))
+    if changed or _sold_out(ids) != before:
+        # Qualche prodotto è andato esaurito o è tornato disponibile: le card in cache vanno rigenerate
+        bump_catalog_version()
+    return compacted
+
+
+"""
+Perché un registro invece di UPDATE su Product.stock: durante un lancio ogni checkout
+sullo stesso vestito aggiornava la stessa riga, e il database li metteva in coda uno dopo l'altro.
+
+Ora il checkout:
+- toglie i pezzi da una delle STOCK_SHARDS righe di StockShard scelta a caso
+  (UPDATE condizionale `quantity >= q`, nessun overselling), così N worker lavorano su righe diverse;
+- scrive un StockMovement di vendita (solo INSERT).
+
+Product.stock, Product.sold e Product.reserved sono una fotografia per vetrina, filtri
+e ordinamenti, aggiornata solo da compact() (carrello e checkout non scrivono mai la riga
+del prodotto): in coda pochi secondi dopo ogni vendita, annullamento o prenotazione
+(schedule_compaction, eseguita da run_jobs) e comunque con il comando compact_stock_ledger:
+stock attuale = fotografia + movimenti non compattati (current_stock), pezzi liberi esatti =
+somma delle righe del contatore (available_to_sell). L'import è un inventario (set_stocks):
+il valore nel file diventa il nuovo stock. Nell'admin lo stock è in sola lettura e si indicano
+i pezzi arrivati o tolti (adjust_stock): un salvataggio con una fotografia vecchia (lista dei
+prodotti aperta prima di una vendita) non può più riportare in vendita pezzi già venduti.
+"""
@@ -0,0 +1,152 @@
+import logging
+import random
+import traceback
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def enqueue(task, dedupe_key=None, delay=0, max_attempts=None, **kwargs):
+    """
+    Mette in coda `task` (percorso della funzione) con gli argomenti `kwargs` (serializzabili in JSON).
+    Va chiamata dentro la transazione che produce il lavoro (es. l'ordine): se la transazione
+    viene annullata sparisce anche il lavoro, e nessun worker vede un ordine non ancora salvato.
+    Con `dedupe_key` non si inserisce nulla se c'è già un lavoro in attesa con la stessa chiave.
+    """
+    job = Job(
+        task=task, kwargs=kwargs, dedupe_key=dedupe_key,
+        run_after=timezone.now() + timedelta(seconds=delay),
+        max_attempts=max_attempts or settings.JOBS_MAX_ATTEMPTS,
+    )
+    # Un solo INSERT ... ON CONFLICT DO NOTHING: niente SELECT prima e niente savepoint
+    Job.objects.bulk_create([job], ignore_conflicts=dedupe_key is not None)
+
+
+def shared_key(name):
+    """
+    dedupe_key per un lavoro messo in coda da molte transazioni contemporanee (es. ogni checkout).
+    Due INSERT con la stessa chiave in transazioni aperte si aspettano fino al commit della prima:
+    divisa su JOBS_DEDUPE_SHARDS chiavi l'attesa è rara, e in coda restano al massimo
+    JOBS_DEDUPE_SHARDS copie dello stesso lavoro (che devono poter girare insieme).
+    """
+    return f'{name}:{random.randrange(settings.JOBS_DEDUPE_SHARDS)}'
+
+
+def _claimable(now):
+    # In attesa e pronti, oppure presi da un worker che non ha finito entro il termine (processo morto)
+    return Q(status=PENDING, run_after__lte=now) | Q(status=RUNNING, locked_until__lt=now)
+
+
+def claim(limit):
+    """
+    Prende fino a `limit` lavori pronti per questo worker e restituisce i loro id.
+    Con PostgreSQL/MySQL i worker concorrenti saltano le righe già bloccate (SKIP LOCKED);
+    l'UPDATE ripete la condizione, quindi due worker non prendono mai lo stesso lavoro.
+    """
+    now = timezone.now()
+    token = uuid.uuid4().hex
+    with transaction.atomic():
+        ids = list(
+            Job.objects.select_for_update(skip_locked=True).filter(_claimable(now))
+            .order_by('run_after', 'id').values_list('id', flat=True)[:limit]
+        )
+        if not ids:
+            return []
+        Job.objects.filter(_claimable(now), id__in=ids).update(
+            status=RUNNING, claimed_by=token, attempts=F('attempts') + 1,
+            locked_until=now + timedelta(seconds=settings.JOBS_LEASE),
+        )
+    return list(Job.objects.filter(claimed_by=token, status=RUNNING).values_list('id', flat=True))
+
+
+def _backoff(attempts):
+    """ Attesa prima del nuovo tentativo: raddoppia a ogni errore, con un po' di casualità. """
+    delay = min(settings.JOBS_RETRY_BACKOFF * 2 ** (attempts - 1), settings.JOBS_RETRY_MAX_DELAY)
+    return delay * random.uniform(1, 1.25)
+
+
+def execute(job_id):
+    """ Esegue un lavoro preso con claim(). Gira nei thread o nei processi del worker (comando run_jobs). """
+    close_old_connections()
+    try:
+        job = Job.objects.get(id=job_id)
+        try:
+            import_string(job.task)(**job.kwargs)
+        except Exception:
+            logger.exception('Lavoro %s fallito (tentativo %s di %s)', job, job.attempts, job.max_attempts)
+            _failed(job, traceback.format_exc())
+            return False
+        Job.objects.filter(id=job.id, claimed_by=job.claimed_by).update(
+            status=DONE, finished=timezone.now(), locked_until=None, last_error='',
+        )
+        return True
+    finally:
+        close_old_connections()
+
+
+def _failed(job, error):
+    mine = Job.objects.filter(id=job.id, claimed_by=job.claimed_by)
+    if job.attempts >= job.max_attempts:
+        mine.update(status=FAILED, finished=timezone.now(), locked_until=None, last_error=error)
+        return
+    try:
+        with transaction.atomic():
+            mine.update(
+                status=PENDING, locked_until=None, last_error=error,
+                run_after=timezone.now() + timedelta(seconds=_backoff(job.attempts)),
+            )
+    except IntegrityError:
+        # Nel frattempo è stato messo in coda lo stesso lavoro (stessa dedupe_key): riproverà quello
+        mine.update(status=FAILED, finished=timezone.now(), locked_until=None,
+                    last_error=error + '\nSostituito da un lavoro in attesa con la stessa chiave.')
+
+
+def retry(queryset):
+    """ Rimette in coda subito i lavori falliti del queryset (azione dell'admin). Restituisce quanti. """
+    retried = 0
+    for job in queryset.filter(status=FAILED):
+        try:
+            with transaction.atomic():
+                Job.objects.filter(id=job.id, status=FAILED).update(
+                    status=PENDING, attempts=0, run_after=timezone.now(), finished=None,
+                )
+            retried += 1
+        except IntegrityError:
+            # C'è già un lavoro identico in attesa
+            pass
+    return retried
+
+
+def purge(days):
+    """ Elimina i lavori completati da più di `days` giorni (quelli falliti restano per l'analisi). """
+    deleted, _ = Job.objects.filter(status=DONE, finished__lt=timezone.now() - timedelta(days=days)).delete()
+    return deleted
+
+
+"""
+Coda di lavori nel database (outbox): quello che segue un checkout e non serve per
+rispondere al cliente (compattazione del magazzino, email, fatture, statistiche, avvisi)
+si scrive come riga Job nella stessa transazione dell'ordine. Il checkout paga un INSERT
+qualunque sia il numero di effetti collaterali; li esegue il comando run_jobs, con un pool
+di thread o di processi.
+
+Un lavoro fallito torna in attesa con un ritardo che raddoppia (JOBS_RETRY_BACKOFF,
+fino a JOBS_RETRY_MAX_DELAY) e dopo max_attempts tentativi resta 'failed' (si può
+rimettere in coda dall'admin). Un lavoro può quindi essere eseguito più di una volta
+(errore dopo aver fatto metà del lavoro, worker morto oltre JOBS_LEASE secondi):
+le funzioni in coda devono poter essere ripetute senza danni.
+"""
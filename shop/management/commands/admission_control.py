@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from shop import admission
+
+
+class Command(BaseCommand):
+    help = "Mostra o modifica a runtime i limiti del controllo degli ingressi (valgono per tutti i processi, senza riavvio)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rate', type=float, help='Ingressi al secondo.')
+        parser.add_argument('--burst', type=int, help='Picco massimo di ingressi.')
+        parser.add_argument('--max-concurrent', type=int, help='Richieste di carrello/checkout contemporanee.')
+        parser.add_argument('--queue-limit', type=int, help='Persone in coda oltre le quali si risponde 503.')
+        parser.add_argument('--pass-ttl', type=int, help='Secondi di validità del pass di un acquirente ammesso.')
+        switch = parser.add_mutually_exclusive_group()
+        switch.add_argument('--enable', action='store_true', help='Attiva il controllo.')
+        switch.add_argument('--disable', action='store_true', help='Disattiva il controllo.')
+        parser.add_argument('--reset', action='store_true', help='Torna ai valori dei settings.')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            admission.reset_overrides()
+        values = {name: options[name] for name in admission.SETTINGS if options.get(name) is not None}
+        if options['enable'] or options['disable']:
+            values['enabled'] = options['enable']
+        invalid = [name for name, value in values.items() if name != 'enabled' and value <= 0]
+        if invalid:
+            raise CommandError(f'Valori non validi (devono essere positivi): {", ".join(invalid)}.')
+        config = admission.set_overrides(**values) if values else admission.get_config()
+        for name, value in config.items():
+            self.stdout.write(f'{name}: {value}')
+        self.stdout.write(self.style.SUCCESS(f'Persone in coda: {admission.queue_length()}.'))
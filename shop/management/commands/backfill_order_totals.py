@@ -0,0 +1,45 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F, Sum
+
+from shop.models import Order
+
+
+class Command(BaseCommand):
+    help = "Calcola total_cost e item_count per gli ordini esistenti, a blocchi."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help="Ordini elaborati per blocco (default 500).")
+        parser.add_argument('--all', action='store_true', help="Ricalcola anche gli ordini che hanno già i totali.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        orders = Order.objects.order_by('id')
+        if not options['all']:
+            # Di default solo gli ordini mai calcolati (creati prima dei campi denormalizzati)
+            orders = orders.filter(item_count=0)
+        last_id = 0
+        processed = 0
+        while True:
+            # Paginazione per ID: ogni blocco parte dall'ultimo ID elaborato, senza OFFSET
+            batch = list(
+                orders.filter(id__gt=last_id)
+                .annotate(
+                    computed_cost=Sum(F('items__price') * F('items__quantity')),
+                    computed_count=Sum('items__quantity'),
+                )
+                .only('id')[:batch_size]
+            )
+            if not batch:
+                break
+            for order in batch:
+                order.total_cost = order.computed_cost or Decimal('0')
+                order.item_count = order.computed_count or 0
+            with transaction.atomic():
+                Order.objects.bulk_update(batch, ['total_cost', 'item_count'])
+            last_id = batch[-1].id
+            processed += len(batch)
+            self.stdout.write(f'{processed} ordini aggiornati (ultimo ID {last_id})')
+        self.stdout.write(self.style.SUCCESS(f'Completato: {processed} ordini aggiornati.'))
@@ -0,0 +1,82 @@
+import re
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from shop.facets import SORT_ORDERS, FacetSelection, counts_queryset, newest_cutoff, price_bands
+from shop.models import Category, Product
+from shop.pagination import KeysetPaginator
+
+# Righe di EXPLAIN QUERY PLAN (SQLite) che indicano lavoro proporzionale a tutta la tabella
+FULL_SCAN = re.compile(r'\bSCAN (TABLE )?shop_product\b(?! USING (COVERING )?INDEX)')
+TEMP_SORT = re.compile(r'USE TEMP B-TREE FOR ORDER BY')
+
+
+class Command(BaseCommand):
+    help = (
+        "Esegue EXPLAIN su tutte le query della vetrina (ogni ordinamento, con e senza categoria, "
+        "prima pagina e pagine successive, filtri) e fallisce se una legge tutta la tabella prodotti."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--verbose-plans', action='store_true', help="Stampa il piano completo di ogni query.")
+
+    def handle(self, *args, **options):
+        checked = connection.vendor == 'sqlite'
+        if not checked:
+            self.stdout.write(self.style.WARNING(
+                f'Controllo automatico disponibile solo su SQLite (database attuale: {connection.vendor}): '
+                'stampo i piani senza verificarli.'
+            ))
+        failures = []
+        for label, queryset, strict in self._shapes():
+            plan = queryset.explain()
+            problems = []
+            if checked:
+                if FULL_SCAN.search(plan):
+                    problems.append('scansione completa della tabella')
+                # Le pagine senza filtri extra devono leggere le righe già ordinate dall'indice
+                if strict and TEMP_SORT.search(plan):
+                    problems.append("ordinamento in memoria (l'indice non copre l'ORDER BY)")
+            if problems:
+                failures.append(label)
+                self.stdout.write(self.style.ERROR(f'KO  {label}: {", ".join(problems)}'))
+            else:
+                self.stdout.write(f'ok  {label}')
+            if problems or options['verbose_plans'] or not checked:
+                self.stdout.write('    ' + plan.replace('\n', '\n    '))
+        if failures:
+            raise CommandError(f'{len(failures)} query della vetrina senza un indice adeguato.')
+        self.stdout.write(self.style.SUCCESS('Tutte le query della vetrina usano un indice.'))
+
+    def _shapes(self):
+        """ (descrizione, queryset, deve usare l'indice anche per l'ordinamento?) per ogni forma di query. """
+        # Valori di esempio per il cursore e la categoria: servono solo a costruire la query
+        sample = Product(id=1, created=timezone.now(), price=Decimal('50'), sold=0)
+        category = Category(id=1, slug='categoria')
+        cutoff = newest_cutoff()
+        base = Product.objects.filter(available=True)
+        for sort, (_, keys) in SORT_ORDERS.items():
+            for selected in (None, category):
+                scope = 'categoria' if selected else 'tutte'
+                queryset = FacetSelection(category=selected, sort=sort).filter(base)
+                paginator = KeysetPaginator(queryset, per_page=settings.CATALOG_PAGE_SIZE, keys=keys)
+                values = [getattr(sample, name.lstrip('-')) for name in keys]
+                yield f'{sort} / {scope} / prima pagina', paginator.page_queryset('next', None), True
+                yield f'{sort} / {scope} / pagina successiva', paginator.page_queryset('next', values), True
+                yield f'{sort} / {scope} / pagina precedente', paginator.page_queryset('prev', values), True
+            # Con i filtri della sidebar basta che la lettura parta da un indice
+            filters = {
+                'fascia di prezzo': FacetSelection(price=next(iter(price_bands())), sort=sort),
+                'solo disponibili': FacetSelection(in_stock=True, sort=sort),
+                'novità': FacetSelection(new=True, sort=sort),
+            }
+            for name, selection in filters.items():
+                paginator = KeysetPaginator(selection.filter(base), per_page=settings.CATALOG_PAGE_SIZE, keys=keys)
+                yield f'{sort} / filtro {name}', paginator.page_queryset('next', None), False
+        yield 'conteggi dei filtri', counts_queryset(FacetSelection(), cutoff), False
+        yield 'scheda prodotto', Product.objects.filter(id=1, slug='prodotto', available=True), False
+
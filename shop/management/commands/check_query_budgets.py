@@ -0,0 +1,139 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test import Client, RequestFactory
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.urls import reverse
+
+# Ricevitori di setting_changed: ricreano le cache quando override_settings cambia CACHES
+import django.test.signals  # noqa: F401
+
+from shop import reservations
+from shop.cart import Cart
+from shop.models import Category, Order, OrderItem, Product
+from shop.testing import QueryBudgetExceeded, assert_constant_queries
+
+# Query massime per vista, a cache vuota, qualunque sia il numero di prodotti o righe
+# (sessione e utente compresi): si alzano solo per una query nuova voluta, non per un N+1
+QUERY_BUDGETS = {
+    'product_list': 3,
+    'product_list_by_category': 4,
+    'product_detail': 3,
+    'cart_detail': 3,
+    'order_list': 3,
+    'order_detail': 4,
+    # Invio del modulo di checkout (ordine, righe, magazzino, prenotazioni, notifica, lavori in coda, sessione), savepoint compresi:
+    # misurato dai test (shop/tests.py), il comando controlla solo pagine in GET
+    'order_create': 16,
+}
+
+# Quantità di righe con cui si misura ogni vista: se le query cambiano tra una e l'altra c'è un N+1
+SIZES = (1, 20)
+
+
+class Command(BaseCommand):
+    help = (
+        "Misura le query delle viste principali con pochi e molti dati di prova (creati e poi annullati) "
+        "e fallisce se una vista supera il suo budget di QUERY_BUDGETS o fa query proporzionali ai dati."
+    )
+
+    def handle(self, *args, **options):
+        try:
+            setup_test_environment()
+            started = True
+        except RuntimeError:
+            # Già attivo: comando lanciato da un test (call_command)
+            started = False
+        try:
+            # Cache separata e vuota: si misura il caso peggiore senza toccare quella del sito
+            with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'check-query-budgets',
+            }}):
+                with transaction.atomic():
+                    failures = self._check()
+                    # I dati di prova non restano nel database
+                    transaction.set_rollback(True)
+        finally:
+            if started:
+                teardown_test_environment()
+        if failures:
+            raise CommandError(f'{failures} viste oltre il budget di query.')
+        self.stdout.write(self.style.SUCCESS('Tutte le viste rispettano il budget di query.'))
+
+    def _check(self):
+        failures = 0
+        for name, url, client, populate in self._scenarios():
+            try:
+                counts = assert_constant_queries(
+                    client, url, QUERY_BUDGETS[name], populate, sizes=SIZES, before_request=cache.clear,
+                )
+            except QueryBudgetExceeded as e:
+                failures += 1
+                self.stdout.write(self.style.ERROR(f'KO  {name}: {e}'))
+            else:
+                counts = ', '.join(f'{size} righe: {queries}' for size, queries in counts.items())
+                self.stdout.write(f'ok  {name} ({counts}; budget {QUERY_BUDGETS[name]})')
+        return failures
+
+    def _scenarios(self):
+        """ (vista, URL, client, populate(n)) per ogni vista controllata. """
+        category = Category.objects.create(name='Budget query', slug='check-query-budgets')
+        products = []
+
+        def add_products(n):
+            # Prodotti aggiunti fino ad averne n (bulk_create: nessun segnale, l'indice di ricerca non cambia)
+            Product.objects.bulk_create([
+                Product(category=category, name=f'Prodotto {i}', slug=f'prodotto-{i}', price=Decimal('10.00'), stock=5)
+                for i in range(len(products), n)
+            ])
+            products[:] = Product.objects.filter(category=category).order_by('id')
+
+        add_products(1)
+        anonymous = Client()
+        yield 'product_list', reverse('shop:product_list'), anonymous, add_products
+        yield 'product_list_by_category', category.get_absolute_url(), anonymous, add_products
+        yield 'product_detail', products[0].get_absolute_url(), anonymous, add_products
+
+        def fill_cart(n):
+            add_products(n)
+            request = RequestFactory().get('/')
+            request.session = anonymous.session
+            request.user = AnonymousUser()
+            cart = Cart(request)
+            for product in products[:n]:
+                # Come cart_add: con la prenotazione, che la pagina del carrello prolunga
+                reservations.reserve(reservations.get_hold_token(request), product, 1)
+                cart.add(product, quantity=1, override_quantity=True)
+            request.session.save()
+
+        yield 'cart_detail', reverse('shop:cart_detail'), anonymous, fill_cart
+
+        user = User.objects.create_user('check-query-budgets')
+        customer = Client()
+        customer.force_login(user)
+        order = Order.objects.create(
+            user=user, first_name='Budget', last_name='Query', email='budget@example.com',
+            address='Via Roma 1', postal_code='00100', city='Roma',
+        )
+
+        def add_orders(n):
+            add_products(n)
+            count = Order.objects.filter(user=user).count()
+            Order.objects.bulk_create([
+                Order(user=user, first_name='Budget', last_name='Query', email='budget@example.com',
+                      address='Via Roma 1', postal_code='00100', city='Roma')
+                for _ in range(count, n)
+            ])
+
+        def add_items(n):
+            add_products(n)
+            OrderItem.objects.filter(order=order).delete()
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=product, price=product.price, quantity=1) for product in products[:n]
+            ])
+
+        yield 'order_list', reverse('shop:order_list'), customer, add_orders
+        yield 'order_detail', reverse('shop:order_detail', args=[order.id]), customer, add_items
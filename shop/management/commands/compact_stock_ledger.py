@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.inventory import compact
+
+
+class Command(BaseCommand):
+    help = (
+        "Somma i movimenti di magazzino non ancora compattati in Product.stock e Product.sold "
+        "e aggiorna i pezzi nei carrelli (da lanciare ogni minuto, es. con cron)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help='Movimenti per transazione (default 1000).')
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        count = compact(batch_size=options['batch_size'])
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f'Movimenti compattati: {count} in {elapsed:.1f}s.'))
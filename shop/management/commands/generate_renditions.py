@@ -0,0 +1,57 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+
+from shop.models import Product
+
+
+def _setup_worker():
+    # Con il metodo "spawn" (Windows/macOS) ogni processo figlio deve inizializzare Django
+    django.setup()
+
+
+def _render(name, force):
+    from shop.renditions import generate_renditions
+    try:
+        return name, generate_renditions(name, force=force), None
+    except OSError as e:
+        return name, 0, str(e)
+
+
+class Command(BaseCommand):
+    help = "Genera (o rigenera) le versioni ridotte JPEG/WebP delle immagini di tutti i prodotti."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                            help="Processi in parallelo (default: numero di CPU).")
+        parser.add_argument('--force', action='store_true',
+                            help="Rigenera anche le versioni già esistenti.")
+
+    def handle(self, *args, **options):
+        # Nomi distinti: più prodotti possono condividere la stessa immagine
+        names = sorted(set(
+            Product.objects.exclude(image='').values_list('image', flat=True)
+        ))
+        if not names:
+            self.stdout.write('Nessuna immagine da elaborare.')
+            return
+        started = time.monotonic()
+        written = 0
+        errors = 0
+        # Ridimensionare immagini è lavoro di CPU: i processi aggirano il GIL
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=_setup_worker) as pool:
+            futures = [pool.submit(_render, name, options['force']) for name in names]
+            for done, future in enumerate(as_completed(futures), start=1):
+                name, count, error = future.result()
+                if error:
+                    errors += 1
+                    self.stderr.write(f'{name}: {error}')
+                written += count
+                self.stdout.write(f'[{done}/{len(names)}] {name}: {count} file')
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            f'Completato in {elapsed:.1f}s: {len(names)} immagini, {written} file scritti, {errors} errori.'
+        ))
@@ -0,0 +1,239 @@
+import csv
+import json
+import os
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from shop import inventory
+from shop.catalog_cache import bump_catalog_version
+from shop.models import Category, Product
+from shop.search import rebuild_index
+
+# Colonne accettate nel file (oltre a 'slug', obbligatoria e usata come chiave)
+IMPORT_FIELDS = ['name', 'category', 'price', 'description', 'stock', 'available']
+# Testi che una cella vuota non cancella nei prodotti esistenti (si tiene il valore nel DB)
+TEXT_FIELDS = ['name', 'description']
+TRUE_VALUES = {'1', 'true', 'yes', 'si', 'sì', 'y', 's'}
+
+
+class RowError(ValueError):
+    """ Riga del file non valida: viene saltata e conteggiata, l'import continua. """
+
+
+class Command(BaseCommand):
+    help = (
+        "Importa (o aggiorna) prodotti da un file CSV o JSONL, in streaming e a blocchi. "
+        "I prodotti sono identificati dallo slug; le categorie dallo slug della categoria."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File CSV (con intestazione) o JSONL (un oggetto JSON per riga).")
+        parser.add_argument('--format', choices=['csv', 'jsonl'], help="Formato del file (default: dall'estensione).")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Righe per transazione (default 1000).")
+        parser.add_argument('--create-categories', action='store_true',
+                            help="Crea le categorie mancanti invece di scartare le righe.")
+        parser.add_argument('--checkpoint', help="File di avanzamento (default: <path>.checkpoint).")
+        parser.add_argument('--resume', action='store_true',
+                            help="Riprende dall'ultimo blocco completato indicato nel checkpoint.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'File non trovato: {path}')
+        fmt = options['format'] or ('jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        self.batch_size = options['batch_size']
+        self.create_categories = options['create_categories']
+        self.checkpoint = options['checkpoint'] or f'{path}.checkpoint'
+        self.columns = None
+        # La ripresa ripristina anche le colonne lette dalla prima riga del file
+        skip = self._read_checkpoint() if options['resume'] else 0
+        # Mappa slug -> id di tutte le categorie: nessuna query per riga
+        self.categories = dict(Category.objects.values_list('slug', 'id'))
+        self.created = self.updated = self.errors = 0
+
+        started = time.monotonic()
+        done = skip
+        with open(path, newline='', encoding='utf-8') as handle:
+            records = self._read_csv(handle) if fmt == 'csv' else self._read_jsonl(handle)
+            batch = []
+            for number, record in enumerate(records, start=1):
+                if number <= skip:
+                    continue
+                batch.append((number, record))
+                if len(batch) >= self.batch_size:
+                    done = self._flush(batch, started, skip)
+                    batch = []
+            if batch:
+                done = self._flush(batch, started, skip)
+
+        # bulk_create/bulk_update non inviano i segnali post_save: invalidiamo la cache a mano
+        bump_catalog_version()
+        # e ricostruiamo l'indice di ricerca se è cambiato del testo indicizzato (non per soli prezzi/stock)
+        if self.created or (self.updated and set(self.columns or ()) & {'name', 'description', 'category'}):
+            self.stdout.write('Ricostruzione indice di ricerca...')
+            rebuild_index()
+        elapsed = time.monotonic() - started
+        rate = (done - skip) / elapsed if elapsed else 0
+        self.stdout.write(self.style.SUCCESS(
+            f'Completato: {done - skip} righe in {elapsed:.1f}s ({rate:.0f} righe/s) - '
+            f'{self.created} creati, {self.updated} aggiornati, {self.errors} scartati.'
+        ))
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+
+    # --- LETTURA IN STREAMING ---
+    def _read_csv(self, handle):
+        # DictReader legge una riga alla volta: la memoria non dipende dalla dimensione del file
+        yield from csv.DictReader(handle)
+
+    def _read_jsonl(self, handle):
+        for line in handle:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+    # --- SCRITTURA A BLOCCHI ---
+    def _flush(self, batch, started, skip):
+        products = {}
+        for number, record in batch:
+            try:
+                product = self._build(record)
+            except RowError as e:
+                self.errors += 1
+                self.stderr.write(f'Riga {number}: {e}')
+                continue
+            # Slug ripetuto nello stesso blocco: vale l'ultima riga
+            products[product.slug] = product
+
+        with transaction.atomic():
+            existing = {}
+            previous_stock = {}
+            texts = {}
+            # In caso di slug duplicati nel DB aggiorniamo il prodotto più vecchio
+            rows = Product.objects.filter(slug__in=list(products)).order_by('-id').values_list(
+                'slug', 'id', 'stock', *TEXT_FIELDS,
+            )
+            for slug, pk, stock, *values in rows:
+                existing[slug] = pk
+                previous_stock[pk] = stock
+                texts[pk] = dict(zip(TEXT_FIELDS, values))
+            to_update = []
+            to_create = []
+            for slug, product in products.items():
+                if slug in existing:
+                    product.pk = existing[slug]
+                    # bulk_update scrive tutte le colonne: una cella vuota riscrive il testo già salvato
+                    for field, value in texts[product.pk].items():
+                        if field in self.columns and not getattr(product, field):
+                            setattr(product, field, value)
+                    to_update.append(product)
+                elif product.category_id is None or product.price is None:
+                    # Un prodotto nuovo ha bisogno almeno di categoria e prezzo
+                    self.errors += 1
+                    self.stderr.write(f'{slug}: categoria o prezzo mancanti per un nuovo prodotto')
+                else:
+                    if not product.name:
+                        product.name = slug.replace('-', ' ').capitalize()
+                    to_create.append(product)
+            if to_create:
+                Product.objects.bulk_create(to_create)
+            if to_update:
+                Product.objects.bulk_update(to_update, self.update_fields)
+            # Lo stock importato è un inventario: movimenti e contatore dei pezzi liberi (niente segnali con bulk_*)
+            if to_create:
+                created_ids = Product.objects.filter(slug__in=[product.slug for product in to_create])
+                targets = dict(created_ids.values_list('id', 'stock'))
+                inventory.set_stocks(targets, kind=inventory.RESTOCK, previous=dict.fromkeys(targets, 0))
+            if to_update and 'stock' in self.columns:
+                inventory.set_stocks({product.pk: product.stock for product in to_update}, previous=previous_stock)
+        self.created += len(to_create)
+        self.updated += len(to_update)
+
+        last = batch[-1][0]
+        # Il checkpoint si scrive solo dopo il commit: in caso di errore si riparte da questo blocco
+        self._write_checkpoint(last)
+        elapsed = time.monotonic() - started
+        rate = (last - skip) / elapsed if elapsed else 0
+        self.stdout.write(f'{last} righe elaborate ({rate:.0f} righe/s)')
+        return last
+
+    def _build(self, record):
+        if not isinstance(record, dict):
+            raise RowError('JSON non valido')
+        slug = (record.get('slug') or '').strip() or slugify(record.get('name') or '')
+        if not slug:
+            raise RowError('slug mancante')
+        if self.columns is None:
+            # Le colonne importate sono quelle della prima riga (l'intestazione, per il CSV)
+            self._set_columns([field for field in IMPORT_FIELDS if field in record])
+        missing = [field for field in self.columns if field not in record]
+        if missing:
+            # Senza questo controllo un campo assente sovrascriverebbe il valore nel DB con il default
+            raise RowError(f'campi mancanti: {", ".join(missing)}')
+        product = Product(slug=slug, updated=timezone.now())
+        for field in self.columns:
+            value = record[field]
+            if field == 'category':
+                product.category_id = self._category_id(str(value).strip())
+            elif field == 'price':
+                try:
+                    product.price = Decimal(str(value).replace(',', '.'))
+                except InvalidOperation:
+                    raise RowError(f'prezzo non valido: {value!r}')
+                if product.price <= 0:
+                    raise RowError(f'prezzo non valido: {value!r}')
+            elif field == 'stock':
+                try:
+                    product.stock = int(value)
+                except (TypeError, ValueError):
+                    raise RowError(f'stock non valido: {value!r}')
+                if product.stock < 0:
+                    raise RowError(f'stock negativo: {value!r}')
+            elif field == 'available':
+                product.available = value if isinstance(value, bool) else str(value).strip().lower() in TRUE_VALUES
+            else:
+                setattr(product, field, value or '')
+        return product
+
+    def _set_columns(self, columns):
+        self.columns = columns
+        self.update_fields = ['category_id' if field == 'category' else field for field in columns] + ['updated']
+
+    def _category_id(self, slug):
+        if slug in self.categories:
+            return self.categories[slug]
+        if not self.create_categories:
+            raise RowError(f'categoria sconosciuta: {slug!r} (usa --create-categories)')
+        category = Category.objects.create(slug=slug, name=slug.replace('-', ' ').capitalize())
+        self.categories[slug] = category.id
+        return category.id
+
+    # --- CHECKPOINT ---
+    def _read_checkpoint(self):
+        try:
+            with open(self.checkpoint, encoding='utf-8') as handle:
+                state = json.load(handle)
+            records = state['records']
+        except (OSError, ValueError, KeyError):
+            return 0
+        # Le righe saltate non passano da _build: senza queste colonne varrebbero quelle della prima riga letta
+        if state.get('columns') is not None:
+            self._set_columns(state['columns'])
+        self.stdout.write(f'Ripresa dalla riga {records + 1}')
+        return records
+
+    def _write_checkpoint(self, records):
+        # Scrittura atomica: un crash durante la scrittura non lascia un checkpoint corrotto
+        tmp = f'{self.checkpoint}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as handle:
+            json.dump({'records': records, 'columns': self.columns}, handle)
+        os.replace(tmp, self.checkpoint)
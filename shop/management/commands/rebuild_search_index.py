@@ -0,0 +1,15 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from shop.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Ricostruisce da zero l'indice di ricerca dei prodotti (dopo import massivi o modifiche con update())."
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        count = rebuild_index()
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(f'Indice di ricerca ricostruito: {count} prodotti in {elapsed:.1f}s.'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from shop.reservations import release_expired
+
+
+class Command(BaseCommand):
+    help = "Libera le prenotazioni di stock scadute e restituisce i pezzi ai prodotti (da lanciare ogni minuto, es. con cron)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500, help='Prenotazioni liberate per transazione (default 500).')
+
+    def handle(self, *args, **options):
+        released = release_expired(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Prenotazioni scadute liberate: {released}.'))
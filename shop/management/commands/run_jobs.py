@@ -0,0 +1,68 @@
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from shop import jobs
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Esegue i lavori in coda (tabella Job) con un pool di thread o di processi; resta in ascolto finché non viene fermato."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int,
+                            help='Lavori eseguiti in parallelo (default 4; 1 con SQLite, che ha un solo scrittore alla volta).')
+        parser.add_argument('--processes', action='store_true',
+                            help='Usa processi invece di thread (per lavori che usano molta CPU).')
+        parser.add_argument('--once', action='store_true', help='Esegue i lavori pronti e termina.')
+        parser.add_argument('--sleep', type=float, default=1.0,
+                            help='Secondi di attesa quando la coda è vuota (default 1).')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        if workers is None:
+            # Con SQLite più lavori in parallelo si bloccano a vicenda ("database is locked")
+            workers = 1 if connections['default'].vendor == 'sqlite' else 4
+        if options['processes']:
+            # I processi figli nascono con fork: non devono ereditare la connessione al database del padre
+            connections.close_all()
+            pool = ProcessPoolExecutor(max_workers=workers)
+        else:
+            pool = ThreadPoolExecutor(max_workers=workers)
+        done = failed = 0
+        last_purge = 0
+        running = set()
+        with pool:
+            while True:
+                # Un lavoro per ogni posto libero, preso appena si libera: un lavoro lento non ferma gli altri
+                # e nessun lavoro preso resta in attesa (con il lease che scade) dietro a quelli in corso
+                ids = jobs.claim(workers - len(running)) if len(running) < workers else []
+                running.update(pool.submit(jobs.execute, job_id) for job_id in ids)
+                if running:
+                    # Pool pieno: si aspetta il primo che finisce; altrimenti si riguarda la coda dopo --sleep
+                    timeout = None if len(running) >= workers else options['sleep']
+                    finished, running = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        try:
+                            ok = future.result()
+                        except Exception:
+                            # Errore fuori dal lavoro (database non raggiungibile, processo figlio morto):
+                            # il lavoro resta preso e torna disponibile alla scadenza del lease (JOBS_LEASE)
+                            logger.exception('Errore del worker durante un lavoro')
+                            ok = False
+                        done += ok
+                        failed += not ok
+                    continue
+                if options['once']:
+                    break
+                # Coda vuota: una volta all'ora si eliminano i lavori completati vecchi
+                if time.monotonic() - last_purge > 3600:
+                    jobs.purge(settings.JOBS_KEEP_DONE_DAYS)
+                    last_purge = time.monotonic()
+                time.sleep(options['sleep'])
+        self.stdout.write(self.style.SUCCESS(f'Lavori completati: {done}, falliti: {failed}.'))
@@ -0,0 +1,221 @@
+import atexit
+import json
+import math
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from . import instrumentation
+
+# Limiti superiori dei bucket degli istogrammi (+Inf è sempre aggiunto)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+CART_BUCKETS = (1, 2, 3, 5, 10, 20, 50)
+
+# Nome -> (tipo, descrizione, bucket). Solo i nomi elencati qui possono essere registrati
+METRICS = {
+    'shop_request_duration_seconds': ('histogram', 'Durata delle richieste per vista di shop.urls', LATENCY_BUCKETS),
+    'shop_session_writes_total': ('counter', 'Salvataggi della sessione per vista', None),
+    'shop_cache_gets_total': ('counter', 'Letture dalla cache per esito (hit/miss)', None),
+    'shop_checkouts_total': ('counter', 'Checkout riusciti', None),
+    'shop_checkout_failures_total': ('counter', 'Checkout falliti per motivo (OutOfStock.reason)', None),
+    'shop_checkout_cart_items': ('histogram', 'Pezzi nel carrello a ogni tentativo di checkout', CART_BUCKETS),
+}
+
+# Valori di questo processo: (nome, etichette ordinate) -> numero, o [conteggi per bucket, somma] per gli istogrammi
+_values = {}
+_lock = threading.Lock()
+_flush_lock = threading.Lock()
+_pid = None
+_file = None
+_flushed = 0.0
+
+
+def _reset_after_fork():
+    """ Un processo figlio (worker di gunicorn) riparte da zero, con un suo file. """
+    global _pid, _file, _flushed
+    if _pid == os.getpid():
+        return
+    _values.clear()
+    _pid = os.getpid()
+    # PID riutilizzati dopo un riavvio non sovrascrivono i totali dei processi terminati
+    _file = f'{_pid}-{uuid.uuid4().hex[:8]}.json'
+    _flushed = time.monotonic()
+
+
+def inc(name, amount=1, **labels):
+    """ Incrementa il contatore `name` (uno di METRICS) con le etichette indicate. """
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _reset_after_fork()
+        _values[key] = _values.get(key, 0) + amount
+
+
+def observe(name, value, **labels):
+    """ Registra `value` nell'istogramma `name`. """
+    buckets = METRICS[name][2]
+    key = (name, tuple(sorted(labels.items())))
+    index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+    with _lock:
+        _reset_after_fork()
+        histogram = _values.setdefault(key, [[0] * (len(buckets) + 1), 0])
+        histogram[0][index] += 1
+        histogram[1] += value
+
+
+def _snapshot():
+    with _lock:
+        _reset_after_fork()
+        return [[name, list(labels), value] for (name, labels), value in _values.items()]
+
+
+def flush(force=False):
+    """
+    Scrive i valori del processo nel suo file di METRICS_DIR (al più ogni METRICS_FLUSH_INTERVAL
+    secondi, sempre con force=True). Scrittura atomica: chi legge non trova mai un file a metà.
+    """
+    global _flushed
+    if not settings.METRICS_DIR:
+        return
+    if not force and time.monotonic() - _flushed < settings.METRICS_FLUSH_INTERVAL:
+        return
+    # Un thread alla volta scrive il file; gli altri (senza force) non aspettano
+    if not _flush_lock.acquire(blocking=force):
+        return
+    try:
+        directory = Path(settings.METRICS_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        snapshot = _snapshot()
+        if not snapshot:
+            # Processo senza valori (es. un comando di gestione): nessun file
+            return
+        temporary = directory / f'.{_file}.tmp'
+        temporary.write_text(json.dumps(snapshot))
+        os.replace(temporary, directory / _file)
+        _flushed = time.monotonic()
+    finally:
+        _flush_lock.release()
+
+
+def collect():
+    """ Valori sommati di tutti i processi (file di METRICS_DIR), o di questo se non è configurata. """
+    if not settings.METRICS_DIR:
+        snapshots = [_snapshot()]
+    else:
+        flush(force=True)
+        snapshots = []
+        for path in Path(settings.METRICS_DIR).glob('*.json'):
+            try:
+                snapshots.append(json.loads(path.read_text()))
+            except (OSError, ValueError):
+                # File eliminato o illeggibile tra glob e lettura: lo si salta in questa lettura
+                continue
+    merged = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot:
+            if name not in METRICS:
+                continue
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if METRICS[name][0] == 'counter':
+                merged[key] = merged.get(key, 0) + value
+            else:
+                counts, total = merged.setdefault(key, [[0] * len(value[0]), 0])
+                merged[key] = [[a + b for a, b in zip(counts, value[0])], total + value[1]]
+    return merged
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _number(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render():
+    """ Testo nel formato di esposizione di Prometheus (version 0.0.4). """
+    merged = collect()
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for (metric, labels), value in sorted(merged.items()):
+            if metric != name:
+                continue
+            if kind == 'counter':
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+                continue
+            counts, total = value
+            cumulative = 0
+            for bound, count in zip(buckets + (math.inf,), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels + (("le", _number(bound)),))} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {_number(total)}')
+            lines.append(f'{name}_count{_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+# Alla chiusura ordinata del processo si salvano anche gli ultimi secondi
+atexit.register(flush, force=True)
+
+
+class MetricsMiddleware:
+    """
+    Durata di ogni richiesta per vista (nome della URL di shop.urls, 'other' per admin, account,
+    file statici e 404), salvataggi della sessione e letture dalla cache (con il backend di cache
+    di shop/instrumentation.py). Va messo prima di SessionMiddleware per vedere la sessione
+    come la trova SessionMiddleware a fine richiesta. Attivo solo con METRICS_ENABLED = True.
+    """
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        with instrumentation.collecting() as stats:
+            # Contatori già accumulati da InstrumentationMiddleware, se attivo, prima di questo middleware
+            hits, misses = stats.cache_hits, stats.cache_misses
+            response = self.get_response(request)
+            hits, misses = stats.cache_hits - hits, stats.cache_misses - misses
+        writes = instrumentation.session_writes(request, response)
+        match = request.resolver_match
+        # Solo le viste dello shop: una serie per URL, senza percorsi arbitrari (etichette limitate)
+        view = match.view_name if match and match.namespace == 'shop' else 'other'
+        observe('shop_request_duration_seconds', time.perf_counter() - started, view=view)
+        if writes:
+            inc('shop_session_writes_total', writes, view=view)
+        if hits:
+            inc('shop_cache_gets_total', hits, result='hit')
+        if misses:
+            inc('shop_cache_gets_total', misses, result='miss')
+        flush()
+        return response
+
+
+"""
+Metriche per Prometheus su /metrics. Ogni processo tiene i suoi valori in memoria;
+con più processi (worker di gunicorn) ognuno li scrive ogni pochi secondi in un suo file
+di METRICS_DIR e /metrics somma tutti i file, così qualunque worker risponda la lettura
+è la stessa. I file dei worker terminati restano (i contatori non devono tornare indietro):
+la cartella va svuotata a ogni avvio di gunicorn, come PROMETHEUS_MULTIPROC_DIR di
+prometheus_client.
+
+Rapporti utili (PromQL):
+    hit ratio della cache     sum(rate(shop_cache_gets_total{result="hit"}[5m])) / sum(rate(shop_cache_gets_total[5m]))
+    sessioni salvate/richiesta  rate(shop_session_writes_total[5m]) / rate(shop_request_duration_seconds_count[5m])
+    p95 di una vista          histogram_quantile(0.95, rate(shop_request_duration_seconds_bucket{view="shop:product_list"}[5m]))
+"""
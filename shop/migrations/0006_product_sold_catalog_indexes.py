@@ -0,0 +1,58 @@
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def backfill_sold(apps, schema_editor):
+    # Pezzi venduti dagli ordini già esistenti, con un solo UPDATE
+    Product = apps.get_model('shop', 'Product')
+    OrderItem = apps.get_model('shop', 'OrderItem')
+    totals = (
+        OrderItem.objects.filter(product=OuterRef('pk'))
+        .values('product').annotate(total=Sum('quantity')).values('total')
+    )
+    Product.objects.update(sold=Coalesce(Subquery(totals), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0005_order_total_cost_item_count'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='product',
+            name='shop_produc_id_f21274_idx',
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='sold',
+            field=models.PositiveIntegerField(default=0, verbose_name='Sold'),
+        ),
+        migrations.RunPython(backfill_sold, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'created', 'id'], name='product_category_created'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['created', 'id'], name='product_created'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'price', 'id'], name='product_category_price'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['price', 'id'], name='product_price'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['category', 'sold', 'id'], name='product_category_sold'),
+        ),
+        migrations.AddIndex(
+            model_name='product',
+            index=models.Index(fields=['sold', 'id'], name='product_sold'),
+        ),
+    ]
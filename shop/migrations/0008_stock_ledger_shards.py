@@ -0,0 +1,74 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_shards(apps, schema_editor):
+    # Pezzi liberi dei prodotti esistenti (stock meno quelli nei carrelli) divisi su STOCK_SHARDS righe
+    Product = apps.get_model('shop', 'Product')
+    StockShard = apps.get_model('shop', 'StockShard')
+    shards = settings.STOCK_SHARDS
+    batch = []
+    for product_id, stock, reserved in Product.objects.values_list('id', 'stock', 'reserved').iterator(chunk_size=2000):
+        free = max(stock - reserved, 0)
+        batch += [
+            StockShard(product_id=product_id, index=index, quantity=free // shards + (1 if index < free % shards else 0))
+            for index in range(shards)
+        ]
+        if len(batch) >= 2000:
+            StockShard.objects.bulk_create(batch)
+            batch = []
+    StockShard.objects.bulk_create(batch)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0007_stock_reservations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveSmallIntegerField(verbose_name='Index')),
+                ('quantity', models.PositiveIntegerField(default=0, verbose_name='Quantity')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_shards', to='shop.product', verbose_name='Product')),
+            ],
+            options={
+                'verbose_name': 'Stock Shard',
+                'verbose_name_plural': 'Stock Shards',
+            },
+        ),
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('sale', 'Sale'), ('restock', 'Restock'), ('adjustment', 'Adjustment'), ('cancellation', 'Cancellation')], max_length=12, verbose_name='Kind')),
+                ('quantity', models.IntegerField(verbose_name='Quantity')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('compacted', models.BooleanField(default=False, verbose_name='Compacted')),
+                ('order', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='stock_movements', to='shop.order', verbose_name='Order')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_movements', to='shop.product', verbose_name='Product')),
+            ],
+            options={
+                'verbose_name': 'Stock Movement',
+                'verbose_name_plural': 'Stock Movements',
+                'ordering': ('-id',),
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='stockshard',
+            constraint=models.UniqueConstraint(fields=('product', 'index'), name='unique_stock_shard'),
+        ),
+        migrations.AddIndex(
+            model_name='stockmovement',
+            index=models.Index(fields=['product', 'compacted'], name='movement_product_compacted'),
+        ),
+        migrations.AddIndex(
+            model_name='stockmovement',
+            index=models.Index(fields=['compacted', 'id'], name='movement_compacted_id'),
+        ),
+        migrations.RunPython(create_shards, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0008_stock_ledger_shards'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.CharField(max_length=200, verbose_name='Task')),
+                ('kwargs', models.JSONField(blank=True, default=dict, verbose_name='Arguments')),
+                ('dedupe_key', models.CharField(blank=True, max_length=200, null=True, verbose_name='Dedupe Key')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10, verbose_name='Status')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Attempts')),
+                ('max_attempts', models.PositiveSmallIntegerField(default=5, verbose_name='Max Attempts')),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now, verbose_name='Run After')),
+                ('claimed_by', models.CharField(blank=True, max_length=32, verbose_name='Claimed By')),
+                ('locked_until', models.DateTimeField(blank=True, null=True, verbose_name='Locked Until')),
+                ('last_error', models.TextField(blank=True, verbose_name='Last Error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='Finished')),
+            ],
+            options={
+                'verbose_name': 'Job',
+                'verbose_name_plural': 'Jobs',
+                'ordering': ('-id',),
+                'indexes': [models.Index(fields=['status', 'run_after'], name='job_status_run_after')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='job',
+            constraint=models.UniqueConstraint(condition=models.Q(('status', 'pending')), fields=('dedupe_key',), name='unique_pending_job_dedupe_key'),
+        ),
+    ]
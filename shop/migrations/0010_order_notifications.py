@@ -0,0 +1,28 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0009_jobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderNotification',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('confirmation', 'Confirmation'), ('shipped', 'Shipped')], max_length=12, verbose_name='Kind')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Created')),
+                ('sent_at', models.DateTimeField(blank=True, null=True, verbose_name='Sent At')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='notifications', to='shop.order', verbose_name='Order')),
+            ],
+            options={
+                'verbose_name': 'Order Notification',
+                'verbose_name_plural': 'Order Notifications',
+                'ordering': ('-id',),
+                'indexes': [models.Index(fields=['sent_at', 'id'], name='notification_sent_id')],
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0010_order_notifications'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='WebhookEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('event_id', models.CharField(max_length=255, unique=True, verbose_name='Event ID')),
+                ('type', models.CharField(max_length=100, verbose_name='Type')),
+                ('payload', models.JSONField(verbose_name='Payload')),
+                ('received', models.DateTimeField(auto_now_add=True, verbose_name='Received')),
+                ('processed_at', models.DateTimeField(blank=True, null=True, verbose_name='Processed At')),
+            ],
+            options={
+                'verbose_name': 'Webhook Event',
+                'verbose_name_plural': 'Webhook Events',
+                'ordering': ('-id',),
+            },
+        ),
+        migrations.AddField(
+            model_name='order',
+            name='payment_intent_id',
+            field=models.CharField(blank=True, db_index=True, max_length=255, verbose_name='Payment Intent'),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop', '0011_payments'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='refund_required',
+            field=models.BooleanField(default=False, verbose_name='Refund Required'),
+        ),
+    ]
@@ -1,6 +1,8 @@
 from django.db import models
+from django.db.models import F, Sum
 from django.contrib.auth.models import User # Per legare carrelli e ordini agli utenti registrati
 from django.core.validators import MinValueValidator # Per impedire prezzi o quantità negative
+from django.utils import timezone
 from django.urls import reverse # Per creare URL dinamici basati su slug o ID , generare URL dinamicamente
 from decimal import Decimal
 
@@ -36,12 +38,27 @@ class Product(models.Model):
     available = models.BooleanField(default=True, verbose_name="Available")
     created = models.DateTimeField(auto_now_add=True, verbose_name="Created") # Data creazione automatica
     updated = models.DateTimeField(auto_now=True, verbose_name="Updated") # Data modifica automatica
+    # Fotografia dello stock: il checkout non la tocca, scrive solo StockMovement che vengono
+    # sommati qui periodicamente (vedi shop/inventory.py, compact_stock_ledger)
     stock = models.PositiveIntegerField(default=0, verbose_name="Stock")
+    # Pezzi venduti, sommati dai movimenti di vendita: l'ordinamento "Più venduti" non somma gli OrderItem
+    sold = models.PositiveIntegerField(default=0, verbose_name="Sold")
+    # Pezzi trattenuti nei carrelli (somma delle StockReservation), aggiornati insieme allo stock: disponibili = stock - reserved
+    reserved = models.PositiveIntegerField(default=0, verbose_name="Reserved")
     
     class Meta:
         ordering = ('-created',) # I più recenti appaiono per primi
+        # Un indice per ogni ordinamento della vetrina (vedi shop/facets.py, SORT_ORDERS), con e senza categoria:
+        # il database legge le righe già nell'ordine giusto e si ferma dopo una pagina.
+        # 'available' non è nell'indice: Django scrive il filtro come WHERE "available" (senza "= 1")
+        # e SQLite non lo userebbe; i pochi prodotti non disponibili vengono scartati durante la lettura
         indexes = [
-            models.Index(fields=['id', 'slug']), # Ottimizza la velocità di ricerca nel database
+            models.Index(fields=['category', 'created', 'id'], name='product_category_created'),
+            models.Index(fields=['created', 'id'], name='product_created'),
+            models.Index(fields=['category', 'price', 'id'], name='product_category_price'),
+            models.Index(fields=['price', 'id'], name='product_price'),
+            models.Index(fields=['category', 'sold', 'id'], name='product_category_sold'),
+            models.Index(fields=['sold', 'id'], name='product_sold'),
         ]
         verbose_name = 'Product'
         verbose_name_plural = 'Products'
@@ -52,6 +69,49 @@ class Product(models.Model):
     def get_absolute_url(self):
         return reverse('shop:product_detail', args=[self.id, self.slug])
 
+    @property
+    def available_to_sell(self):
+        # Dalla fotografia: per il valore esatto vedi inventory.available_to_sell()
+        return max(self.stock - self.reserved, 0)
+
+# --- MAGAZZINO: CONTATORE DIVISO E REGISTRO MOVIMENTI ---
+class StockShard(models.Model):
+    # I pezzi liberi (non venduti né nei carrelli) di un prodotto, divisi su STOCK_SHARDS righe:
+    # checkout concorrenti sullo stesso prodotto aggiornano righe diverse invece di mettersi in coda su una
+    product = models.ForeignKey(Product, related_name='stock_shards', on_delete=models.CASCADE, verbose_name="Product")
+    index = models.PositiveSmallIntegerField(verbose_name="Index")
+    quantity = models.PositiveIntegerField(default=0, verbose_name="Quantity")
+
+    class Meta:
+        verbose_name = 'Stock Shard'
+        verbose_name_plural = 'Stock Shards'
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'index'], name='unique_stock_shard'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_id}/{self.index}: {self.quantity}"
+
+# --- PRENOTAZIONI DI STOCK (CARRELLI) ---
+class StockReservation(models.Model):
+    # Pezzi trattenuti per un carrello finché non scade expires_at (vedi shop/reservations.py)
+    product = models.ForeignKey(Product, related_name='reservations', on_delete=models.CASCADE, verbose_name="Product")
+    token = models.CharField(max_length=32, verbose_name="Hold Token") # Identifica il carrello, salvato in sessione
+    quantity = models.PositiveIntegerField(verbose_name="Quantity")
+    created = models.DateTimeField(auto_now_add=True, verbose_name="Created")
+    expires_at = models.DateTimeField(db_index=True, verbose_name="Expires At")
+
+    class Meta:
+        verbose_name = 'Stock Reservation'
+        verbose_name_plural = 'Stock Reservations'
+        constraints = [
+            # Una prenotazione per prodotto in ogni carrello: cambiare quantità la aggiorna
+            models.UniqueConstraint(fields=['token', 'product'], name='unique_reservation_token_product'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} x {self.product_id} ({self.token})"
+
 # --- CARRELLO (CONTENITORE) ---
 class Cart(models.Model):
     # OneToOne: un utente ha un solo carrello attivo
@@ -70,12 +130,13 @@ class Cart(models.Model):
         return f"Cart session {self.session_key}"
     
     def get_total_price(self):
-        # Somma il prezzo totale di tutti gli elementi nel carrello
-        return sum(item.get_total_price() for item in self.items.all())
+        # Somma il prezzo totale di tutti gli elementi nel carrello con un'unica query aggregata
+        total = self.items.aggregate(total=Sum(F('quantity') * F('product__price')))['total']
+        return total or Decimal('0')
     
     def get_total_items(self):
-        # Somma la quantità totale di pezzi nel carrello
-        return sum(item.quantity for item in self.items.all())
+        # Somma la quantità totale di pezzi nel carrello (query aggregata)
+        return self.items.aggregate(total=Sum('quantity'))['total'] or 0
 
 # --- ELEMENTI DEL CARRELLO (DETTAGLIO) ---
 class CartItem(models.Model):
@@ -86,6 +147,10 @@ class CartItem(models.Model):
     class Meta:
         verbose_name = 'Cart Item'
         verbose_name_plural = 'Cart Items'
+        constraints = [
+            # Una sola riga per prodotto in ogni carrello: permette gli upsert sulle quantità
+            models.UniqueConstraint(fields=['cart', 'product'], name='unique_cart_product'),
+        ]
     
     def __str__(self):
         return f"{self.quantity} x {self.product.name}"
@@ -120,6 +185,13 @@ class Order(models.Model):
     paid = models.BooleanField(default=False, verbose_name="Paid") # Indica se il pagamento è avvenuto
     payment_method = models.CharField(max_length=10, choices=PAYMENT_CHOICES, default='cash', verbose_name="Payment Method")
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending', verbose_name="Status")
+    # Totali denormalizzati: scritti al checkout, così liste e admin non ricalcolano le righe per ogni ordine
+    total_cost = models.DecimalField(max_digits=12, decimal_places=2, default=Decimal('0'), verbose_name="Total Cost")
+    item_count = models.PositiveIntegerField(default=0, verbose_name="Item Count")
+    # PaymentIntent di Stripe per i pagamenti con carta: paid diventa True solo dal webhook (payments.py)
+    payment_intent_id = models.CharField(max_length=255, blank=True, db_index=True, verbose_name="Payment Intent")
+    # Pagamento arrivato per un ordine già annullato (pezzi tornati in magazzino): va rimborsato a mano
+    refund_required = models.BooleanField(default=False, verbose_name="Refund Required")
     
     class Meta:
         ordering = ('-created',)
@@ -130,7 +202,134 @@ class Order(models.Model):
         return f'Order {self.id}'
     
     def get_total_cost(self):
-        return sum(item.get_cost() for item in self.items.all())
+        # Legge il totale salvato sull'ordine (nessuna query sulle righe)
+        return self.total_cost
+    
+    def update_totals(self, save=True):
+        """ Ricalcola total_cost e item_count dalle righe con un'unica query aggregata. """
+        totals = self.items.aggregate(
+            total_cost=Sum(F('price') * F('quantity')),
+            item_count=Sum('quantity'),
+        )
+        self.total_cost = totals['total_cost'] or Decimal('0')
+        self.item_count = totals['item_count'] or 0
+        if save:
+            self.save(update_fields=['total_cost', 'item_count'])
+
+# --- REGISTRO DEI MOVIMENTI DI MAGAZZINO ---
+class StockMovement(models.Model):
+    KIND_CHOICES = [
+        ('sale', 'Sale'),
+        ('restock', 'Restock'),
+        ('adjustment', 'Adjustment'),
+        ('cancellation', 'Cancellation'),
+    ]
+
+    # Solo inserimenti: ogni variazione di stock è una riga nuova, mai un UPDATE sul prodotto
+    product = models.ForeignKey(Product, related_name='stock_movements', on_delete=models.CASCADE, verbose_name="Product")
+    kind = models.CharField(max_length=12, choices=KIND_CHOICES, verbose_name="Kind")
+    quantity = models.IntegerField(verbose_name="Quantity") # Con segno: negativo per le vendite
+    order = models.ForeignKey(Order, related_name='stock_movements', on_delete=models.SET_NULL, null=True, blank=True, verbose_name="Order")
+    created = models.DateTimeField(auto_now_add=True, verbose_name="Created")
+    # True quando il movimento è già sommato in Product.stock
+    compacted = models.BooleanField(default=False, verbose_name="Compacted")
+
+    class Meta:
+        ordering = ('-id',)
+        verbose_name = 'Stock Movement'
+        verbose_name_plural = 'Stock Movements'
+        indexes = [
+            # Movimenti da sommare: per prodotto (stock attuale) e in ordine di inserimento (compattazione)
+            models.Index(fields=['product', 'compacted'], name='movement_product_compacted'),
+            models.Index(fields=['compacted', 'id'], name='movement_compacted_id'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} {self.quantity:+d} x {self.product_id}"
+
+# --- WEBHOOK DEI PAGAMENTI ---
+class WebhookEvent(models.Model):
+    # Un evento per ID: i reinvii dello stesso evento da parte di Stripe non vengono applicati due volte
+    event_id = models.CharField(max_length=255, unique=True, verbose_name="Event ID")
+    type = models.CharField(max_length=100, verbose_name="Type")
+    payload = models.JSONField(verbose_name="Payload")
+    received = models.DateTimeField(auto_now_add=True, verbose_name="Received")
+    processed_at = models.DateTimeField(null=True, blank=True, verbose_name="Processed At") # None = da elaborare
+
+    class Meta:
+        ordering = ('-id',)
+        verbose_name = 'Webhook Event'
+        verbose_name_plural = 'Webhook Events'
+
+    def __str__(self):
+        return f"{self.type} ({self.event_id})"
+
+# --- EMAIL AI CLIENTI (outbox) ---
+class OrderNotification(models.Model):
+    KIND_CHOICES = [
+        ('confirmation', 'Confirmation'),
+        ('shipped', 'Shipped'),
+    ]
+
+    # Scritta nella stessa transazione dell'ordine (o del cambio di stato), inviata dopo da notifications.py
+    order = models.ForeignKey(Order, related_name='notifications', on_delete=models.CASCADE, verbose_name="Order")
+    kind = models.CharField(max_length=12, choices=KIND_CHOICES, verbose_name="Kind")
+    created = models.DateTimeField(auto_now_add=True, verbose_name="Created")
+    sent_at = models.DateTimeField(null=True, blank=True, verbose_name="Sent At") # None = da inviare
+
+    class Meta:
+        ordering = ('-id',)
+        verbose_name = 'Order Notification'
+        verbose_name_plural = 'Order Notifications'
+        indexes = [
+            # Email da inviare, in ordine di arrivo
+            models.Index(fields=['sent_at', 'id'], name='notification_sent_id'),
+        ]
+
+    def __str__(self):
+        return f"{self.get_kind_display()} - Order {self.order_id}"
+
+# --- LAVORI IN BACKGROUND (outbox) ---
+class Job(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+
+    # Percorso della funzione da eseguire (es. 'shop.inventory.compact') e suoi argomenti
+    task = models.CharField(max_length=200, verbose_name="Task")
+    kwargs = models.JSONField(default=dict, blank=True, verbose_name="Arguments")
+    # Due lavori in attesa con la stessa chiave sono lo stesso lavoro: il secondo non viene inserito
+    dedupe_key = models.CharField(max_length=200, null=True, blank=True, verbose_name="Dedupe Key")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending', verbose_name="Status")
+    attempts = models.PositiveSmallIntegerField(default=0, verbose_name="Attempts")
+    max_attempts = models.PositiveSmallIntegerField(default=5, verbose_name="Max Attempts")
+    run_after = models.DateTimeField(default=timezone.now, verbose_name="Run After")
+    # Worker che lo sta eseguendo e fino a quando: scaduto il termine un altro worker lo riprende
+    claimed_by = models.CharField(max_length=32, blank=True, verbose_name="Claimed By")
+    locked_until = models.DateTimeField(null=True, blank=True, verbose_name="Locked Until")
+    last_error = models.TextField(blank=True, verbose_name="Last Error")
+    created = models.DateTimeField(auto_now_add=True, verbose_name="Created")
+    finished = models.DateTimeField(null=True, blank=True, verbose_name="Finished")
+
+    class Meta:
+        ordering = ('-id',)
+        verbose_name = 'Job'
+        verbose_name_plural = 'Jobs'
+        indexes = [
+            # Lavori pronti per i worker: WHERE status = 'pending' AND run_after <= now
+            models.Index(fields=['status', 'run_after'], name='job_status_run_after'),
+        ]
+        constraints = [
+            models.UniqueConstraint(
+                fields=['dedupe_key'], condition=models.Q(status='pending'), name='unique_pending_job_dedupe_key',
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.task} #{self.id}"
 
 # --- DETTAGLIO PRODOTTI ORDINATI ---
 class OrderItem(models.Model):
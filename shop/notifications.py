@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.core.mail import EmailMultiAlternatives, get_connection
+from django.db import transaction
+from django.db.models import Prefetch
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.utils import timezone
+
+from . import jobs
+from .models import OrderItem, OrderNotification
+
+CONFIRMATION = 'confirmation'
+SHIPPED = 'shipped'
+
+# Oggetto e template (templates/shop/email/<nome>.txt e .html) di ogni tipo di email
+EMAILS = {
+    CONFIRMATION: ('Conferma ordine n. {id}', 'order_confirmation'),
+    SHIPPED: ('Il tuo ordine n. {id} è stato spedito', 'order_shipped'),
+}
+
+
+def notify(orders, kind):
+    """
+    Mette in coda l'email `kind` per gli ordini indicati, con il lavoro che la invia, nella transazione
+    corrente: l'email parte solo se l'ordine o il cambio di stato vengono salvati, e sempre se lo sono.
+    """
+    OrderNotification.objects.bulk_create([OrderNotification(order=order, kind=kind) for order in orders])
+    # Pochi lavori in attesa per tutte le email: ognuno invia tutte quelle pronte sulla stessa connessione
+    # (send_pending salta le righe già prese da un altro worker)
+    jobs.enqueue('shop.notifications.send_pending', dedupe_key=jobs.shared_key('order_notifications'))
+
+
+def build_message(notification):
+    """ Email multipart (testo + HTML) per una notifica, con ordine e righe già caricati. """
+    order = notification.order
+    subject, template = EMAILS[notification.kind]
+    context = {
+        'order': order,
+        'items': order.items.all(),
+        'order_url': settings.SHOP_BASE_URL + reverse('shop:order_detail', args=[order.id]),
+    }
+    message = EmailMultiAlternatives(
+        subject=subject.format(id=order.id),
+        body=render_to_string(f'shop/email/{template}.txt', context),
+        to=[order.email],
+    )
+    message.attach_alternative(render_to_string(f'shop/email/{template}.html', context), 'text/html')
+    return message
+
+
+def send_pending(batch_size=None):
+    """
+    Invia tutte le email in attesa a blocchi di `batch_size`, aprendo una sola connessione SMTP.
+    Ogni blocco è segnato come inviato nella stessa transazione di send_messages: se l'SMTP cade
+    a metà il lavoro fallisce e al nuovo tentativo (shop/jobs.py) riparte il blocco
+    (le email del blocco già consegnate possono arrivare due volte).
+    """
+    batch_size = batch_size or settings.ORDER_EMAIL_BATCH_SIZE
+    sent = 0
+    # Il backend SMTP apre la connessione al primo send_messages e la chiude all'uscita dal with
+    with get_connection() as connection:
+        while True:
+            with transaction.atomic():
+                # Righe bloccate: due worker non inviano la stessa email (solo le notifiche, non gli ordini)
+                batch = list(
+                    OrderNotification.objects.filter(sent_at__isnull=True).order_by('id')
+                    .select_for_update(skip_locked=True, of=('self',))
+                    .select_related('order')
+                    .prefetch_related(Prefetch('order__items', queryset=OrderItem.objects.select_related('product')))
+                    [:batch_size]
+                )
+                if not batch:
+                    break
+                messages = [build_message(notification) for notification in batch]
+                # Segnate prima dell'invio, nella stessa transazione: se send_messages fallisce si annulla anche questo
+                OrderNotification.objects.filter(id__in=[notification.id for notification in batch]).update(
+                    sent_at=timezone.now(),
+                )
+                connection.send_messages(messages)
+            sent += len(batch)
+            if len(batch) < batch_size:
+                break
+    return sent
+
+
+"""
+Email ai clienti: conferma al checkout e avviso di spedizione (azione "Segna come spediti"
+dell'admin). La richiesta non parla mai con il server SMTP: scrive una OrderNotification
+nella sua transazione e mette in coda send_pending, che il worker run_jobs esegue pochi
+istanti dopo. Tutte le email in attesa, anche centinaia dopo una spedizione di massa,
+partono sulla stessa connessione invece di aprirne una per messaggio.
+
+Con EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend' le email finiscono
+in django.core.mail.outbox (utile per provarle), con il backend smtp e un server di debug
+locale (python -m aiosmtpd -n -l localhost:1025) si vedono stampate dal server.
+"""
@@ -0,0 +1,208 @@
+import base64
+import binascii
+import json
+from datetime import date, datetime
+from decimal import Decimal
+
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.db.models import Q
+from django.http import QueryDict
+
+
+class InvalidCursor(Exception):
+    """ Sollevata quando il token di paginazione non è decodificabile o non corrisponde alle chiavi. """
+
+
+class KeysetPaginator:
+    """
+    Paginazione "a cursore" (keyset): invece di OFFSET, ogni pagina riparte
+    dall'ultima riga vista filtrando sulle chiavi di ordinamento.
+    Il costo di una pagina resta costante anche dopo centinaia di pagine.
+
+    `keys` è l'ordinamento completo e univoco, es. ('-created', '-id'):
+    l'ultima chiave deve essere univoca (di solito la primary key).
+    """
+
+    def __init__(self, queryset, per_page, keys=('-created', '-id')):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.keys = tuple(keys)
+        # Coppie (nome campo, discendente?) ricavate dalle chiavi
+        self.fields = [(key.lstrip('-'), key.startswith('-')) for key in self.keys]
+
+    def get_page(self, token=None, params=None):
+        """
+        Restituisce la pagina indicata dal token (None = prima pagina).
+        Un token non valido riporta alla prima pagina invece di generare un errore.
+        """
+        try:
+            direction, values = self.decode(token) if token else ('next', None)
+        except InvalidCursor:
+            direction, values = 'next', None
+        return KeysetPage(self, direction, values, params)
+
+    # --- CODIFICA DEL CURSORE ---
+    def encode(self, direction, obj):
+        values = [self._serialize(getattr(obj, name)) for name, _ in self.fields]
+        raw = json.dumps([direction] + values, separators=(',', ':')).encode()
+        # base64 "url-safe" senza padding: il token finisce direttamente nella query string
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    def decode(self, token):
+        try:
+            raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+            data = json.loads(raw)
+        except (binascii.Error, ValueError, TypeError):
+            raise InvalidCursor(token)
+        if not isinstance(data, list) or len(data) != len(self.fields) + 1 or data[0] not in ('next', 'prev'):
+            raise InvalidCursor(token)
+        values = [self._deserialize(name, value) for (name, _), value in zip(self.fields, data[1:])]
+        return data[0], values
+
+    @staticmethod
+    def _serialize(value):
+        # JSON non gestisce date e Decimal: li salviamo come stringhe
+        if isinstance(value, (datetime, date)):
+            return value.isoformat()
+        if isinstance(value, Decimal):
+            return str(value)
+        return value
+
+    def _deserialize(self, name, value):
+        try:
+            field = self.queryset.model._meta.get_field(name)
+        except FieldDoesNotExist:
+            # Chiave annotata (non è un campo del modello): usiamo il valore così com'è
+            return value
+        try:
+            return field.to_python(value)
+        except ValidationError:
+            raise InvalidCursor(value)
+
+    # --- COSTRUZIONE DELLA QUERY ---
+    def _seek_filter(self, values, forward):
+        """
+        Condizione "riga successiva al cursore" per un ordinamento su più colonne:
+        (a > x) OR (a = x AND b > y) OR ... con il verso di ogni chiave.
+        """
+        condition = Q()
+        for i, (name, descending) in enumerate(self.fields):
+            # Andando avanti seguiamo il verso della chiave, tornando indietro lo invertiamo
+            lookup = 'lt' if descending == forward else 'gt'
+            clause = Q(**{f'{name}__{lookup}': values[i]})
+            for j, (prev_name, _) in enumerate(self.fields[:i]):
+                clause &= Q(**{prev_name: values[j]})
+            condition |= clause
+        return condition
+
+    def _ordering(self, forward):
+        if forward:
+            return self.keys
+        # Ordinamento invertito per leggere "all'indietro" dalla pagina precedente
+        return tuple(name if descending else f'-{name}' for name, descending in self.fields)
+
+    def page_queryset(self, direction, values):
+        """ Queryset (non ancora eseguito) di una pagina, con una riga in più per sapere se ce n'è un'altra. """
+        forward = direction == 'next'
+        queryset = self.queryset.order_by(*self._ordering(forward))
+        if values is not None:
+            queryset = queryset.filter(self._seek_filter(values, forward))
+        return queryset[:self.per_page + 1]
+
+    def fetch(self, direction, values):
+        forward = direction == 'next'
+        # Una riga in più ci dice se esiste un'altra pagina in quella direzione
+        rows = list(self.page_queryset(direction, values))
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if not forward:
+            rows.reverse()
+        return rows, has_more
+
+
+class KeysetPage:
+    """
+    Una pagina della paginazione a cursore. La query viene eseguita solo al primo accesso
+    agli elementi, così un template che non la usa (es. frammento in cache) non tocca il DB.
+    """
+
+    def __init__(self, paginator, direction, values, params=None):
+        self.paginator = paginator
+        self.direction = direction
+        self.values = values
+        self.params = params
+        self._rows = None
+
+    def _load(self):
+        if self._rows is None:
+            rows, has_more = self.paginator.fetch(self.direction, self.values)
+            self._rows = rows
+            if self.direction == 'next':
+                self._has_next = has_more
+                # Se siamo arrivati qui da un cursore, esiste per forza una pagina precedente
+                self._has_previous = self.values is not None
+            else:
+                self._has_next = True
+                self._has_previous = has_more
+        return self._rows
+
+    @property
+    def object_list(self):
+        return self._load()
+
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+    def has_next(self):
+        self._load()
+        return self._has_next and bool(self._rows)
+
+    def has_previous(self):
+        self._load()
+        return self._has_previous and bool(self._rows)
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def next_token(self):
+        if not self.has_next():
+            return None
+        return self.paginator.encode('next', self._rows[-1])
+
+    @property
+    def previous_token(self):
+        if not self.has_previous():
+            return None
+        return self.paginator.encode('prev', self._rows[0])
+
+    def _url(self, token):
+        # Conserva gli altri parametri della query string (categoria, dimensione pagina, ...)
+        params = self.params.copy() if self.params is not None else QueryDict(mutable=True)
+        params['cursor'] = token
+        return '?' + params.urlencode()
+
+    @property
+    def next_url(self):
+        token = self.next_token
+        return self._url(token) if token else None
+
+    @property
+    def previous_url(self):
+        token = self.previous_token
+        return self._url(token) if token else None
+
+
+"""
+Perché non OFFSET: con `LIMIT 12 OFFSET 12000` il database deve comunque
+leggere e scartare 12000 righe; più l'utente scorre, più la pagina è lenta.
+Con il cursore la query diventa `WHERE (created, id) < (x, y) LIMIT 13`,
+che usa l'indice e costa sempre uguale.
+
+Il token contiene i valori delle chiavi dell'ultima (o prima) riga vista e la
+direzione: è stabile (lo stesso link porta sempre alla stessa posizione) anche
+se nel frattempo vengono aggiunti prodotti nuovi in cima al catalogo.
+"""
@@ -0,0 +1,300 @@
+import hashlib
+import hmac
+import json
+import logging
+import time
+import uuid
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+from django.utils import timezone
+from django.utils.crypto import salted_hmac
+from django.utils.module_loading import import_string
+
+from . import inventory, jobs
+from .models import Order, WebhookEvent
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentError(Exception):
+    """ Il gateway non ha potuto creare o recuperare il pagamento (rete, chiavi, importo non valido). """
+
+
+class InvalidWebhook(Exception):
+    """ Corpo o firma del webhook non validi: la richiesta non viene da Stripe. """
+
+
+def get_gateway():
+    """ Istanzia il gateway di pagamento scelto in settings.PAYMENT_GATEWAY. """
+    return import_string(settings.PAYMENT_GATEWAY)()
+
+
+def check_gateway():
+    """ All'avvio (ShopConfig.ready): il gateway finto in produzione farebbe segnare pagati ordini mai addebitati. """
+    if import_string(settings.PAYMENT_GATEWAY).fake and not settings.PAYMENT_FAKE_ENABLED:
+        raise ImproperlyConfigured(
+            'PAYMENT_GATEWAY è il gateway finto ma DEBUG è spento: imposta STRIPE_SECRET_KEY e STRIPE_WEBHOOK_SECRET '
+            '(o PAYMENT_FAKE=1 solo in un ambiente di prova).'
+        )
+
+
+def to_cents(amount):
+    """ Importo in euro (Decimal) -> centesimi interi, come li vuole Stripe. """
+    return int((amount * 100).quantize(Decimal('1')))
+
+
+class StripeGateway:
+    """ Pagamenti con carta tramite PaymentIntent di Stripe (libreria `stripe`, vedi requirements.txt). """
+
+    fake = False
+
+    def __init__(self):
+        import stripe
+        stripe.api_key = settings.STRIPE_SECRET_KEY
+        self.stripe = stripe
+
+    @property
+    def public_key(self):
+        return settings.STRIPE_PUBLIC_KEY
+
+    def create_intent(self, order):
+        """ Crea il PaymentIntent dell'ordine e restituisce (id, client_secret). """
+        try:
+            intent = self.stripe.PaymentIntent.create(
+                amount=to_cents(order.total_cost),
+                currency=settings.PAYMENT_CURRENCY,
+                automatic_payment_methods={'enabled': True},
+                receipt_email=order.email,
+                metadata={'order_id': order.id},
+                # Un doppio invio non crea due pagamenti per lo stesso ordine
+                idempotency_key=f'order-{order.id}-intent',
+            )
+        except self.stripe.error.StripeError as e:
+            raise PaymentError(str(e)) from e
+        return intent.id, intent.client_secret
+
+    def client_secret(self, intent_id):
+        """ client_secret di un PaymentIntent esistente (non lo salviamo: si chiede a Stripe). """
+        try:
+            return self.stripe.PaymentIntent.retrieve(intent_id).client_secret
+        except self.stripe.error.StripeError as e:
+            raise PaymentError(str(e)) from e
+
+    def cancel_intent(self, intent_id):
+        """ Annulla il PaymentIntent: il cliente non può più pagare l'ordine scaduto. """
+        try:
+            self.stripe.PaymentIntent.cancel(intent_id)
+        except self.stripe.error.StripeError as e:
+            raise PaymentError(str(e)) from e
+
+    def parse_event(self, payload, signature):
+        """ Verifica la firma del webhook e restituisce l'evento come dict. """
+        try:
+            self.stripe.Webhook.construct_event(payload, signature, settings.STRIPE_WEBHOOK_SECRET)
+        except (ValueError, self.stripe.error.SignatureVerificationError) as e:
+            raise InvalidWebhook(str(e)) from e
+        return json.loads(payload)
+
+
+class FakeGateway:
+    """
+    Gateway finto per sviluppo e test, senza rete né libreria `stripe`: PaymentIntent con ID
+    inventati e webhook firmati come quelli veri (header Stripe-Signature, HMAC-SHA256 del
+    corpo con STRIPE_WEBHOOK_SECRET). La pagina di pagamento mostra un pulsante che simula
+    il pagamento e fa passare l'evento dallo stesso percorso dei webhook reali.
+    Solo con PAYMENT_FAKE_ENABLED (DEBUG o PAYMENT_FAKE=1).
+    """
+
+    fake = True
+    public_key = ''
+    TOLERANCE = 300
+
+    def __init__(self):
+        if not settings.PAYMENT_FAKE_ENABLED:
+            raise ImproperlyConfigured('FakeGateway richiede PAYMENT_FAKE_ENABLED (DEBUG o PAYMENT_FAKE=1).')
+
+    @property
+    def secret(self):
+        # Senza STRIPE_WEBHOOK_SECRET un segreto ricavato da SECRET_KEY: mai un valore noto a chiunque
+        return settings.STRIPE_WEBHOOK_SECRET or salted_hmac('shop.payments.FakeGateway', 'webhook').hexdigest()
+
+    def create_intent(self, order):
+        intent_id = f'pi_fake_{uuid.uuid4().hex[:24]}'
+        return intent_id, f'{intent_id}_secret_fake'
+
+    def client_secret(self, intent_id):
+        return f'{intent_id}_secret_fake'
+
+    def cancel_intent(self, intent_id):
+        pass
+
+    def event(self, event_type, order, **fields):
+        """ Corpo JSON di un evento sul PaymentIntent dell'ordine (es. 'payment_intent.succeeded'). """
+        intent = {
+            'id': order.payment_intent_id, 'object': 'payment_intent',
+            'amount': to_cents(order.total_cost), 'amount_received': 0,
+            'currency': settings.PAYMENT_CURRENCY, 'metadata': {'order_id': str(order.id)},
+        }
+        if event_type == 'payment_intent.succeeded':
+            intent['amount_received'] = intent['amount']
+        intent.update(fields)
+        return json.dumps({
+            'id': f'evt_fake_{uuid.uuid4().hex[:24]}', 'type': event_type, 'data': {'object': intent},
+        }).encode()
+
+    def sign(self, payload, timestamp=None):
+        """ Header Stripe-Signature per `payload` (stesso schema di Stripe: t=...,v1=...). """
+        timestamp = int(timestamp or time.time())
+        signature = hmac.new(self.secret.encode(), f'{timestamp}.'.encode() + payload, hashlib.sha256).hexdigest()
+        return f't={timestamp},v1={signature}'
+
+    def parse_event(self, payload, signature):
+        parts = dict(part.split('=', 1) for part in (signature or '').split(',') if '=' in part)
+        try:
+            timestamp = int(parts.get('t', ''))
+        except ValueError:
+            raise InvalidWebhook('Firma senza timestamp')
+        if abs(time.time() - timestamp) > self.TOLERANCE:
+            raise InvalidWebhook('Firma scaduta')
+        if not hmac.compare_digest(self.sign(payload, timestamp), f't={timestamp},v1={parts.get("v1", "")}'):
+            raise InvalidWebhook('Firma non valida')
+        try:
+            return json.loads(payload)
+        except ValueError as e:
+            raise InvalidWebhook(str(e)) from e
+
+
+def start_payment(order, gateway=None):
+    """
+    PaymentIntent dell'ordine (creato la prima volta) e suo client_secret per Stripe.js.
+    Va chiamata fuori dalla transazione dell'ordine: è una chiamata di rete.
+    """
+    gateway = gateway or get_gateway()
+    if order.payment_intent_id:
+        return gateway.client_secret(order.payment_intent_id)
+    intent_id, client_secret = gateway.create_intent(order)
+    Order.objects.filter(id=order.id).update(payment_intent_id=intent_id)
+    order.payment_intent_id = intent_id
+    return client_secret
+
+
+# --- WEBHOOK ---
+def receive(payload, signature, gateway=None):
+    """
+    Registra un webhook e mette in coda la sua elaborazione: la richiesta di Stripe riceve
+    subito 200 e il lavoro vero lo fa il worker (process_event). Un evento già ricevuto
+    (Stripe reinvia finché non riceve 2xx) non viene registrato né accodato di nuovo.
+    """
+    event = (gateway or get_gateway()).parse_event(payload, signature)
+    if WebhookEvent.objects.filter(event_id=event['id']).exists():
+        return False
+    with transaction.atomic():
+        # Evento e lavoro nella stessa transazione: non esiste un evento registrato senza elaborazione in coda
+        WebhookEvent.objects.bulk_create(
+            [WebhookEvent(event_id=event['id'], type=event['type'], payload=event)], ignore_conflicts=True,
+        )
+        jobs.enqueue('shop.payments.process_event', dedupe_key=f"webhook:{event['id']}", event_id=event['id'])
+    return True
+
+
+def _succeeded(intent):
+    order = Order.objects.select_for_update().filter(payment_intent_id=intent['id']).first()
+    if order is None or order.paid:
+        return
+    if order.status == 'cancelled':
+        # Pagato dopo l'annullamento (scaduto o annullato dall'admin): i pezzi sono già tornati in vendita,
+        # l'ordine non si spedisce e l'importo va restituito
+        logger.error('Pagamento %s arrivato per l\'ordine annullato %s: da rimborsare', intent['id'], order.id)
+        Order.objects.filter(id=order.id).update(refund_required=True)
+        return
+    if intent.get('amount_received') != to_cents(order.total_cost):
+        # Importo diverso dal totale dell'ordine: non lo segniamo pagato, serve un controllo a mano
+        logger.error('Pagamento %s: ricevuti %s centesimi per l\'ordine %s da %s', intent['id'],
+                     intent.get('amount_received'), order.id, to_cents(order.total_cost))
+        return
+    Order.objects.filter(id=order.id).update(paid=True, status='processing')
+
+
+def _failed(intent):
+    # Il cliente può riprovare con un'altra carta sullo stesso PaymentIntent: l'ordine resta in attesa
+    error = intent.get('last_payment_error') or {}
+    logger.info('Pagamento %s rifiutato: %s', intent['id'], error.get('message', ''))
+
+
+def _canceled(intent):
+    order = Order.objects.select_for_update().filter(payment_intent_id=intent['id']).first()
+    if order is None or order.paid or order.status == 'cancelled':
+        return
+    Order.objects.filter(id=order.id).update(status='cancelled')
+    inventory.cancel_order(order)
+
+
+def schedule_expiry(order):
+    """ Nella transazione del checkout: se l'ordine con carta non è pagato entro PAYMENT_EXPIRY viene annullato. """
+    jobs.enqueue('shop.payments.expire_order', delay=settings.PAYMENT_EXPIRY, order_id=order.id)
+
+
+def expire_order(order_id):
+    """ Annulla un ordine con carta ancora non pagato (lavoro in coda): i pezzi venduti tornano in magazzino. """
+    with transaction.atomic():
+        order = (
+            Order.objects.select_for_update()
+            .filter(id=order_id, payment_method='card', paid=False).exclude(status='cancelled').first()
+        )
+        if order is None:
+            return
+        Order.objects.filter(id=order.id).update(status='cancelled')
+        inventory.cancel_order(order)
+    if order.payment_intent_id:
+        # Chiamata di rete fuori dalla transazione; se fallisce un pagamento tardivo finisce in refund_required
+        try:
+            get_gateway().cancel_intent(order.payment_intent_id)
+        except PaymentError:
+            logger.warning('Impossibile annullare il pagamento %s dell\'ordine scaduto %s',
+                           order.payment_intent_id, order.id, exc_info=True)
+
+
+# Eventi gestiti (da abilitare sull'endpoint in Stripe Dashboard -> Webhooks); gli altri vengono solo registrati
+HANDLERS = {
+    'payment_intent.succeeded': _succeeded,
+    'payment_intent.payment_failed': _failed,
+    'payment_intent.canceled': _canceled,
+}
+
+
+def process_event(event_id):
+    """ Applica un evento registrato, una volta sola (lavoro in coda, eseguito da run_jobs). """
+    with transaction.atomic():
+        event = WebhookEvent.objects.select_for_update().get(event_id=event_id)
+        if event.processed_at is not None:
+            return
+        handler = HANDLERS.get(event.type)
+        if handler is not None:
+            handler(event.payload['data']['object'])
+        event.processed_at = timezone.now()
+        event.save(update_fields=['processed_at'])
+
+
+"""
+Pagamenti con carta: al checkout l'ordine viene creato non pagato e il cliente paga
+nella pagina shop:order_pay con Stripe.js (Payment Element) sul PaymentIntent dell'ordine.
+Il campo `paid` lo imposta solo il webhook payment_intent.succeeded, mai il browser.
+
+Webhook: la vista verifica la firma e scrive due righe (WebhookEvent e Job), poi risponde 200.
+L'elaborazione la fa il worker run_jobs: durante i picchi di un lancio i processi web non
+aspettano il database degli ordini. L'ID dell'evento è univoco, quindi i reinvii di Stripe
+vengono ignorati e process_event applica ogni evento una volta sola.
+
+Un ordine con carta non pagato entro PAYMENT_EXPIRY viene annullato (expire_order, in coda
+dal checkout) e i suoi pezzi tornano in vendita. Un pagamento che arriva dopo l'annullamento
+non riapre l'ordine: lo segna refund_required per il rimborso.
+
+In sviluppo PAYMENT_GATEWAY = 'shop.payments.FakeGateway' (default senza STRIPE_SECRET_KEY):
+nessuna chiamata a Stripe, e nei test si possono costruire eventi firmati con
+FakeGateway().event(...) e FakeGateway().sign(...) da inviare alla vista del webhook.
+Con DEBUG spento il gateway finto è ammesso solo con PAYMENT_FAKE=1: senza, il sito non
+parte (check_gateway), perché chiunque potrebbe segnare pagato un ordine.
+"""
@@ -0,0 +1,179 @@
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+
+SALT = 'shop.profiling'
+# Parametro della query string con il token firmato (profile_link) che fa profilare una singola richiesta
+QUERY_PARAM = '_profile'
+
+# Un solo cProfile attivo per processo: due richieste profilate insieme si falserebbero a vicenda
+_profile_lock = threading.Lock()
+
+
+def profile_link(path):
+    """ Token firmato, valido PROFILING_LINK_MAX_AGE secondi e una sola volta, che fa profilare `path`. """
+    return signing.dumps({'path': path, 'nonce': uuid.uuid4().hex}, salt=SALT, compress=True)
+
+
+def _check_link(request):
+    token = request.GET.get(QUERY_PARAM)
+    if not token:
+        return False
+    try:
+        data = signing.loads(token, salt=SALT, max_age=settings.PROFILING_LINK_MAX_AGE)
+    except signing.BadSignature:
+        return False
+    # Solo sul percorso per cui è stato firmato, e una volta: ricaricare la pagina non profila di nuovo
+    return data.get('path') == request.path and cache.add(
+        f'profiling:used:{data.get("nonce")}', 1, settings.PROFILING_LINK_MAX_AGE,
+    )
+
+
+def _frame_name(code):
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class _Sampler(threading.Thread):
+    """
+    Campiona ogni PROFILING_SAMPLE_INTERVAL secondi lo stack dei thread che stanno servendo
+    una richiesta dello shop: costa poco anche su tutte le richieste, e quando una supera
+    PROFILING_SLOW_MS i suoi campioni diventano un file di stack compressi (flamegraph).
+    """
+
+    def __init__(self):
+        super().__init__(name='shop-profiling-sampler', daemon=True)
+        self.stacks = {}
+        self.lock = threading.Lock()
+
+    def start_request(self):
+        with self.lock:
+            self.stacks[threading.get_ident()] = Counter()
+
+    def stop_request(self):
+        with self.lock:
+            return self.stacks.pop(threading.get_ident(), Counter())
+
+    def run(self):
+        while True:
+            time.sleep(settings.PROFILING_SAMPLE_INTERVAL)
+            with self.lock:
+                if not self.stacks:
+                    continue
+                frames = sys._current_frames()
+                for thread_id, stacks in self.stacks.items():
+                    frame = frames.get(thread_id)
+                    names = []
+                    while frame is not None:
+                        names.append(_frame_name(frame.f_code))
+                        frame = frame.f_back
+                    if names:
+                        stacks[';'.join(reversed(names))] += 1
+
+
+_sampler = None
+_sampler_pid = None
+_sampler_lock = threading.Lock()
+
+
+def _get_sampler():
+    """ Thread di campionamento del processo, avviato alla prima richiesta (anche dopo il fork dei worker). """
+    global _sampler, _sampler_pid
+    with _sampler_lock:
+        if _sampler_pid != os.getpid():
+            _sampler = _Sampler()
+            _sampler.start()
+            _sampler_pid = os.getpid()
+        return _sampler
+
+
+def _write(request, suffix, write):
+    """ Salva un profilo in PROFILING_DIR e toglie i più vecchi oltre PROFILING_KEEP. """
+    directory = Path(settings.PROFILING_DIR)
+    directory.mkdir(parents=True, exist_ok=True)
+    view = request.resolver_match.view_name.replace(':', '.')
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    path = directory / f'{stamp}-{os.getpid()}-{view}-{request.profiling_ms}ms-{suffix}'
+    write(path)
+    files = sorted(directory.glob('*-*'), key=lambda file: file.stat().st_mtime)
+    for old in files[:-settings.PROFILING_KEEP]:
+        old.unlink(missing_ok=True)
+    return path
+
+
+class ProfilingMiddleware:
+    """
+    Profila le viste dello shop in produzione, senza toccare le altre:
+    - una richiesta ogni PROFILING_SAMPLE_RATE con cProfile (file .prof, da leggere con pstats o snakeviz);
+    - ogni richiesta più lenta di PROFILING_SLOW_MS con il campionatore (file .collapsed per i flamegraph);
+    - la singola richiesta aperta dallo staff con il link firmato di shop:profile_request (.prof).
+    Va messo ultimo in MIDDLEWARE: misura la vista, non gli altri middleware.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.profiler = None
+        sampler = _get_sampler() if settings.PROFILING_SLOW_MS else None
+        if sampler is not None:
+            sampler.start_request()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            if request.profiler is not None:
+                request.profiler.disable()
+                _profile_lock.release()
+            stacks = sampler.stop_request() if sampler is not None else None
+        request.profiling_ms = int((time.perf_counter() - started) * 1000)
+        match = request.resolver_match
+        if match is None or match.namespace != 'shop':
+            return response
+        if request.profiler is not None:
+            _write(request, f'{request.profiling_reason}.prof', request.profiler.dump_stats)
+        elif stacks and request.profiling_ms >= settings.PROFILING_SLOW_MS:
+            _write(request, 'slow.collapsed', lambda path: path.write_text(
+                ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+            ))
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if request.resolver_match.namespace != 'shop':
+            return None
+        if _check_link(request):
+            reason = 'staff'
+        elif settings.PROFILING_SAMPLE_RATE and random.randrange(settings.PROFILING_SAMPLE_RATE) == 0:
+            reason = 'sampled'
+        else:
+            return None
+        if not _profile_lock.acquire(blocking=False):
+            return None
+        request.profiler = cProfile.Profile()
+        request.profiling_reason = reason
+        request.profiler.enable()
+        return None
+
+
+"""
+Profilazione a campione per capire, quando order_create o product_list rallentano in
+produzione, quali funzioni Python occupano il tempo, senza rilasciare codice nuovo.
+
+File in PROFILING_DIR (restano gli ultimi PROFILING_KEEP):
+    *.prof       python -m pstats <file>  (poi: sort cumtime, stats 30)  oppure  snakeviz <file>
+    *.collapsed  flamegraph.pl <file> > flame.svg  oppure trascinato su https://www.speedscope.app
+
+cProfile rallenta la richiesta profilata (ogni chiamata viene registrata), per questo si usa
+solo su una richiesta ogni PROFILING_SAMPLE_RATE o su richiesta dello staff; le richieste
+lente si catturano invece con il campionatore, che guarda lo stack pochi centinaia di volte
+al secondo e non rallenta la vista.
+"""
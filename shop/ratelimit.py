@@ -0,0 +1,108 @@
+import time
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.core.cache import cache
+from django.http import HttpResponse
+
+from .admission import incr_counter
+
+
+def client_ip(request):
+    """ Indirizzo del client dall'header configurato in RATE_LIMIT_IP_HEADER (primo della lista se ce ne sono più). """
+    value = request.META.get(settings.RATE_LIMIT_IP_HEADER, '')
+    return value.split(',')[0].strip()
+
+
+def _keys(name, identity, current, limit):
+    return f'ratelimit:{name}:{identity}:{current}', f'ratelimit:{name}:{identity}:{current - 1}', limit
+
+
+def _exceeded(keys, weight):
+    """ True se uno dei contatori ha già raggiunto il proprio limite nella finestra scorrevole. """
+    counts = cache.get_many([key for current, previous, _ in keys for key in (current, previous)])
+    return any(
+        counts.get(previous, 0) * weight + counts.get(current, 0) >= limit for current, previous, limit in keys
+    )
+
+
+def hit(name, request):
+    """
+    Conta una richiesta per il limite `name` di RATE_LIMITS e restituisce i secondi da
+    aspettare se uno dei contatori (sessione, utente, IP) è oltre il limite, altrimenti 0.
+    Sessione e utente hanno il limite di RATE_LIMITS, l'IP quello (più alto) di RATE_LIMITS_IP,
+    se c'è: dietro lo stesso IP (NAT, rete aziendale o mobile) ci sono molti clienti.
+    Finestra scorrevole approssimata: il conteggio della finestra precedente pesa per la
+    parte non ancora trascorsa, così non si raddoppia il limite a cavallo di due finestre.
+    """
+    limit, window = settings.RATE_LIMITS[name]
+    now = time.time()
+    current = int(now // window)
+    # Quanta parte della finestra precedente è ancora dentro gli ultimi `window` secondi
+    weight = 1 - (now % window) / window
+    retry_after = max(int(window - now % window), 1)
+    # Prima cookie di sessione e IP: si leggono dalla richiesta, senza caricare la sessione
+    keys = []
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if session_key:
+        keys.append(_keys(name, f'session:{session_key}', current, limit))
+    ip = client_ip(request)
+    ip_limit = settings.RATE_LIMITS_IP.get(name)
+    if ip and ip_limit:
+        keys.append(_keys(name, f'ip:{ip}', current, ip_limit))
+    if _exceeded(keys, weight):
+        return retry_after
+    # Poi l'utente, che è nella sessione: la vista la caricherebbe comunque
+    user_id = request.session.get(SESSION_KEY) if session_key else None
+    if user_id:
+        user_keys = [_keys(name, f'user:{user_id}', current, limit)]
+        if _exceeded(user_keys, weight):
+            return retry_after
+        keys += user_keys
+    # Le richieste rifiutate non si contano: un bot insistente non allunga la propria attesa
+    for current_key, _, _ in keys:
+        incr_counter(current_key, timeout=window * 2 + 1)
+    return 0
+
+
+def too_many_requests(retry_after):
+    """ Risposta 429 minima: nessun template, quindi né context processor né query. """
+    response = HttpResponse('Troppe richieste: riprova tra qualche secondo.', status=429,
+                            content_type='text/plain; charset=utf-8')
+    response['Retry-After'] = str(retry_after)
+    return response
+
+
+class RateLimitMiddleware:
+    """ Applica i limiti alle viste elencate in RATE_LIMIT_VIEWS ({'shop:cart_add': 'cart'}) senza decorarle. """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        name = settings.RATE_LIMIT_VIEWS.get(request.resolver_match.view_name)
+        if name is not None:
+            retry_after = hit(name, request)
+            if retry_after:
+                return too_many_requests(retry_after)
+        return None
+
+
+"""
+Limiti di frequenza per gli endpoint che modificano il carrello: i bot dei lanci che
+aggiungono e rimuovono in continuazione farebbero una query sul prodotto e una scrittura
+della sessione a ogni richiesta. Ogni limite (RATE_LIMITS = {nome: (richieste, secondi)})
+vale separatamente per sessione e utente; l'indirizzo IP ha un limite a parte, molto più alto
+(RATE_LIMITS_IP = {nome: richieste}, nella stessa finestra), che ferma chi cambia sessione a
+ogni richiesta senza bloccare i clienti che condividono un IP. I contatori sono nella cache
+(una get_many per richiesta più un incr per contatore) e una richiesta rifiutata per sessione
+o IP riceve un 429 senza toccare il database (il limite per utente legge la sessione, che la
+vista caricherebbe comunque).
+
+Si applica con il decoratore @rate_limited('nome') (shop/decorators.py) oppure, senza
+toccare le viste, con RateLimitMiddleware e RATE_LIMIT_VIEWS = {'app:vista': 'nome'}.
+Come per admission.py, con più worker serve un backend di cache condiviso.
+"""
@@ -0,0 +1,147 @@
+import posixpath
+from io import BytesIO
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image, ImageOps
+
+# Parametri di salvataggio per ogni formato: (nome Pillow, opzioni)
+FORMATS = {
+    'jpg': ('JPEG', {'quality': 82, 'optimize': True, 'progressive': True}),
+    'webp': ('WEBP', {'quality': 80, 'method': 4}),
+}
+
+
+def rendition_name(name, width, fmt):
+    """ products/2026/01/10/abito.jpg -> products/2026/01/10/abito_400w.webp (accanto all'originale). """
+    root, _ = posixpath.splitext(name)
+    return f'{root}_{width}w.{fmt}'
+
+
+def rendition_widths(original_width):
+    """
+    Larghezze delle versioni di un'immagine larga `original_width` px: quelle di PRODUCT_IMAGE_WIDTHS
+    non più grandi dell'originale, più l'originale stesso se è più stretto della più grande.
+    Un originale di 300 px -> [160, 300]: mai un file "_1200w" che in realtà è largo 300 px.
+    """
+    widths = [width for width in sorted(settings.PRODUCT_IMAGE_WIDTHS) if width <= original_width]
+    if original_width < max(settings.PRODUCT_IMAGE_WIDTHS) and original_width not in widths:
+        widths.append(original_width)
+    return widths
+
+
+def _upright_width(image):
+    # Foto del telefono ruotate di 90° (orientamento EXIF 5-8): la larghezza vera è l'altezza del file
+    return image.height if image.getexif().get(0x0112) in (5, 6, 7, 8) else image.width
+
+
+def _cache_key(name):
+    return f'renditions:{name}'
+
+
+def available_widths(name):
+    """
+    Larghezze delle versioni ridotte già generate per l'immagine ([] se mancano). Il controllo
+    sullo storage (dimensione dell'originale ed esistenza dei file) viene fatto una volta sola
+    e poi memorizzato in cache, così i template non interrogano il filesystem a ogni richiesta.
+    """
+    if not name:
+        return []
+    widths = cache.get(_cache_key(name))
+    if widths is None:
+        try:
+            with default_storage.open(name, 'rb') as source:
+                # Legge solo l'intestazione del file, non decodifica l'immagine
+                widths = rendition_widths(_upright_width(Image.open(source)))
+        except OSError:
+            widths = []
+        if widths and not all(
+            default_storage.exists(rendition_name(name, widths[0], fmt)) for fmt in settings.PRODUCT_IMAGE_FORMATS
+        ):
+            widths = []
+        # Un "mancano" dura poco: le versioni possono arrivare dal comando generate_renditions in un altro processo
+        cache.set(_cache_key(name), widths, 60 * 60 if widths else 60 * 5)
+    return widths
+
+
+def renditions_available(name):
+    """ True se le versioni ridotte dell'immagine esistono. """
+    return bool(available_widths(name))
+
+
+def _prepare(image, fmt):
+    if fmt == 'jpg' and image.mode != 'RGB':
+        # JPEG non supporta la trasparenza: appoggia l'immagine su sfondo bianco
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        rgba = image.convert('RGBA')
+        background.paste(rgba, mask=rgba.split()[-1])
+        return background
+    if image.mode not in ('RGB', 'RGBA'):
+        return image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+    return image
+
+
+def generate_renditions(name, force=False):
+    """
+    Crea le versioni ridotte (larghezze rendition_widths(), formati PRODUCT_IMAGE_FORMATS)
+    dell'immagine `name` nello storage. Non ingrandisce mai: le larghezze maggiori
+    dell'originale vengono saltate. Restituisce il numero di file scritti.
+    """
+    if not name:
+        return 0
+    with default_storage.open(name, 'rb') as source:
+        original = Image.open(source)
+        # Applica la rotazione EXIF delle foto scattate col telefono prima di ridimensionare
+        original = ImageOps.exif_transpose(original)
+        original.load()
+    written = 0
+    widths = rendition_widths(original.width)
+    # Dalla più grande alla più piccola: ogni riduzione parte dalla precedente (più veloce)
+    current = original
+    for width in reversed(widths):
+        if current.width > width:
+            height = round(current.height * width / current.width)
+            current = current.resize((width, height), Image.LANCZOS)
+        for fmt in settings.PRODUCT_IMAGE_FORMATS:
+            target = rendition_name(name, width, fmt)
+            if default_storage.exists(target):
+                if not force:
+                    continue
+                default_storage.delete(target)
+            pil_format, options = FORMATS[fmt]
+            buffer = BytesIO()
+            _prepare(current, fmt).save(buffer, pil_format, **options)
+            default_storage.save(target, ContentFile(buffer.getvalue()))
+            written += 1
+    cache.set(_cache_key(name), widths, 60 * 60)
+    return written
+
+
+def srcset(name, fmt):
+    """ Attributo srcset ("url 160w, url 400w, ...") per il formato richiesto, '' se mancano le versioni. """
+    return ', '.join(
+        f'{default_storage.url(rendition_name(name, width, fmt))} {width}w' for width in available_widths(name)
+    )
+
+
+def rendition_url(name, width, fmt='jpg'):
+    """ URL della versione più vicina (per eccesso) a `width`; l'originale se le versioni non esistono. """
+    widths = available_widths(name)
+    if not widths:
+        return default_storage.url(name)
+    chosen = next((w for w in widths if w >= width), widths[-1])
+    return default_storage.url(rendition_name(name, chosen, fmt))
+
+
+"""
+Le foto caricate dall'admin sono spesso di diversi MB (vedi cartella prodotti/),
+mentre la vetrina le mostra a 250px di altezza e il carrello a 80x80.
+Per ogni immagine generiamo alcune larghezze fisse in JPEG e WebP; il tag
+{% product_picture %} (templatetags/shop_images.py) usa <picture> e srcset,
+così il browser scarica solo la versione adatta allo schermo.
+
+Le versioni vengono create al salvataggio del prodotto (signals.py) e, per
+tutto il catalogo, con:  python manage.py generate_renditions --workers 4
+"""
@@ -0,0 +1,129 @@
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from . import inventory
+from .models import StockReservation
+
+
+class NotEnoughStock(Exception):
+    """
+    Sollevata quando la quantità richiesta non può essere trattenuta.
+    `available` è il massimo che il carrello può avere (pezzi liberi + quelli che tiene già).
+    """
+
+    def __init__(self, product, available):
+        self.product = product
+        self.available = available
+        super().__init__(f'{product}: disponibili {available}')
+
+
+def get_hold_token(request, create=True):
+    """ Token delle prenotazioni del carrello, salvato in sessione alla prima aggiunta (None se non c'è e create=False). """
+    token = request.session.get(settings.STOCK_RESERVATION_SESSION_ID)
+    if token is None and create:
+        token = uuid.uuid4().hex
+        request.session[settings.STOCK_RESERVATION_SESSION_ID] = token
+    return token
+
+
+def _expiry():
+    return timezone.now() + timedelta(seconds=settings.STOCK_RESERVATION_TTL)
+
+
+def reserve(token, product, quantity):
+    """
+    Porta a `quantity` i pezzi di `product` trattenuti per il carrello `token` e rinnova
+    la scadenza di tutte le sue prenotazioni. Solleva NotEnoughStock senza modificare nulla
+    se i pezzi liberi non bastano.
+    """
+    try:
+        with transaction.atomic():
+            hold = StockReservation.objects.select_for_update().filter(token=token, product=product).first()
+            held = hold.quantity if hold else 0
+            delta = quantity - held
+            if delta > 0:
+                # I pezzi passano dal contatore diviso alla prenotazione: due carrelli non possono trattenere lo stesso pezzo
+                if not product.available or not inventory.take(product.id, delta):
+                    available = inventory.available_to_sell([product.id])[product.id] if product.available else 0
+                    raise NotEnoughStock(product, available + held)
+            elif delta < 0:
+                inventory.give(product.id, -delta)
+            if delta:
+                # Product.reserved (vetrina e filtri) lo ricalcola la compattazione in coda: nessun UPDATE
+                # sulla riga del prodotto, che durante un lancio metterebbe in fila tutti i carrelli
+                inventory.schedule_compaction()
+            if hold is None:
+                StockReservation.objects.create(token=token, product=product, quantity=quantity, expires_at=_expiry())
+            elif quantity != held:
+                hold.quantity = quantity
+                hold.save(update_fields=['quantity'])
+            # Ogni modifica al carrello rinnova tutte le sue prenotazioni
+            extend(token)
+    except IntegrityError:
+        # Doppio invio concorrente: l'altra richiesta ha appena creato la prenotazione, ripartiamo da quella
+        reserve(token, product, quantity)
+
+
+def extend(token):
+    """ Rinnova la scadenza di tutte le prenotazioni del carrello (una sola query). """
+    if token:
+        StockReservation.objects.filter(token=token).update(expires_at=_expiry())
+
+
+def _release(holds, skip_locked=False):
+    """ Elimina le prenotazioni del queryset `holds` e restituisce i loro pezzi al contatore. """
+    with transaction.atomic():
+        rows = list(holds.select_for_update(skip_locked=skip_locked).values_list('id', 'product_id', 'quantity'))
+        if not rows:
+            return 0
+        quantities = {}
+        for _, product_id, quantity in rows:
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        StockReservation.objects.filter(id__in=[hold_id for hold_id, _, _ in rows]).delete()
+        for product_id, quantity in quantities.items():
+            inventory.give(product_id, quantity)
+        inventory.schedule_compaction()
+    return len(rows)
+
+
+def release(token, product=None):
+    """ Libera le prenotazioni del carrello (tutte, o solo quella di `product`). """
+    if not token:
+        return 0
+    holds = StockReservation.objects.filter(token=token)
+    if product is not None:
+        holds = holds.filter(product=product)
+    return _release(holds)
+
+
+def release_expired(batch_size=500):
+    """
+    Libera le prenotazioni scadute a blocchi di `batch_size` (una transazione breve per blocco).
+    Le righe bloccate da un checkout in corso vengono saltate e riprese al giro successivo.
+    """
+    released = 0
+    while True:
+        expired = StockReservation.objects.filter(expires_at__lte=timezone.now()).order_by('expires_at')
+        count = _release(expired[:batch_size], skip_locked=True)
+        released += count
+        if count < batch_size:
+            return released
+
+
+"""
+Prenotazioni con scadenza: aggiungere un prodotto al carrello trattiene i pezzi
+per STOCK_RESERVATION_TTL secondi. I pezzi passano dal contatore dei pezzi liberi
+(StockShard, vedi inventory.py) alla StockReservation nella stessa transazione, con
+UPDATE condizionali: nessun pezzo finisce in due carrelli. Product.reserved, usato da
+vetrina e filtri, è la somma delle prenotazioni ricalcolata dalla compattazione che ogni
+prenotazione creata o liberata mette in coda (pochi secondi di ritardo, STOCK_COMPACT_DELAY).
+
+Le prenotazioni scadute continuano a contare finché il comando
+release_expired_reservations (da lanciare ogni minuto, es. con cron) non le libera.
+Al checkout i pezzi trattenuti dal carrello vengono convertiti in vendita (checkout.py);
+se la prenotazione è già scaduta l'ordine passa solo se ci sono ancora pezzi liberi.
+"""
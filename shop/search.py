@@ -0,0 +1,356 @@
+import heapq
+import json
+import logging
+import math
+import os
+import pickle
+import re
+import threading
+import unicodedata
+from operator import itemgetter
+
+from django.conf import settings
+from django.db import transaction
+
+logger = logging.getLogger(__name__)
+
+# Peso di ogni occorrenza di un termine in base al campo: il nome conta più della descrizione
+FIELD_WEIGHTS = {'name': 3, 'category': 2, 'description': 1}
+# Oltre questo peso un termine ripetuto non aumenta più il punteggio (descrizioni "riempite" di parole chiave)
+MAX_TERM_WEIGHT = 20
+# Saturazione stile BM25: i primi match contano molto, quelli successivi sempre meno
+SATURATION = 1.2
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset("""
+    a ad al allo alla ai agli alle anche che chi con col come da dal dallo dalla dai dagli dalle
+    di del dello della dei degli delle e ed fra gli i il in la le lo ma ne nel nello nella nei
+    negli nelle non o per piu se si su sul sullo sulla sui sugli sulle tra un una uno
+""".split())
+
+
+def fold(text):
+    """ Minuscolo e senza accenti: "Città" -> "citta". """
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def stem(word):
+    """
+    Stemmer "leggero" per l'italiano: unifica singolare/plurale e maschile/femminile
+    (abito/abiti, gonna/gonne, giacca/giacche, camicia/camicie) senza toccare i numeri.
+    """
+    if word.isdigit() or len(word) <= 3:
+        return word
+    if len(word) > 7 and word.endswith('mente'):
+        return word[:-5]
+    if word.endswith(('che', 'chi', 'ghe', 'ghi')):
+        return word[:-2]
+    if word[-1] in 'aeio':
+        word = word[:-1]
+        # camicia/camicie -> camici -> camic
+        if word.endswith('i') and len(word) > 4:
+            word = word[:-1]
+    return word
+
+
+def tokenize(text):
+    """ Testo -> lista di termini indicizzabili (normalizzati, senza stopword, con stemming). """
+    return [
+        stem(token) for token in TOKEN_RE.findall(fold(text or ''))
+        if token not in STOPWORDS and (len(token) > 1 or token.isdigit())
+    ]
+
+
+def document_terms(name, description='', category_name=''):
+    """ Termini di un prodotto con il loro peso (occorrenze pesate per campo). """
+    weights = {}
+    for field, text in (('name', name), ('category', category_name), ('description', description)):
+        for term in tokenize(text):
+            weights[term] = min(weights.get(term, 0) + FIELD_WEIGHTS[field], MAX_TERM_WEIGHT)
+    return weights
+
+
+def product_terms(product):
+    return document_terms(product.name, product.description, product.category.name)
+
+
+class SearchIndex:
+    """
+    Indice invertito in memoria, diviso per peso: termine -> {peso: set di ID prodotto}.
+    `documents` tiene i termini (e i pesi) di ogni prodotto per poterlo rimuovere o aggiornare.
+    """
+
+    def __init__(self):
+        self.postings = {}
+        self.documents = {}
+
+    def __len__(self):
+        return len(self.documents)
+
+    def add(self, product_id, terms):
+        self.remove(product_id)
+        if not terms:
+            return
+        self.documents[product_id] = tuple(terms.items())
+        for term, weight in terms.items():
+            self.postings.setdefault(term, {}).setdefault(weight, set()).add(product_id)
+
+    def remove(self, product_id):
+        for term, weight in self.documents.pop(product_id, ()):
+            tiers = self.postings.get(term, {})
+            ids = tiers.get(weight)
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del tiers[weight]
+                    if not tiers:
+                        del self.postings[term]
+
+    def search(self, query, limit=None):
+        """
+        ID dei prodotti che contengono tutti i termini della query, dal più rilevante
+        (a parità di punteggio prima i più recenti, cioè ID più alto).
+        """
+        terms = set(tokenize(query))
+        if not terms:
+            return []
+        total = len(self.documents)
+        options = []
+        for term in terms:
+            tiers = self.postings.get(term)
+            if not tiers:
+                return []
+            # IDF: un termine raro ("lino") pesa più di uno presente ovunque ("abito")
+            idf = math.log(1 + total / sum(map(len, tiers.values())))
+            options.append(sorted(
+                ((idf * weight / (weight + SATURATION), ids) for weight, ids in tiers.items()),
+                key=itemgetter(0), reverse=True,
+            ))
+        results = []
+        last_score = None
+        for score, sets in _best_combinations(options):
+            if limit is not None and len(results) >= limit and score < last_score:
+                break
+            # Intersezione in C, partendo dall'insieme più piccolo
+            sets = sorted(sets, key=len)
+            matched = sets[0].intersection(*sets[1:])
+            if not matched:
+                continue
+            # Da ogni combinazione servono al massimo `limit` prodotti (i più recenti)
+            chosen = matched if limit is None else heapq.nlargest(limit, matched)
+            results.extend((score, product_id) for product_id in chosen)
+            last_score = score
+        results.sort(reverse=True)
+        return [product_id for _, product_id in results[:limit]]
+
+
+def _best_combinations(options):
+    """
+    Combinazioni (una fascia di peso per termine) in ordine di punteggio decrescente,
+    generate una alla volta con un heap: la ricerca si ferma appena ha abbastanza risultati,
+    senza dare un punteggio a tutti i prodotti che contengono parole molto comuni.
+    """
+    start = (0,) * len(options)
+    heap = [(-sum(option[0][0] for option in options), start)]
+    seen = {start}
+    while heap:
+        negative_score, position = heapq.heappop(heap)
+        yield -negative_score, [options[i][j][1] for i, j in enumerate(position)]
+        for i, j in enumerate(position):
+            if j + 1 < len(options[i]):
+                following = position[:i] + (j + 1,) + position[i + 1:]
+                if following not in seen:
+                    seen.add(following)
+                    score = sum(options[k][n][0] for k, n in enumerate(following))
+                    heapq.heappush(heap, (-score, following))
+
+
+# --- PERSISTENZA SU DISCO ---
+# Snapshot (pickle) dell'indice completo + journal (JSON Lines) delle modifiche successive.
+# Ogni processo tiene l'indice in memoria e legge dal journal solo le righe nuove.
+
+class _State:
+    index = None
+    snapshot_mtime = None
+    journal_offset = 0
+    # File del journal a cui si riferisce l'offset: cambia quando rebuild_index lo ruota
+    journal_id = None
+
+
+_state = _State()
+_lock = threading.Lock()
+
+
+def _snapshot_path():
+    return str(settings.SEARCH_INDEX_PATH)
+
+
+def _journal_path():
+    return f'{_snapshot_path()}.journal'
+
+
+def _journal_size():
+    try:
+        return os.path.getsize(_journal_path())
+    except OSError:
+        return 0
+
+
+def _journal_id():
+    try:
+        stat = os.stat(_journal_path())
+    except OSError:
+        return None
+    return stat.st_dev, stat.st_ino
+
+
+def _append_journal(entry):
+    # Una riga per modifica, in append: più processi possono scrivere senza lock
+    line = json.dumps(entry, separators=(',', ':')) + '\n'
+    os.makedirs(os.path.dirname(_journal_path()) or '.', exist_ok=True)
+    with open(_journal_path(), 'a', encoding='utf-8') as handle:
+        handle.write(line)
+
+
+def _replay_journal(index, offset):
+    """ Applica le righe del journal a partire da `offset`; restituisce il nuovo offset. """
+    try:
+        handle = open(_journal_path(), 'rb')
+    except OSError:
+        return offset
+    with handle:
+        handle.seek(offset)
+        for line in handle:
+            if not line.endswith(b'\n'):
+                # Riga ancora in scrittura da un altro processo: la rileggeremo la prossima volta
+                break
+            offset += len(line)
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            if 'terms' in entry:
+                index.add(entry['id'], entry['terms'])
+            else:
+                index.remove(entry['id'])
+    return offset
+
+
+def _load_snapshot():
+    with open(_snapshot_path(), 'rb') as handle:
+        data = pickle.load(handle)
+    index = SearchIndex()
+    index.postings = data['postings']
+    index.documents = data['documents']
+    return index, data['journal_offset'], data.get('journal_id')
+
+
+def rebuild_index():
+    """
+    Ricostruisce l'indice leggendo tutti i prodotti dal DB e lo salva su disco.
+    Restituisce il numero di prodotti indicizzati.
+    """
+    from .models import Product
+
+    # Le modifiche già nel journal finiscono nello snapshot (sono state salvate prima della lettura):
+    # il journal viene sostituito da uno vuoto, così non cresce all'infinito e l'avvio non lo rilegge tutto.
+    # Le modifiche registrate durante la lettura vanno nel nuovo journal e vengono riapplicate al caricamento
+    journal = _journal_path()
+    os.makedirs(os.path.dirname(journal) or '.', exist_ok=True)
+    rotated = f'{journal}.rotated'
+    try:
+        os.replace(journal, rotated)
+    except FileNotFoundError:
+        rotated = None
+    open(journal, 'a').close()
+    journal_id = _journal_id()
+    index = SearchIndex()
+    products = Product.objects.select_related('category').only(
+        'id', 'name', 'description', 'category__name'
+    )
+    for product in products.iterator(chunk_size=2000):
+        index.add(product.id, product_terms(product))
+    path = _snapshot_path()
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as handle:
+        pickle.dump({
+            'postings': index.postings,
+            'documents': index.documents,
+            'journal_offset': 0,
+            'journal_id': journal_id,
+        }, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    # Sostituzione atomica: gli altri processi vedono il vecchio o il nuovo snapshot, mai un file a metà
+    os.replace(tmp, path)
+    if rotated:
+        os.remove(rotated)
+    return len(index)
+
+
+def get_index():
+    """ Indice aggiornato del processo corrente (costruito al primo uso se manca lo snapshot). """
+    with _lock:
+        try:
+            mtime = os.stat(_snapshot_path()).st_mtime_ns
+        except OSError:
+            mtime = None
+        if _state.index is None or mtime != _state.snapshot_mtime:
+            if mtime is None:
+                # Gli altri thread aspettano sul lock invece di costruirlo anche loro
+                logger.info('Indice di ricerca assente: lo costruisco dal database')
+                rebuild_index()
+                mtime = os.stat(_snapshot_path()).st_mtime_ns
+            _state.index, _state.journal_offset, _state.journal_id = _load_snapshot()
+            _state.snapshot_mtime = mtime
+        journal_id = _journal_id()
+        if journal_id != _state.journal_id:
+            # Journal ruotato da rebuild_index di un altro processo: le righe del nuovo sono tutte da applicare
+            _state.journal_id = journal_id
+            _state.journal_offset = 0
+        if _journal_size() > _state.journal_offset:
+            _state.journal_offset = _replay_journal(_state.index, _state.journal_offset)
+        return _state.index
+
+
+def _append_on_commit(entry):
+    """ Scrive la riga del journal dopo il commit: un salvataggio annullato non arriva all'indice. """
+    def append():
+        try:
+            _append_journal(entry)
+        except OSError:
+            logger.warning('Impossibile aggiornare l\'indice di ricerca per il prodotto %s', entry['id'], exc_info=True)
+    transaction.on_commit(append)
+
+
+def index_product(product):
+    """ Aggiorna il prodotto nell'indice (chiamata dal segnale post_save). """
+    # Termini calcolati subito: dopo il commit l'istanza potrebbe essere già stata modificata
+    _append_on_commit({'id': product.id, 'terms': product_terms(product)})
+
+
+def remove_product(product_id):
+    """ Toglie il prodotto dall'indice (chiamata dal segnale post_delete). """
+    _append_on_commit({'id': product_id})
+
+
+def search_products(query, limit=None):
+    """ ID dei prodotti che corrispondono a `query`, ordinati per rilevanza. """
+    return get_index().search(query, limit=limit)
+
+
+"""
+Perché un indice invertito invece di icontains: `name__icontains` con LIKE '%...%'
+non può usare indici e legge tutta la tabella prodotti a ogni ricerca; inoltre
+"giacche" non trova "giacca" e "citta" non trova "città".
+Qui ogni parola viene normalizzata (minuscolo, senza accenti, stemming leggero)
+e l'indice associa a ogni termine i prodotti che lo contengono: la ricerca legge
+solo le liste dei termini cercati, in memoria.
+
+Funziona con qualunque database (SQLite in sviluppo, MySQL/PostgreSQL in produzione).
+L'indice si aggiorna da solo ai salvataggi dall'admin (signals.py), dopo il commit;
+dopo import massivi o modifiche fatte con update() si ricostruisce con:
+    python manage.py rebuild_search_index
+che svuota anche il journal: lanciato ogni notte (es. con cron) tiene breve la sua
+rilettura all'avvio dei processi.
+Il percorso dei file è SEARCH_INDEX_PATH nei settings.
+"""
@@ -0,0 +1,76 @@
+import logging
+
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .cart_storage import merge_anonymous_cart
+from . import inventory
+from .catalog_cache import bump_catalog_version
+from .models import Category, Product
+from .renditions import generate_renditions, renditions_available
+from .search import index_product, remove_product
+
+logger = logging.getLogger(__name__)
+
+
+@receiver(user_logged_in)
+def merge_cart_on_login(sender, request, user, **kwargs):
+    """ Unisce il carrello dell'ospite a quello persistente dell'utente appena loggato. """
+    merge_anonymous_cart(request, user)
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_catalog_cache(sender, **kwargs):
+    """
+    Qualsiasi modifica a prodotti o categorie (admin, anche list_editable, o codice)
+    rende obsoleti i frammenti del catalogo in cache.
+    """
+    bump_catalog_version()
+
+
+@receiver(post_save, sender=Product)
+def record_stock_change(sender, instance, created, **kwargs):
+    """
+    Prodotto nuovo (admin o codice): lo stock iniziale è un rifornimento e crea le righe del contatore.
+    Le modifiche successive passano da inventory.adjust_stock (admin) o set_stocks (import),
+    mai dal valore salvato nella riga, che può essere una fotografia vecchia.
+    """
+    if created:
+        inventory.set_stocks({instance.pk: instance.stock}, kind=inventory.RESTOCK, previous={instance.pk: 0})
+
+
+@receiver(post_save, sender=Product)
+def create_image_renditions(sender, instance, **kwargs):
+    """ Alla prima apparizione di una nuova immagine genera le sue versioni ridotte (JPEG/WebP). """
+    name = instance.image.name
+    if name and not renditions_available(name):
+        try:
+            generate_renditions(name)
+        except OSError:
+            # Immagine illeggibile: il prodotto resta salvato, la vetrina userà l'originale
+            logger.warning('Impossibile generare le versioni ridotte di %s', name, exc_info=True)
+
+
+@receiver(post_save, sender=Product)
+def update_search_index(sender, instance, **kwargs):
+    """ Aggiorna il prodotto nell'indice di ricerca (nome, descrizione, categoria), dopo il commit. """
+    index_product(instance)
+
+
+@receiver(post_delete, sender=Product)
+def remove_from_search_index(sender, instance, **kwargs):
+    remove_product(instance.pk)
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created, **kwargs):
+    """ Il nome della categoria fa parte del testo indicizzato: se cambia vanno reindicizzati i suoi prodotti. """
+    if created:
+        return
+    for product in instance.products.only('id', 'name', 'description', 'category'):
+        product.category = instance
+        index_product(product)
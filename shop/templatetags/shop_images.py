@@ -0,0 +1,34 @@
+from django import template
+
+from shop import renditions
+
+register = template.Library()
+
+
+@register.simple_tag
+def srcset(image, fmt='jpg'):
+    """ {% srcset product.image 'webp' %} -> "url 160w, url 400w, ..." ('' se le versioni non esistono). """
+    return renditions.srcset(image.name, fmt) if image else ''
+
+
+@register.simple_tag
+def rendition_url(image, width, fmt='jpg'):
+    """ {% rendition_url product.image 400 %} -> URL della versione larga almeno 400px. """
+    return renditions.rendition_url(image.name, width, fmt) if image else ''
+
+
+@register.inclusion_tag('shop/partials/picture.html')
+def product_picture(image, alt='', width=400, sizes='100vw', css_class='', style=''):
+    """
+    <picture> con sorgente WebP e fallback JPEG: il browser sceglie la larghezza adatta
+    tramite srcset/sizes. Senza versioni ridotte mostra l'originale.
+    """
+    return {
+        'src': renditions.rendition_url(image.name, width),
+        'webp_srcset': renditions.srcset(image.name, 'webp'),
+        'jpg_srcset': renditions.srcset(image.name, 'jpg'),
+        'alt': alt,
+        'sizes': sizes,
+        'css_class': css_class,
+        'style': style,
+    }
@@ -0,0 +1,76 @@
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudgetExceeded(AssertionError):
+    """ Una vista ha fatto più query del suo budget, o un numero di query che cresce con i dati (N+1). """
+
+
+def _listing(context):
+    return '\n'.join(f'  {index}. {query["sql"]}' for index, query in enumerate(context.captured_queries, 1))
+
+
+@contextmanager
+def query_budget(budget, label='', using=DEFAULT_DB_ALIAS):
+    """
+    Fallisce se il blocco fa più di `budget` query:
+
+        with query_budget(3, 'catalogo'):
+            client.get('/')
+    """
+    with CaptureQueriesContext(connections[using]) as context:
+        yield context
+    if len(context) > budget:
+        raise QueryBudgetExceeded(f'{label or "blocco"}: {len(context)} query, budget {budget}\n{_listing(context)}')
+
+
+def assert_query_budget(client, url, budget, method='get', data=None, using=DEFAULT_DB_ALIAS):
+    """ Richiesta con il test client entro `budget` query; restituisce la risposta. """
+    with query_budget(budget, f'{method.upper()} {url}', using):
+        response = getattr(client, method)(url, data or {})
+    return response
+
+
+def assert_constant_queries(client, url, budget, populate, sizes=(1, 20), before_request=None, using=DEFAULT_DB_ALIAS):
+    """
+    Verifica che `url` faccia lo stesso numero di query, entro `budget`, qualunque sia la quantità
+    di dati: per ogni n di `sizes` chiama populate(n) (es. crea n prodotti), poi before_request()
+    se indicato (es. svuota la cache) e misura la pagina. Restituisce {n: query}.
+    """
+    counts = {}
+    contexts = {}
+    for size in sizes:
+        populate(size)
+        if before_request is not None:
+            before_request()
+        with CaptureQueriesContext(connections[using]) as context:
+            response = client.get(url)
+        if response.status_code != 200:
+            raise AssertionError(f'GET {url} con {size} righe: risposta {response.status_code}')
+        counts[size] = len(context)
+        contexts[size] = context
+    largest = max(sizes)
+    if len(set(counts.values())) > 1:
+        raise QueryBudgetExceeded(
+            f'GET {url}: le query crescono con i dati {counts} (query ripetute per ogni riga?)\n'
+            f'{_listing(contexts[largest])}'
+        )
+    if counts[largest] > budget:
+        raise QueryBudgetExceeded(f'GET {url}: {counts[largest]} query, budget {budget}\n{_listing(contexts[largest])}')
+    return counts
+
+
+"""
+Budget di query per i test e la CI. Esempio in un TestCase:
+
+    from shop.testing import assert_constant_queries
+
+    def test_catalogo(self):
+        assert_constant_queries(self.client, '/', 6, populate=crea_prodotti, before_request=cache.clear)
+
+Il comando check_query_budgets applica i budget di QUERY_BUDGETS (check_query_budgets.py)
+alle viste principali su dati di prova creati e annullati in una transazione, e termina
+con errore se una vista li supera: si può lanciare in CI senza una suite di test.
+"""
@@ -0,0 +1,1002 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core import mail
+from django.core.management import call_command
+from django.db import OperationalError, connection, transaction
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from shop import (
+    admission, catalog_cache, idempotency, inventory, jobs, metrics, notifications, payments, renditions, reservations,
+    search,
+)
+from shop.cart import Cart
+from shop.checkout import OutOfStock, place_order
+from shop.facets import FacetSelection, compute_counts, newest_cutoff
+from shop.management.commands.check_query_budgets import QUERY_BUDGETS
+from shop.models import Category, Job, Order, OrderItem, Product, StockReservation, WebhookEvent
+from shop.pagination import InvalidCursor, KeysetPaginator
+from shop.testing import assert_constant_queries, query_budget
+
+# Indice di ricerca dei test in una cartella temporanea, non in quella del sito
+SEARCH_DIR = tempfile.mkdtemp(prefix='shop-tests-')
+
+
+def tearDownModule():
+    shutil.rmtree(SEARCH_DIR, ignore_errors=True)
+
+
+def make_products(count, stock=100, category=None, first=0):
+    category = category or Category.objects.get_or_create(name='Abiti', slug='abiti')[0]
+    return [
+        Product.objects.create(category=category, name=f'Abito {i}', slug=f'abito-{i}', price=Decimal('25.00'), stock=stock)
+        for i in range(first, first + count)
+    ]
+
+
+def make_cart(lines):
+    """ Carrello di sessione con le righe [(prodotto, quantità)], come dopo le aggiunte dalla vetrina. """
+    request = RequestFactory().get('/')
+    request.session = SessionStore()
+    request.user = AnonymousUser()
+    cart = Cart(request)
+    for product, quantity in lines:
+        cart.add(product, quantity)
+    return cart
+
+
+def make_order():
+    return Order(first_name='Anna', last_name='Bianchi', email='anna@example.com',
+                 address='Via Roma 1', postal_code='00100', city='Roma')
+
+
+@override_settings(SEARCH_INDEX_PATH=f'{SEARCH_DIR}/products.pickle')
+class ShopTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+
+# --- CHECKOUT (checkout.place_order) ---
+@override_settings(SEARCH_INDEX_PATH=f'{SEARCH_DIR}/products.pickle')
+class ConcurrentCheckoutTests(TransactionTestCase):
+    """ Checkout contemporanei sugli ultimi pezzi: mai più pezzi venduti di quelli in magazzino. """
+
+    def test_parallel_checkouts_do_not_oversell(self):
+        product, = make_products(1, stock=3)
+        buyers = 8
+        results = []
+        barrier = threading.Barrier(buyers)
+
+        def buy():
+            cart = make_cart([(product, 1)])
+            barrier.wait()
+            try:
+                for _ in range(100):
+                    try:
+                        place_order(make_order(), cart)
+                        results.append('ok')
+                    except OutOfStock:
+                        results.append('out of stock')
+                    except OperationalError:
+                        # SQLite: un solo scrittore alla volta, chi non ottiene il lock riprova
+                        time.sleep(0.01)
+                        continue
+                    return
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=buy) for _ in range(buyers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        sold = sum(OrderItem.objects.filter(product=product).values_list('quantity', flat=True))
+        # Chi ha trovato il magazzino vuoto ha ricevuto OutOfStock: nessuno è rimasto in attesa
+        self.assertEqual(len(results), buyers)
+        self.assertIn('out of stock', results)
+        self.assertEqual(sold, 3)
+        self.assertEqual(Order.objects.count(), 3)
+        self.assertEqual(inventory.available_to_sell([product.id])[product.id], 0)
+
+
+class CheckoutQueryTests(ShopTestCase):
+
+    def test_query_count_does_not_depend_on_cart_lines(self):
+        products = make_products(10)
+        with CaptureQueriesContext(connection) as single:
+            place_order(make_order(), make_cart([(products[0], 2)]))
+        for size in (5, 10):
+            cart = make_cart([(product, 2) for product in products[:size]])
+            with self.assertNumQueries(len(single)):
+                place_order(make_order(), cart)
+
+
+# --- TOTALI DEGLI ORDINI (Order.total_cost, item_count) ---
+class OrderTotalsTests(ShopTestCase):
+
+    def test_checkout_stores_the_totals(self):
+        products = make_products(2)
+        order = place_order(make_order(), make_cart([(products[0], 2), (products[1], 1)]))
+        order.refresh_from_db()
+        self.assertEqual((order.total_cost, order.item_count), (Decimal('75.00'), 3))
+
+    def test_backfill_fills_old_orders_in_batches(self):
+        product, = make_products(1)
+        # Ordini creati prima dei campi denormalizzati: totali a zero
+        orders = []
+        for quantity in (1, 2, 3):
+            order = make_order()
+            order.save()
+            OrderItem.objects.create(order=order, product=product, price=Decimal('10.00'), quantity=quantity)
+            orders.append(order)
+        out = StringIO()
+        call_command('backfill_order_totals', batch_size=2, stdout=out)
+        self.assertIn('Completato: 3 ordini aggiornati.', out.getvalue())
+        self.assertEqual(
+            [(order.total_cost, order.item_count) for order in Order.objects.order_by('id')],
+            [(Decimal('10.00'), 1), (Decimal('20.00'), 2), (Decimal('30.00'), 3)],
+        )
+        # Di nuovo: non c'è più niente da calcolare
+        out = StringIO()
+        call_command('backfill_order_totals', stdout=out)
+        self.assertIn('Completato: 0 ordini aggiornati.', out.getvalue())
+
+
+# --- FRAMMENTI DEL CATALOGO IN CACHE (catalog_cache.py) ---
+class CatalogCacheTests(ShopTestCase):
+
+    def check_invalidation(self):
+        product, = make_products(1)
+        version = catalog_cache.get_catalog_version()
+        self.assertContains(self.client.get(reverse('shop:product_list')), 'Abito 0')
+        # Seconda visita: i frammenti arrivano dalla cache, con meno query
+        with CaptureQueriesContext(connection) as first:
+            self.client.get(reverse('shop:product_list'))
+        product.name = 'Gonna a pieghe'
+        product.save()
+        self.assertGreater(catalog_cache.get_catalog_version(), version)
+        with CaptureQueriesContext(connection) as after_save:
+            response = self.client.get(reverse('shop:product_list'))
+        self.assertContains(response, 'Gonna a pieghe')
+        self.assertNotContains(response, 'Abito 0')
+        self.assertGreater(len(after_save), len(first))
+        version = catalog_cache.get_catalog_version()
+        product.category.delete()
+        self.assertGreater(catalog_cache.get_catalog_version(), version)
+
+    def test_save_and_delete_bump_the_version(self):
+        self.check_invalidation()
+
+    def test_file_based_cache(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        with self.settings(CACHES={'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory,
+        }}):
+            self.check_invalidation()
+            self.assertTrue(os.listdir(directory))
+
+
+# --- PAGINE PUBBLICHE DEL CATALOGO (SHOP_PERSONALIZATION = 'client') ---
+@override_settings(SHOP_PERSONALIZATION='client')
+class PublicCatalogTests(ShopTestCase):
+
+    def assert_public(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('public', response['Cache-Control'])
+        self.assertNotIn('Cookie', response.get('Vary', ''))
+
+    def test_catalog_pages_are_public_with_every_cart_storage(self):
+        product, = make_products(1)
+        for storage in ('shop.cart_storage.SessionCartStorage', 'shop.cart_storage.DatabaseCartStorage'):
+            with self.subTest(storage=storage), self.settings(CART_STORAGE=storage):
+                self.assert_public(reverse('shop:product_list'))
+                self.assert_public(product.get_absolute_url())
+
+    def test_personal_parts_come_from_the_session_endpoint(self):
+        product, = make_products(1)
+        response = self.client.get(reverse('shop:product_list'))
+        # Nessun cookie: la stessa risposta va bene per tutti i visitatori
+        self.assertFalse(response.cookies)
+        self.assertEqual(self.client.get(reverse('shop:session_state')).json()['cart_count'], 0)
+        self.client.post(reverse('shop:cart_add', args=[product.id]), {'quantity': 2, 'override': False})
+        state = self.client.get(reverse('shop:session_state'))
+        self.assertIn('no-cache', state['Cache-Control'])
+        self.assertEqual(state.json()['cart_count'], 2)
+        self.assertFalse(state.json()['authenticated'])
+
+
+# --- CARRELLO IDRATATO (Cart.hydrate) ---
+class CartHydrationTests(ShopTestCase):
+
+    def test_products_are_loaded_once_per_request(self):
+        products = make_products(3)
+        cart = make_cart([(products[0], 1), (products[1], 2), (products[2], 3)])
+        payload = json.dumps(cart.cart, sort_keys=True)
+        with self.assertNumQueries(1):
+            lines = list(cart)
+            list(cart)
+            total = cart.get_total_price()
+            self.assertEqual(len(cart), 6)
+        self.assertEqual(total, Decimal('150.00'))
+        self.assertEqual([line.total_price for line in lines], [Decimal('25.00'), Decimal('50.00'), Decimal('75.00')])
+        # Il dizionario in sessione resta serializzabile: niente Product né Decimal aggiunti
+        self.assertEqual(json.dumps(cart.cart, sort_keys=True), payload)
+        # Una modifica invalida il risultato memorizzato
+        cart.remove(products[0])
+        with self.assertNumQueries(1):
+            self.assertEqual(cart.get_total_price(), Decimal('125.00'))
+
+
+# --- NAVIGAZIONE ANONIMA SENZA SESSIONE (cart.py) ---
+class AnonymousSessionTests(ShopTestCase):
+
+    def test_browsing_never_creates_a_session(self):
+        product, = make_products(1)
+        for url in (reverse('shop:product_list'), product.get_absolute_url(), reverse('shop:cart_detail')):
+            with self.subTest(url=url), CaptureQueriesContext(connection) as context:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+            self.assertFalse([q['sql'] for q in context.captured_queries if 'django_session' in q['sql']])
+        # La sessione nasce alla prima aggiunta al carrello
+        response = self.client.post(reverse('shop:cart_add', args=[product.id]), {'quantity': 1, 'override': False})
+        self.assertIn(settings.SESSION_COOKIE_NAME, response.cookies)
+
+
+# --- VERSIONI RIDOTTE DELLE IMMAGINI (renditions.py) ---
+class RenditionTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.media = tempfile.mkdtemp(prefix='shop-media-')
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        storage = override_settings(MEDIA_ROOT=self.media)
+        storage.enable()
+        self.addCleanup(storage.disable)
+
+    def save_image(self, width, height):
+        buffer = BytesIO()
+        Image.new('RGB', (width, height), (200, 30, 30)).save(buffer, 'JPEG')
+        return default_storage.save('products/foto.jpg', ContentFile(buffer.getvalue()))
+
+    @override_settings(PRODUCT_IMAGE_WIDTHS=[160, 400, 800, 1200], PRODUCT_IMAGE_FORMATS=['webp', 'jpg'])
+    def test_small_original_is_never_advertised_wider_than_it_is(self):
+        name = self.save_image(300, 200)
+        renditions.generate_renditions(name)
+        cache.clear()
+        self.assertEqual(renditions.available_widths(name), [160, 300])
+        srcset = renditions.srcset(name, 'webp')
+        self.assertTrue(srcset.endswith('_300w.webp 300w'), srcset)
+        self.assertNotIn('1200w', srcset)
+        self.assertFalse(default_storage.exists(renditions.rendition_name(name, 400, 'jpg')))
+        with Image.open(default_storage.open(renditions.rendition_name(name, 300, 'jpg'))) as image:
+            self.assertEqual(image.width, 300)
+
+
+# --- RICERCA (search.py) ---
+class SearchIndexTests(ShopTestCase):
+
+    def test_rolled_back_save_is_not_indexed(self):
+        search.rebuild_index()
+        with self.captureOnCommitCallbacks(execute=True):
+            try:
+                with transaction.atomic():
+                    make_products(1)
+                    raise RuntimeError
+            except RuntimeError:
+                pass
+        self.assertEqual(search.get_index().search('abito'), [])
+        with self.captureOnCommitCallbacks(execute=True):
+            product, = make_products(1)
+        self.assertEqual(search.get_index().search('abito'), [product.id])
+
+    def test_rebuild_empties_the_journal(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            product, = make_products(1)
+        self.assertGreater(os.path.getsize(search._journal_path()), 0)
+        search.rebuild_index()
+        self.assertEqual(os.path.getsize(search._journal_path()), 0)
+        self.assertEqual(search.get_index().search('abito'), [product.id])
+
+
+# --- AUTOCOMPLETAMENTO (autocomplete.py) ---
+class AutocompleteTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        abiti = Category.objects.create(name='Abiti', slug='abiti')
+        giacche = Category.objects.create(name='Giacche', slug='giacche')
+        for name, category, sold, available in [
+            ('Abito in lino', abiti, 5, True), ('Abito lungo', abiti, 1, True),
+            ('Giacca di lino', giacche, 0, True), ('Abito nascosto', abiti, 9, False),
+        ]:
+            Product.objects.create(category=category, name=name, slug=name.lower().replace(' ', '-'),
+                                   price=Decimal('40.00'), stock=1, sold=sold, available=available)
+
+    def names(self, query):
+        response = self.client.get(reverse('shop:product_autocomplete'), {'q': query})
+        return [result['name'] for result in response.json()['results']]
+
+    def test_prefix_suggestions(self):
+        # Prima le categorie, poi i prodotti più venduti; quelli non disponibili non compaiono
+        self.assertEqual(self.names('abi'), ['Abiti', 'Abito in lino', 'Abito lungo'])
+        # Inizio di una parola qualsiasi del nome, senza accenti né maiuscole
+        self.assertEqual(self.names('LÌN'), ['Abito in lino', 'Giacca di lino'])
+        self.assertEqual(self.names('abito li'), ['Abito in lino'])
+        self.assertEqual(self.names('zzz'), [])
+        # Indice in memoria: i tasti successivi non toccano il database
+        with self.assertNumQueries(0):
+            self.names('gia')
+
+
+# --- FILTRI DELLA VETRINA (facets.py) ---
+@override_settings(CATALOG_PRICE_BANDS=[(None, 50), (50, 100), (100, 200), (200, None)])
+class FacetCountTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.abiti = Category.objects.create(name='Abiti', slug='abiti')
+        self.giacche = Category.objects.create(name='Giacche', slug='giacche')
+        for slug, category, price, stock in [
+            ('abito-corto', self.abiti, '30', 5), ('abito-lungo', self.abiti, '80', 0),
+            ('abito-sera', self.abiti, '150', 2), ('giacca', self.giacche, '60', 1),
+        ]:
+            Product.objects.create(category=category, name=slug, slug=slug, price=Decimal(price), stock=stock)
+        Product.objects.create(category=self.abiti, name='ritirato', slug='ritirato', price=Decimal('30'),
+                               stock=1, available=False)
+
+    def counts(self, **selection):
+        with self.assertNumQueries(1):
+            return compute_counts(FacetSelection(**selection), newest_cutoff())
+
+    def test_each_count_applies_the_other_filters(self):
+        counts = self.counts(price='50-100')
+        # Categorie e disponibilità rispettano la fascia scelta, le fasce no (mostrano le alternative)
+        self.assertEqual(counts['category'], {self.abiti.id: 1, self.giacche.id: 1})
+        self.assertEqual(counts['price'], {'-50': 1, '50-100': 2, '100-200': 1, '200-': 0})
+        self.assertEqual((counts['in_stock'], counts['new'], counts['total']), (1, 2, 2))
+
+    def test_selected_category_limits_the_other_counts(self):
+        counts = self.counts(category=self.abiti, in_stock=True)
+        self.assertEqual(counts['category'], {self.abiti.id: 2, self.giacche.id: 1})
+        self.assertEqual(counts['price'], {'-50': 1, '50-100': 0, '100-200': 1, '200-': 0})
+        self.assertEqual((counts['in_stock'], counts['total']), (2, 2))
+
+
+# --- INDICI E BUDGET DI QUERY (comandi check_*) ---
+class CatalogIndexTests(ShopTestCase):
+
+    def test_every_catalog_query_uses_an_index(self):
+        # CommandError (test fallito) se una migrazione toglie un indice usato dalla vetrina
+        call_command('check_catalog_indexes', stdout=StringIO())
+
+
+class QueryBudgetTests(ShopTestCase):
+    """ Budget di QUERY_BUDGETS sulle pagine principali, con pochi e molti prodotti o righe. """
+
+    def fill_cart(self, client, products):
+        for product in products:
+            client.post(reverse('shop:cart_add', args=[product.id]), {'quantity': 1})
+
+    def test_catalog_pages(self):
+        products = []
+
+        def add_products(n):
+            products[len(products):] = make_products(n - len(products), first=len(products))
+
+        add_products(1)
+        for name, url in (('product_list', reverse('shop:product_list')),
+                          ('product_detail', products[0].get_absolute_url())):
+            with self.subTest(view=name):
+                assert_constant_queries(self.client, url, QUERY_BUDGETS[name], add_products, before_request=cache.clear)
+
+    def test_cart_page(self):
+        products = make_products(20)
+        assert_constant_queries(
+            self.client, reverse('shop:cart_detail'), QUERY_BUDGETS['cart_detail'],
+            lambda n: self.fill_cart(self.client, products[:n]), before_request=cache.clear,
+        )
+
+    def test_checkout(self):
+        products = make_products(10)
+        counts = {}
+        for size in (1, 10):
+            client = Client()
+            self.fill_cart(client, products[:size])
+            data = {'first_name': 'Anna', 'last_name': 'Bianchi', 'email': 'anna@example.com', 'address': 'Via Roma 1',
+                    'postal_code': '00100', 'city': 'Roma', 'payment_method': 'cash', 'idempotency_key': uuid.uuid4().hex}
+            with query_budget(QUERY_BUDGETS['order_create'], f'checkout con {size} righe') as context:
+                response = client.post(reverse('shop:order_create'), data)
+            self.assertEqual(Order.objects.filter(item_count=size).count(), 1, response.content[:500])
+            counts[size] = len(context)
+        self.assertEqual(counts[1], counts[10])
+
+
+# --- CONTROLLO DEGLI INGRESSI (admission.py) ---
+class AdmissionTests(ShopTestCase):
+
+    def test_bucket_refills_at_rate_up_to_burst(self):
+        config = {'rate': 10, 'burst': 3}
+        with mock.patch('shop.admission.time.time', return_value=1000.0) as clock:
+            self.assertEqual([admission.take_token(config) for _ in range(4)], [True, True, True, False])
+            # Un gettone ogni 1/rate secondi, non tutto il secchio allo scadere di una finestra
+            clock.return_value = 1000.1
+            self.assertEqual([admission.take_token(config) for _ in range(2)], [True, False])
+            # Dopo una lunga pausa il secchio è pieno, ma mai oltre `burst`
+            clock.return_value = 2000.0
+            self.assertEqual([admission.take_token(config) for _ in range(4)], [True, True, True, False])
+
+    def test_expired_slot_taken_by_another_request_is_not_released(self):
+        config = {'max_concurrent': 1}
+        mine = admission.acquire_slot(config)
+        # Lease scaduto (SLOT_TIMEOUT) e posto preso da un'altra richiesta
+        cache.delete(mine[0])
+        other = admission.acquire_slot(config)
+        admission.release_slot(mine)
+        self.assertIsNone(admission.acquire_slot(config))
+        admission.release_slot(other)
+        self.assertIsNotNone(admission.acquire_slot(config))
+
+
+# --- INVII DOPPI DEL CHECKOUT (idempotency.py) ---
+class CheckoutIdempotencyTests(ShopTestCase):
+
+    def test_resubmit_during_checkout_does_not_wait(self):
+        token = uuid.uuid4().hex
+        self.assertIsNone(idempotency.begin(token))
+        started = time.monotonic()
+        self.assertEqual(idempotency.begin(token), idempotency.PENDING)
+        self.assertLess(time.monotonic() - started, 0.1)
+        response = self.client.get(reverse('shop:order_pending', args=[token]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Refresh'], '2')
+        order = make_order()
+        order.save()
+        idempotency.finish(token, order.id)
+        self.assertEqual(idempotency.begin(token), order.id)
+        response = self.client.get(reverse('shop:order_pending', args=[token]))
+        self.assertContains(response, f'{order.id}')
+
+    def test_failed_first_submit_sends_back_to_cart(self):
+        token = uuid.uuid4().hex
+        idempotency.begin(token)
+        idempotency.abort(token)
+        response = self.client.get(reverse('shop:order_pending', args=[token]))
+        self.assertRedirects(response, reverse('shop:cart_detail'))
+        self.assertIsNone(idempotency.begin(token))
+
+
+# --- PAGAMENTI (payments.py) ---
+class PaymentTestCase(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.product, = make_products(1, stock=5)
+        order = make_order()
+        order.payment_method = 'card'
+        place_order(order, make_cart([(self.product, 2)]))
+        self.order = order
+        self.gateway = payments.FakeGateway()
+        payments.start_payment(order, self.gateway)
+
+
+class FakePaymentTests(PaymentTestCase):
+
+    def pay(self, client):
+        return client.post(reverse('shop:order_pay_fake', args=[self.order.id]))
+
+    def test_only_the_session_that_placed_the_order_can_pay_it(self):
+        self.assertEqual(self.pay(self.client).status_code, 404)
+        session = self.client.session
+        session[settings.ORDERS_SESSION_ID] = [self.order.id]
+        session.save()
+        self.assertEqual(self.pay(self.client).status_code, 302)
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+
+    def test_payment_page_only_for_the_owner(self):
+        url = reverse('shop:order_pay', args=[self.order.id])
+        self.assertEqual(self.client.get(url).status_code, 404)
+        session = self.client.session
+        session[settings.ORDERS_SESSION_ID] = [self.order.id]
+        session.save()
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    @override_settings(PAYMENT_FAKE_ENABLED=False)
+    def test_fake_gateway_needs_explicit_opt_in(self):
+        session = self.client.session
+        session[settings.ORDERS_SESSION_ID] = [self.order.id]
+        session.save()
+        self.assertEqual(self.pay(self.client).status_code, 404)
+        with self.assertRaises(ImproperlyConfigured):
+            payments.check_gateway()
+        with self.settings(PAYMENT_GATEWAY='shop.payments.StripeGateway'):
+            payments.check_gateway()
+
+
+class StripeWebhookTests(PaymentTestCase):
+    """ Eventi firmati inviati alla vista del webhook, poi elaborati come farebbe run_jobs. """
+
+    def post(self, payload, signature=None):
+        return self.client.post(
+            reverse('shop:stripe_webhook'), payload, content_type='application/json',
+            HTTP_STRIPE_SIGNATURE=signature or self.gateway.sign(payload),
+        )
+
+    def deliver(self, event_type, **fields):
+        payload = self.gateway.event(event_type, self.order, **fields)
+        self.assertEqual(self.post(payload).status_code, 200)
+        payments.process_event(json.loads(payload)['id'])
+        self.order.refresh_from_db()
+        return payload
+
+    def test_valid_signature_marks_order_paid(self):
+        self.deliver('payment_intent.succeeded')
+        self.assertTrue(self.order.paid)
+        self.assertEqual(self.order.status, 'processing')
+
+    def test_invalid_signature_is_rejected(self):
+        payload = self.gateway.event('payment_intent.succeeded', self.order)
+        forged = self.gateway.sign(self.gateway.event('payment_intent.canceled', self.order))
+        self.assertEqual(self.post(payload, forged).status_code, 400)
+        self.assertEqual(self.post(payload, 't=1,v1=0').status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+    def test_duplicate_event_is_applied_once(self):
+        payload = self.deliver('payment_intent.canceled')
+        self.assertEqual(self.post(payload).status_code, 200)
+        payments.process_event(json.loads(payload)['id'])
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        self.assertEqual(self.order.stock_movements.filter(kind=inventory.CANCELLATION).count(), 1)
+
+    def test_wrong_amount_does_not_mark_order_paid(self):
+        with self.assertLogs('shop.payments', 'ERROR'):
+            self.deliver('payment_intent.succeeded', amount_received=payments.to_cents(self.order.total_cost) - 100)
+        self.assertFalse(self.order.paid)
+        self.assertIsNotNone(WebhookEvent.objects.get().processed_at)
+
+    def test_payment_after_cancellation_is_flagged_for_refund(self):
+        self.deliver('payment_intent.canceled')
+        with self.assertLogs('shop.payments', 'ERROR'):
+            self.deliver('payment_intent.succeeded')
+        self.assertFalse(self.order.paid)
+        self.assertEqual(self.order.status, 'cancelled')
+        self.assertTrue(self.order.refund_required)
+
+    def test_unpaid_order_expires_and_returns_stock(self):
+        job = Job.objects.get(task='shop.payments.expire_order')
+        self.assertEqual(job.kwargs, {'order_id': self.order.id})
+        self.assertGreater(job.run_after, self.order.created + timedelta(seconds=settings.PAYMENT_EXPIRY - 5))
+        payments.expire_order(self.order.id)
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.status, 'cancelled')
+        self.assertEqual(inventory.available_to_sell([self.product.id])[self.product.id], 5)
+        # Il pagamento pagato in tempo non viene toccato dal lavoro di scadenza
+        paid = make_order()
+        paid.payment_method = 'card'
+        place_order(paid, make_cart([(self.product, 1)]))
+        Order.objects.filter(id=paid.id).update(paid=True)
+        payments.expire_order(paid.id)
+        paid.refresh_from_db()
+        self.assertEqual(paid.status, 'pending')
+
+    def test_cancel_returns_stock(self):
+        self.assertEqual(inventory.available_to_sell([self.product.id])[self.product.id], 3)
+        self.deliver('payment_intent.canceled')
+        self.assertEqual(self.order.status, 'cancelled')
+        self.assertFalse(self.order.paid)
+        self.assertEqual(inventory.available_to_sell([self.product.id])[self.product.id], 5)
+
+
+# --- REGISTRO DI MAGAZZINO E CONTATORE DIVISO (inventory.py) ---
+class InventoryLedgerTests(ShopTestCase):
+
+    def assert_consistent(self, product, stock, sold):
+        product.refresh_from_db()
+        movements = product.stock_movements.all()
+        self.assertEqual((product.stock, product.sold), (stock, sold))
+        # Fotografia = somma di tutti i movimenti, tutti compattati; pezzi liberi = fotografia - prenotazioni
+        self.assertEqual(sum(movement.quantity for movement in movements), stock)
+        self.assertFalse(movements.filter(compacted=False).exists())
+        self.assertEqual(inventory.current_stock(product), stock)
+        self.assertEqual(inventory.available_to_sell([product.id])[product.id], stock - product.reserved)
+
+    def test_compaction_and_cancellation_keep_ledger_and_shards_in_step(self):
+        product, = make_products(1, stock=10)
+        first = place_order(make_order(), make_cart([(product, 3)]))
+        place_order(make_order(), make_cart([(product, 2)]))
+        # Prima della compattazione la fotografia è indietro, lo stock attuale no
+        self.assertEqual(inventory.current_stock(product), 5)
+        inventory.compact()
+        self.assertEqual(list(product.stock_movements.order_by('id').values_list('kind', flat=True)),
+                         [inventory.RESTOCK, inventory.SALE, inventory.SALE])
+        self.assert_consistent(product, stock=5, sold=5)
+
+        self.assertEqual(inventory.cancel_order(first), 1)
+        # Un secondo annullamento non restituisce di nuovo i pezzi
+        self.assertEqual(inventory.cancel_order(first), 0)
+        inventory.compact()
+        self.assert_consistent(product, stock=8, sold=2)
+
+
+# --- PRENOTAZIONI (reservations.py) ---
+class ReservationTests(ShopTestCase):
+
+    def test_cart_holds_never_write_the_product_row(self):
+        product, = make_products(1, stock=5)
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as context:
+            reservations.reserve('carrello', product, 2)
+            reservations.release('carrello')
+            reservations.reserve('carrello', product, 3)
+        self.assertFalse([q['sql'] for q in context.captured_queries if q['sql'].startswith('UPDATE "shop_product"')])
+        # La fotografia la aggiorna la compattazione messa in coda
+        self.assertTrue(Job.objects.filter(task='shop.inventory.compact').exists())
+        inventory.compact()
+        product.refresh_from_db()
+        self.assertEqual(product.reserved, 3)
+        self.assertEqual(product.available_to_sell, 2)
+
+    def test_expired_holds_return_their_stock(self):
+        product, = make_products(1, stock=3)
+        reservations.reserve('primo', product, 2)
+        reservations.reserve('terzo', product, 1)
+        with self.assertRaises(reservations.NotEnoughStock) as raised:
+            reservations.reserve('secondo', product, 2)
+        self.assertEqual(raised.exception.available, 0)
+        StockReservation.objects.filter(token='primo').update(expires_at=timezone.now() - timedelta(seconds=1))
+        out = StringIO()
+        call_command('release_expired_reservations', batch_size=1, stdout=out)
+        self.assertIn('liberate: 1', out.getvalue())
+        # Restano solo le prenotazioni non scadute; i pezzi liberati vanno al carrello successivo
+        self.assertEqual(list(StockReservation.objects.values_list('token', flat=True)), ['terzo'])
+        reservations.reserve('secondo', product, 2)
+        self.assertEqual(inventory.available_to_sell([product.id])[product.id], 0)
+        inventory.compact()
+        product.refresh_from_db()
+        self.assertEqual(product.reserved, 3)
+
+
+# --- STOCK NELL'ADMIN (ProductAdmin, inventory.adjust_stock) ---
+class ProductAdminStockTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.product, = make_products(1, stock=5)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def sell(self, quantity):
+        with self.captureOnCommitCallbacks(execute=True):
+            place_order(make_order(), make_cart([(self.product, quantity)]))
+        inventory.compact()
+
+    def test_stale_changelist_save_keeps_sold_units_sold(self):
+        # Lista aperta quando c'erano 5 pezzi, salvata dopo una vendita di 2
+        self.sell(2)
+        response = self.client.post(reverse('admin:shop_product_changelist'), {
+            'form-TOTAL_FORMS': '1', 'form-INITIAL_FORMS': '1',
+            'form-0-id': str(self.product.id), 'form-0-price': '19.00', 'form-0-available': 'on',
+            'form-0-stock': '5', '_save': 'Save',
+        })
+        self.assertEqual(response.status_code, 302)
+        inventory.compact()
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.price, Decimal('19.00'))
+        self.assertEqual(self.product.stock, 3)
+        self.assertEqual(inventory.available_to_sell([self.product.id])[self.product.id], 3)
+
+    def test_change_form_restock_is_relative(self):
+        self.sell(2)
+        data = {
+            'category': str(self.product.category_id), 'name': self.product.name, 'slug': self.product.slug,
+            'description': '', 'price': '25.00', 'available': 'on', 'stock': '50', 'sold': '0', 'reserved': '0',
+        }
+        url = reverse('admin:shop_product_change', args=[self.product.id])
+        self.assertEqual(self.client.post(url, {**data, 'stock_delta': '4'}).status_code, 302)
+        inventory.compact()
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.stock, self.product.sold), (7, 2))
+        self.assertEqual(inventory.available_to_sell([self.product.id])[self.product.id], 7)
+        self.assertEqual(
+            list(self.product.stock_movements.filter(kind=inventory.RESTOCK).order_by('id').values_list('quantity', flat=True)),
+            [5, 4],
+        )
+        # Non si tolgono più pezzi di quelli liberi
+        response = self.client.post(url, {**data, 'stock_delta': '-8'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(inventory.available_to_sell([self.product.id])[self.product.id], 7)
+
+
+# --- IMPORT DEL CATALOGO (comando import_catalog) ---
+class ImportCatalogTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        Category.objects.create(name='Abiti', slug='abiti')
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def write(self, name, text):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as handle:
+            handle.write(text)
+        return path
+
+    def test_creates_then_updates_products(self):
+        path = self.write('catalogo.csv', 'slug,name,category,price,stock\nabito-rosso,Abito rosso,abiti,30,4\n')
+        call_command('import_catalog', path, stdout=StringIO())
+        product = Product.objects.get(slug='abito-rosso')
+        self.assertEqual((product.name, product.price, product.stock), ('Abito rosso', Decimal('30'), 4))
+        self.assertEqual(inventory.available_to_sell([product.id])[product.id], 4)
+
+        # Aggiornamento: la cella vuota non cancella il nome già salvato
+        path = self.write('prezzi.csv', 'slug,name,price,stock\nabito-rosso,,35.50,6\n')
+        call_command('import_catalog', path, stdout=StringIO())
+        product.refresh_from_db()
+        self.assertEqual((product.name, product.price, product.stock), ('Abito rosso', Decimal('35.50'), 6))
+        self.assertEqual(inventory.available_to_sell([product.id])[product.id], 6)
+        self.assertEqual(Product.objects.count(), 1)
+
+    def test_resume_uses_the_columns_of_the_checkpoint(self):
+        # Il primo blocco è già stato importato: le colonne sono nel checkpoint, non nella riga di ripresa
+        path = self.write('catalogo.jsonl', '\n'.join([
+            '{"slug": "abito-1", "name": "Abito 1", "category": "abiti", "price": "20", "stock": 1}',
+            '{"slug": "abito-2", "category": "abiti", "price": "20"}',
+            '{"slug": "abito-3", "name": "Abito 3", "category": "abiti", "price": "20", "stock": 2}',
+        ]) + '\n')
+        self.write('catalogo.jsonl.checkpoint', json.dumps(
+            {'records': 1, 'columns': ['name', 'category', 'price', 'stock']},
+        ))
+        err = StringIO()
+        call_command('import_catalog', path, resume=True, stdout=StringIO(), stderr=err)
+        self.assertIn('campi mancanti: name, stock', err.getvalue())
+        self.assertEqual(list(Product.objects.values_list('slug', 'stock')), [('abito-3', 2)])
+        self.assertFalse(os.path.exists(f'{path}.checkpoint'))
+
+
+# --- LIMITI DI FREQUENZA (ratelimit.py) ---
+@override_settings(RATE_LIMITS={'cart': (3, 60)}, RATE_LIMITS_IP={'cart': 5})
+class RateLimitTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.product, = make_products(1)
+        self.url = reverse('shop:cart_add', args=[self.product.id])
+
+    def add(self, client):
+        return client.post(self.url, {'quantity': 1, 'override': False})
+
+    def test_session_gets_429_after_the_limit(self):
+        client = Client()
+        # La prima richiesta crea la sessione: da lì si contano le tre del limite
+        self.assertEqual([self.add(client).status_code for _ in range(4)], [302] * 4)
+        response = self.add(client)
+        self.assertEqual(response.status_code, 429)
+        self.assertTrue(int(response['Retry-After']) >= 1)
+        # Un altro cliente dallo stesso IP non è bloccato dal limite della sessione
+        self.assertEqual(self.add(Client()).status_code, 302)
+
+    def test_ip_limit_is_separate_and_higher(self):
+        # Cinque clienti dietro lo stesso NAT, una richiesta ciascuno: il sesto supera il limite per IP
+        self.assertEqual([self.add(Client()).status_code for _ in range(5)], [302] * 5)
+        self.assertEqual(self.add(Client()).status_code, 429)
+        with override_settings(RATE_LIMITS_IP={}):
+            self.assertEqual(self.add(Client()).status_code, 302)
+
+
+# --- RICERCA NELL'ADMIN (ProductAdmin.get_search_results) ---
+class ProductAdminSearchTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.products = make_products(3)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def changelist(self, **params):
+        response = self.client.get(reverse('admin:shop_product_changelist'), {'q': 'abito', **params})
+        return [product.id for product in response.context['cl'].result_list]
+
+    def test_results_keep_the_index_ranking(self):
+        ranked = [self.products[2].id, self.products[0].id, self.products[1].id]
+        with mock.patch('shop.admin.search_products', return_value=ranked):
+            self.assertEqual(self.changelist(), ranked)
+            # Una colonna scelta dall'utente vince sulla rilevanza (colonna 1 = nome)
+            self.assertEqual(self.changelist(o='1'), [product.id for product in self.products])
+
+
+# --- EMAIL AI CLIENTI (notifications.py) ---
+class OrderEmailTests(ShopTestCase):
+
+    def test_pending_emails_go_out_in_batches_on_one_connection(self):
+        products = make_products(3)
+        orders = [place_order(make_order(), make_cart([(product, 1)])) for product in products]
+        # Il checkout mette in coda l'email, non la invia
+        self.assertEqual(mail.outbox, [])
+        self.assertTrue(Job.objects.filter(task='shop.notifications.send_pending').exists())
+        with mock.patch('shop.notifications.get_connection', wraps=mail.get_connection) as get_connection:
+            self.assertEqual(notifications.send_pending(batch_size=2), 3)
+        get_connection.assert_called_once()
+        self.assertEqual([message.subject for message in mail.outbox],
+                         [f'Conferma ordine n. {order.id}' for order in orders])
+        self.assertEqual(mail.outbox[0].to, ['anna@example.com'])
+        self.assertEqual(mail.outbox[0].alternatives[0][1], 'text/html')
+        # Già segnate come inviate: un nuovo giro non le rimanda
+        self.assertEqual(notifications.send_pending(), 0)
+        self.assertEqual(len(mail.outbox), 3)
+
+
+# --- LAVORI IN BACKGROUND (jobs.py, comando run_jobs) ---
+JOB_CALLS = []
+
+
+def record_job(value):
+    JOB_CALLS.append(value)
+
+
+def failing_job():
+    raise RuntimeError('SMTP non raggiungibile')
+
+
+@override_settings(JOBS_RETRY_BACKOFF=30, JOBS_RETRY_MAX_DELAY=3600, SEARCH_INDEX_PATH=f'{SEARCH_DIR}/products.pickle')
+class JobTests(TransactionTestCase):
+
+    def setUp(self):
+        JOB_CALLS.clear()
+
+    def run_once(self):
+        out = StringIO()
+        call_command('run_jobs', once=True, stdout=out)
+        return out.getvalue()
+
+    def test_dedupe_key_keeps_one_pending_job(self):
+        for value in (1, 2):
+            jobs.enqueue('shop.tests.record_job', dedupe_key='stesso', value=value)
+        self.assertEqual(Job.objects.count(), 1)
+        self.assertIn('completati: 1, falliti: 0', self.run_once())
+        self.assertEqual(JOB_CALLS, [1])
+        # Completato il primo, la stessa chiave si può rimettere in coda
+        jobs.enqueue('shop.tests.record_job', dedupe_key='stesso', value=3)
+        self.assertEqual(Job.objects.filter(status=jobs.PENDING).count(), 1)
+
+    def test_failed_job_is_retried_with_backoff_then_given_up(self):
+        jobs.enqueue('shop.tests.failing_job', max_attempts=2)
+        with self.assertLogs('shop.jobs', 'ERROR'):
+            self.assertIn('falliti: 1', self.run_once())
+        job = Job.objects.get()
+        self.assertEqual((job.status, job.attempts), (jobs.PENDING, 1))
+        self.assertIn('SMTP non raggiungibile', job.last_error)
+        # Primo nuovo tentativo dopo JOBS_RETRY_BACKOFF secondi (più fino al 25% casuale)
+        delay = (job.run_after - timezone.now()).total_seconds()
+        self.assertTrue(25 < delay <= 37.5, delay)
+        self.assertIn('completati: 0, falliti: 0', self.run_once())
+        Job.objects.update(run_after=timezone.now())
+        with self.assertLogs('shop.jobs', 'ERROR'):
+            self.run_once()
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (jobs.FAILED, 2))
+        # Dall'admin (azione "Rimetti in coda") riparte da zero
+        self.assertEqual(jobs.retry(Job.objects.all()), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (jobs.PENDING, 0))
+
+    def test_worker_survives_an_error_outside_the_job(self):
+        jobs.enqueue('shop.tests.record_job', value=1)
+        with mock.patch('shop.jobs.execute', side_effect=OperationalError('database non raggiungibile')), \
+                self.assertLogs('shop.management.commands.run_jobs', 'ERROR'):
+            self.assertIn('completati: 0, falliti: 1', self.run_once())
+        # Il lavoro resta preso: torna disponibile alla scadenza del lease
+        self.assertEqual(Job.objects.get().status, jobs.RUNNING)
+
+
+# --- METRICHE PER PROMETHEUS (metrics.py) ---
+@override_settings(METRICS_ENABLED=True, METRICS_DIR='', METRICS_TOKEN='segreto', METRICS_ALLOWED_IPS=[])
+class MetricsTests(ShopTestCase):
+
+    def scrape(self, token='segreto'):
+        return self.client.get(reverse('shop:metrics'), HTTP_AUTHORIZATION=f'Bearer {token}')
+
+    def test_metrics_endpoint(self):
+        make_products(1)
+        before = metrics.collect().get(('shop_request_duration_seconds', (('view', 'shop:product_list'),)))
+        self.client.get(reverse('shop:product_list'))
+        response = self.scrape()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        text = response.content.decode()
+        self.assertIn('# TYPE shop_request_duration_seconds histogram', text)
+        self.assertIn('shop_request_duration_seconds_bucket{view="shop:product_list",le="+Inf"}', text)
+        # Valori del processo: si sommano a quelli delle richieste dei test precedenti
+        count = sum(before[0]) if before else 0
+        self.assertIn(f'shop_request_duration_seconds_count{{view="shop:product_list"}} {count + 1}', text)
+        self.assertEqual(self.scrape(token='sbagliato').status_code, 403)
+
+    def test_disabled_metrics_record_nothing(self):
+        with self.settings(METRICS_ENABLED=False):
+            before = metrics.collect()
+            Client().get(reverse('shop:product_list'))
+            self.assertEqual(metrics.collect(), before)
+
+
+# --- PROFILAZIONE (profiling.py) ---
+class ProfilingTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        make_products(1)
+
+    def profiles(self):
+        return sorted(name.rsplit('-', 1)[-1] for name in os.listdir(self.directory))
+
+    def test_nothing_is_written_when_disabled(self):
+        with self.settings(PROFILING_DIR=self.directory, PROFILING_SAMPLE_RATE=0, PROFILING_SLOW_MS=0):
+            self.assertEqual(self.client.get(reverse('shop:product_list')).status_code, 200)
+        self.assertEqual(self.profiles(), [])
+
+    def test_sampled_requests_write_a_profile(self):
+        with self.settings(PROFILING_DIR=self.directory, PROFILING_SAMPLE_RATE=1, PROFILING_SLOW_MS=0):
+            self.client.get(reverse('shop:product_list'))
+            # Solo le viste dello shop: l'admin non viene profilato
+            self.client.get(reverse('admin:login'))
+        self.assertEqual(self.profiles(), ['sampled.prof'])
+
+    def test_staff_link_profiles_one_request(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        with self.settings(PROFILING_DIR=self.directory, PROFILING_SAMPLE_RATE=0, PROFILING_SLOW_MS=0):
+            link = self.client.get(reverse('shop:profile_request'), {'path': reverse('shop:product_list')})['Location']
+            self.client.get(link)
+            # Il link vale una volta sola
+            self.client.get(link)
+        self.assertEqual(self.profiles(), ['staff.prof'])
+
+
+# --- PAGINAZIONE A CURSORE (pagination.py) ---
+class KeysetPaginatorTests(ShopTestCase):
+
+    def setUp(self):
+        super().setUp()
+        make_products(5)
+        self.paginator = KeysetPaginator(Product.objects.all(), per_page=2)
+        self.expected = list(Product.objects.order_by('-created', '-id').values_list('id', flat=True))
+
+    def test_tokens_walk_forward_and_back(self):
+        pages = [self.paginator.get_page()]
+        while pages[-1].next_token:
+            pages.append(self.paginator.get_page(pages[-1].next_token))
+        self.assertEqual([product.id for page in pages for product in page], self.expected)
+        self.assertFalse(pages[0].has_previous())
+        # Il token "indietro" dell'ultima pagina riporta alla penultima
+        previous = self.paginator.get_page(pages[-1].previous_token)
+        self.assertEqual([product.id for product in previous], [product.id for product in pages[-2]])
+
+    def test_tampered_tokens_are_rejected(self):
+        token = self.paginator.get_page().next_token
+        # Non base64, troncato, chiavi in meno, direzione sconosciuta, data non valida
+        for bad in ['non-base64!', token[:-3], 'WyJuZXh0IiwxXQ', 'WyJzdSIsIngiLDFd', 'WyJuZXh0IiwiaWVyaSIsMV0']:
+            with self.assertRaises(InvalidCursor):
+                self.paginator.decode(bad)
+        # Nella vista un token non valido riporta alla prima pagina
+        self.assertEqual([product.id for product in self.paginator.get_page('non-base64!')], self.expected[:2])
@@ -11,6 +11,21 @@ urlpatterns = [
     #path('<slug:category_slug>/', views.product_list, name='product_list_by_category'),
     #path('<int:id>/<slug:slug>/', views.product_detail, name='product_detail'),
 
+    # Ricerca prodotti (?q=): prima delle categorie, altrimenti "search" verrebbe letto come slug
+    path('search/', views.product_search, name='product_search'),
+    # Suggerimenti mentre si scrive (JSON, ?q=): rispondono dalla memoria, senza query al database
+    path('search/autocomplete/', views.product_autocomplete, name='product_autocomplete'),
+
+    # Stato personale (badge carrello, login, CSRF) in JSON per le pagine in cache pubblica
+    path('session/', views.session_state, name='session_state'),
+
+    # Ultime richieste misurate dalla strumentazione (JSON, solo staff)
+    path('debug/requests/', views.instrumentation_recent, name='instrumentation'),
+    # Metriche per Prometheus (testo, senza slash finale come si aspetta lo scraper)
+    path('metrics', views.metrics_view, name='metrics'),
+    # Link che fa profilare una singola richiesta (?path=/order/create/, solo staff): i profili finiscono in PROFILING_DIR
+    path('debug/profile/', views.profile_request, name='profile_request'),
+
     # --- Gestione del Carrello ---
 
     # Visualizzazione del contenuto del carrello
@@ -24,12 +39,24 @@ urlpatterns = [
 
     # Checkout: creazione di un nuovo ordine
     path('order/create/', views.order_create, name='order_create'),
+    # Attesa di un reinvio del checkout mentre il primo invio sta ancora creando l'ordine (chiave del modulo)
+    path('order/pending/<slug:token>/', views.order_pending, name='order_pending'),
     # Storico ordini dell'utente
     path('orders/', views.order_list, name='order_list'),
     # Dettaglio di un singolo ordine specifico tramite il suo ID
     path('orders/<int:order_id>/', views.order_detail, name='order_detail'),
-    # Marcare un ordine come pagato (view di test/utility)
-    path('orders/<int:order_id>/mark-paid/', views.mark_order_paid, name='mark_order_paid'),
+    # Pagamento con carta dell'ordine (Stripe.js) e simulazione con il gateway finto di sviluppo
+    path('orders/<int:order_id>/pay/', views.order_pay, name='order_pay'),
+    path('orders/<int:order_id>/pay/fake/', views.order_pay_fake, name='order_pay_fake'),
+    # Webhook di Stripe (da configurare in Stripe Dashboard -> Webhooks)
+    path('payments/webhook/', views.stripe_webhook, name='stripe_webhook'),
+
+    # --- Coda di attesa per i lanci ---
+
+    # Pagina di attesa con la posizione in coda
+    path('queue/', views.admission_queue, name='admission_queue'),
+    # Posizione in coda in JSON, chiesta periodicamente dalla pagina di attesa
+    path('queue/status/', views.admission_status, name='admission_status'),
 
     #path('<slug:category_slug>/', views.product_list, name='product_list_by_category'),
 
@@ -1,64 +1,189 @@
+import hmac
+from urllib.parse import urlencode, urlsplit
+
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db.models import Prefetch, prefetch_related_objects
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse
+from django.middleware.csrf import get_token
 from django.shortcuts import render, get_object_or_404, redirect
+from django.urls import reverse
+from django.utils.http import url_has_allowed_host_and_scheme
+from django.views.decorators.cache import cache_control, never_cache
+from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
 from django.contrib.auth import login
-from .models import Category, Product, Order, OrderItem
+from .models import Product, Order, OrderItem
+from . import (
+    admission, autocomplete, catalog_cache, idempotency, instrumentation, inventory, metrics, payments, profiling,
+    reservations, search,
+)
 from .cart import Cart
+from .checkout import OutOfStock, place_order
+from .decorators import admission_controlled, public_when_client_personalized, rate_limited
+from .facets import FacetSelection, get_facets
 from .forms import CartAddProductForm, OrderCreateForm, UserRegistrationForm
+from .pagination import KeysetPaginator
 
 # --- VISUALIZZAZIONE PRODOTTI ---
+def _get_page_size(request):
+    """ Dimensione pagina dal parametro ?per_page=, limitata al massimo configurato nei settings. """
+    try:
+        per_page = int(request.GET.get('per_page', settings.CATALOG_PAGE_SIZE))
+    except ValueError:
+        per_page = settings.CATALOG_PAGE_SIZE
+    return max(1, min(per_page, settings.CATALOG_MAX_PAGE_SIZE))
+
+
+@public_when_client_personalized
 def product_list(request, category_slug=None):
-    """ Elenca i prodotti, opzionalmente filtrati per categoria. """
+    """ Elenca i prodotti, filtrati per categoria, prezzo, disponibilità e novità, una pagina alla volta. """
     category = None
-    categories = Category.objects.all()
-    products = Product.objects.filter(available=True) # Mostra solo prodotti disponibili
     if category_slug:
-        # Se c'è uno slug nell'URL, filtra per quella categoria specifica
-        category = get_object_or_404(Category, slug=category_slug)
-        products = products.filter(category=category)
+        # Se c'è uno slug nell'URL, filtra per quella categoria specifica (categoria letta dalla cache)
+        category = catalog_cache.get_category(category_slug)
+    # Filtri scelti (?price=50-100&in_stock=1&new=1) e relativi conteggi, calcolati in una sola query
+    selection = FacetSelection.from_request(request, category)
+    facets = get_facets(selection)
+    # Queryset "pigro": se il frammento è in cache il template non lo valuta e non si tocca il DB
+    products = selection.filter(Product.objects.filter(available=True)) # Mostra solo prodotti disponibili
+    # Paginazione a cursore sulle chiavi dell'ordinamento scelto (?sort=), es. (created, id) o (price, id)
+    per_page = _get_page_size(request)
+    paginator = KeysetPaginator(products, per_page=per_page, keys=selection.ordering)
+    cursor = request.GET.get('cursor')
+    page = paginator.get_page(cursor, params=request.GET)
     return render(request, 'shop/product/list.html', {
         'category': category,
-        'categories': categories,
-        'products': products
+        'facets': facets,
+        'products': page,
+        'page': page,
+        # Chiavi dei frammenti in cache: versione del catalogo + filtri + posizione nella lista
+        'catalog_version': catalog_cache.get_catalog_version(),
+        'catalog_cache_timeout': settings.CATALOG_CACHE_TIMEOUT,
+        'page_key': f'{selection.key}:{cursor or ""}:{per_page}',
     })
 
 
+@public_when_client_personalized
 def product_detail(request, id, slug):
     """ Mostra il dettaglio di un singolo prodotto e il modulo per aggiungerlo al carrello. """
     product = get_object_or_404(Product, id=id, slug=slug, available=True)
     cart_product_form = CartAddProductForm()
     return render(request, 'shop/product/detail.html', {
         'product': product,
-        'cart_product_form': cart_product_form
+        # Pezzi liberi esatti dal contatore (Product.stock/reserved si aggiornano alla compattazione)
+        'available_quantity': inventory.available_to_sell([product.id])[product.id],
+        'cart_product_form': cart_product_form,
+        'catalog_version': catalog_cache.get_catalog_version(),
+        'catalog_cache_timeout': settings.CATALOG_CACHE_TIMEOUT,
+    })
+
+@public_when_client_personalized
+def product_search(request):
+    """ Ricerca per testo su nome, descrizione e categoria, con risultati ordinati per rilevanza. """
+    query = request.GET.get('q', '').strip()
+    ids = search.search_products(query, limit=settings.SEARCH_MAX_RESULTS) if query else []
+    if ids:
+        # L'indice contiene anche i prodotti non disponibili: li togliamo mantenendo l'ordine di rilevanza
+        available = set(Product.objects.filter(id__in=ids, available=True).values_list('id', flat=True))
+        ids = [product_id for product_id in ids if product_id in available]
+    # Paginazione sulla lista di ID: dal DB si caricano solo i prodotti della pagina richiesta
+    page = Paginator(ids, _get_page_size(request)).get_page(request.GET.get('page'))
+    products = Product.objects.in_bulk(page.object_list)
+    return render(request, 'shop/product/search.html', {
+        'search_query': query,
+        'products': [products[product_id] for product_id in page.object_list if product_id in products],
+        'page': page,
+        'result_count': len(ids),
+    })
+
+@cache_control(public=True, max_age=60)
+def product_autocomplete(request):
+    """
+    Suggerimenti (categorie e prodotti) per il testo scritto finora nella barra di ricerca.
+    Una richiesta per tasto premuto: la risposta arriva dall'indice in memoria, non dal DB,
+    ed è uguale per tutti (non legge la sessione), quindi può finire in cache pubblica.
+    """
+    query = request.GET.get('q', '')[:100]
+    return JsonResponse({'query': query, 'results': autocomplete.suggest(query)})
+
+# --- DATI PERSONALI PER LE PAGINE IN CACHE PUBBLICA ---
+@never_cache
+def session_state(request):
+    """
+    Piccolo endpoint JSON con le sole parti personali della pagina (badge carrello,
+    stato di login, token CSRF). Le pagine del catalogo in modalità 'client' lo chiamano
+    dal browser, così il loro HTML può essere identico per tutti e finire in cache.
+    """
+    cart = Cart(request)
+    user = request.user
+    return JsonResponse({
+        'cart_count': len(cart),
+        'authenticated': user.is_authenticated,
+        'username': user.get_username() if user.is_authenticated else '',
+        'csrf_token': get_token(request),
     })
 
+# --- STRUMENTAZIONE E METRICHE ---
+@staff_member_required
+@never_cache
+def instrumentation_recent(request):
+    """ Ultime richieste misurate da InstrumentationMiddleware in questo processo, con ?view= per filtrare. """
+    view = request.GET.get('view')
+    requests = [entry for entry in instrumentation.recent() if not view or entry['view'] == view]
+    return JsonResponse({'enabled': settings.INSTRUMENTATION_ENABLED, 'requests': requests})
+
+
+@never_cache
+def metrics_view(request):
+    """ Metriche di tutti i processi nel formato di Prometheus, per lo staff, METRICS_TOKEN o METRICS_ALLOWED_IPS. """
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    allowed = (
+        request.user.is_staff
+        or (settings.METRICS_TOKEN and hmac.compare_digest(token, settings.METRICS_TOKEN))
+        or request.META.get('REMOTE_ADDR') in settings.METRICS_ALLOWED_IPS
+    )
+    if not allowed:
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+@never_cache
+def profile_request(request):
+    """ Reindirizza a ?path= con il token firmato di ProfilingMiddleware: quella sola richiesta viene profilata. """
+    path = request.GET.get('path', '')
+    if not url_has_allowed_host_and_scheme(path, allowed_hosts=None) or not path.startswith('/'):
+        raise Http404
+    target = urlsplit(path)
+    query = '&'.join(filter(None, [target.query, urlencode({profiling.QUERY_PARAM: profiling.profile_link(target.path)})]))
+    return redirect(f'{target.path}?{query}')
+
 # --- LOGICA DEL CARRELLO ---
 @require_POST
+@rate_limited('cart')
+@admission_controlled
 def cart_add(request, product_id):
-    """ Aggiunge un prodotto al carrello con controllo rigoroso dello stock. """
+    """ Aggiunge un prodotto al carrello trattenendo i pezzi richiesti per STOCK_RESERVATION_TTL secondi. """
     cart = Cart(request)
     product = get_object_or_404(Product, id=product_id)
     form = CartAddProductForm(request.POST)
     if form.is_valid():
         cd = form.cleaned_data
         quantity = cd['quantity']
-        # 1. Verifica immediata: la quantità richiesta è superiore al magazzino?
-        if quantity > product.stock:
-            messages.error(request, f'Quantità non disponibile. Stock disponibile: {product.stock}')
-            return redirect('shop:cart_detail')
-        # 2. Verifica cumulata: quello che c'è già nel carrello + il nuovo supera lo stock?
-        current_quantity = 0
-        if str(product.id) in cart.cart:
-            current_quantity = cart.cart[str(product.id)]['quantity']
-        
+        # 1. Quantità finale della riga: quello che c'è già nel carrello + il nuovo (o il nuovo valore con 'override')
         if not cd['override']:
-            new_quantity = current_quantity + quantity
+            new_quantity = cart.get_item_quantity(product.id) + quantity
         else:
             new_quantity = quantity # Se 'override' è True, stiamo sovrascrivendo la quantità
-            
-        if new_quantity > product.stock:
-            messages.error(request, f'Quantità non disponibile. Stock disponibile: {product.stock}')
+        # 2. Prenotazione: fallisce se i pezzi non trattenuti da altri carrelli non bastano
+        try:
+            reservations.reserve(reservations.get_hold_token(request), product, new_quantity)
+        except reservations.NotEnoughStock as e:
+            messages.error(request, f'Quantità non disponibile. Stock disponibile: {e.available}')
             return redirect('shop:cart_detail')
         # 3. Esecuzione aggiunta
         cart.add(product=product, quantity=quantity, override_quantity=cd['override'])
@@ -72,11 +197,13 @@ def cart_add(request, product_id):
 
 
 @require_POST
+@rate_limited('cart')
 def cart_remove(request, product_id):
     """ Rimuove un articolo dal carrello. """
     cart = Cart(request)
     product = get_object_or_404(Product, id=product_id)
     cart.remove(product)
+    reservations.release(reservations.get_hold_token(request, create=False), product)
     messages.success(request, f'{product.name} rimosso dal carrello!')
     return redirect('shop:cart_detail')
 
@@ -84,44 +211,62 @@ def cart_remove(request, product_id):
 def cart_detail(request):
     """ Visualizza il carrello e permette di aggiornare le quantità per ogni riga. """
     cart = Cart(request)
-    for item in cart:
-        # Crea un form per ogni riga del carrello per permettere modifiche rapide
-        item['update_quantity_form'] = CartAddProductForm(initial={
-            'quantity': item['quantity'],
-            'override': True
-        })
-    return render(request, 'shop/cart/detail.html', {'cart': cart})
+    if cart.discard_missing():
+        messages.warning(request, 'Alcuni prodotti non sono più in catalogo e sono stati rimossi dal carrello.')
+    # Chi guarda il carrello lo sta ancora usando: le prenotazioni ripartono da zero
+    reservations.extend(reservations.get_hold_token(request, create=False))
+    # Il template riceve la vista idratata: prodotti caricati una volta, totali già calcolati
+    return render(request, 'shop/cart/detail.html', {'cart': cart.hydrate()})
 
 # --- GESTIONE ORDINI ---
+def _order_placed(request, order):
+    """ Risposta a un checkout riuscito (anche ai reinvii dello stesso modulo). """
+    # Anche nei reinvii: la sessione del primo invio può non essere ancora salvata
+    _remember_order(request, order)
+    if order.payment_method == 'card' and not order.paid:
+        # L'ordine è salvato ma non pagato: il pagamento avviene nella pagina di Stripe (paid lo imposta il webhook)
+        return redirect('shop:order_pay', order_id=order.id)
+    messages.success(request, 'Ordine creato con successo!')
+    # Righe e prodotti in una sola query per il riepilogo (niente query per ogni riga)
+    prefetch_related_objects([order], Prefetch('items', queryset=OrderItem.objects.select_related('product')))
+    return render(request, 'shop/order/created.html', {'order': order})
+
+
+@admission_controlled
 def order_create(request):
     """ Gestisce la creazione di un ordine dai dati del carrello. Permette acquisti con o senza registrazione. """
     cart = Cart(request)
     if request.method == 'POST':
         form = OrderCreateForm(request.POST)
         if form.is_valid():
+            # Reinvio dello stesso modulo (doppio clic, retry del browser): stesso ordine, nessun nuovo checkout
+            token = form.cleaned_data['idempotency_key']
+            placed = idempotency.begin(token) if token else None
+            if placed == idempotency.PENDING:
+                # Primo invio ancora in corso: nessuna attesa nel worker, il browser aspetta nella pagina di elaborazione
+                return redirect('shop:order_pending', token=token)
+            if placed is not None:
+                return _order_placed(request, get_object_or_404(Order, id=placed))
             order = form.save(commit=False) # Crea l'oggetto ma non lo salva ancora nel DB
             if request.user.is_authenticated:
                 order.user = request.user # Lega l'ordine all'utente loggato
-            # Se pagamento con carta, marca automaticamente come pagato
-            if form.cleaned_data.get('payment_method') == 'card':
-                order.paid = True
-            order.save() # Ora salva l'ordine nel DB
-            # Trasforma ogni elemento del carrello in una riga dell'ordine (OrderItem)
-            for item in cart:
-                # Decrementa lo stock del prodotto
-                product = item['product']
-                product.stock -= item['quantity']
-                product.save()
-                # Crea l'elemento dell'ordine
-                OrderItem.objects.create(
-                    order=order,
-                    product=product,
-                    price=item['price'], # Salviamo il prezzo attuale per storico
-                    quantity=item['quantity']
-                )
+            try:
+                # Ordine, righe, decremento dello stock e prenotazioni consumate in un'unica transazione atomica
+                place_order(order, cart, hold_token=reservations.get_hold_token(request, create=False))
+            except OutOfStock as e:
+                idempotency.abort(token)
+                names = ', '.join(p.name for p in e.products)
+                if names:
+                    messages.error(request, f'Quantità non più disponibile per: {names}. Aggiorna il carrello.')
+                else:
+                    messages.error(request, 'Alcuni prodotti del carrello non sono più disponibili.')
+                return redirect('shop:cart_detail')
+            except Exception:
+                idempotency.abort(token)
+                raise
+            idempotency.finish(token, order.id)
             cart.clear() # Svuota il carrello dopo l'acquisto
-            messages.success(request, 'Ordine creato con successo!')
-            return render(request, 'shop/order/created.html', {'order': order})
+            return _order_placed(request, order)
     else:
         # Pre-compila il modulo con i dati dell'utente se disponibile
         if request.user.is_authenticated:
@@ -132,7 +277,88 @@ def order_create(request):
             })
         else:
             form = OrderCreateForm()
-    return render(request, 'shop/order/create.html', {'cart': cart, 'form': form})
+        reservations.extend(reservations.get_hold_token(request, create=False))
+    return render(request, 'shop/order/create.html', {'cart': cart.hydrate(), 'form': form})
+
+
+@never_cache
+def order_pending(request, token):
+    """ Reinvio del checkout mentre il primo invio crea ancora l'ordine: la pagina si ricarica finché non ha finito. """
+    placed = idempotency.status(token)
+    if placed is None:
+        # Primo invio fallito (es. stock esaurito) o chiave scaduta: il carrello mostra cosa è rimasto
+        messages.info(request, 'Il tuo ordine non è stato completato: controlla il carrello e riprova.')
+        return redirect('shop:cart_detail')
+    if placed != idempotency.PENDING:
+        return _order_placed(request, get_object_or_404(Order, id=placed))
+    response = render(request, 'shop/order/pending.html')
+    # Il browser ricarica la pagina ogni 2 secondi, anche senza JavaScript
+    response['Refresh'] = '2'
+    return response
+
+
+# --- CODA DI ATTESA (lanci di collezione) ---
+def _queue_status(request):
+    """ Posizione in coda dell'acquirente e pagina a cui tornare quando tocca a lui. """
+    config = admission.get_config()
+    session = request.session
+    position = None
+    if config['enabled'] and not admission.has_pass(session):
+        position = admission.check_ticket(session, config)
+    return {
+        # Senza biglietto (coda disattivata, cache svuotata) si riprova direttamente
+        'admitted': not position,
+        'position': position or 0,
+        'next': session.get(admission.NEXT_SESSION_KEY) or reverse('shop:cart_detail'),
+    }
+
+
+@never_cache
+def admission_queue(request):
+    """ Pagina di attesa: mostra la posizione e la aggiorna dal browser finché non tocca all'acquirente. """
+    status = _queue_status(request)
+    if status['admitted']:
+        request.session.pop(admission.NEXT_SESSION_KEY, None)
+        return redirect(status['next'])
+    return render(request, 'shop/admission/queue.html', {'status': status})
+
+
+@never_cache
+def admission_status(request):
+    """ Stato della coda in JSON per la pagina di attesa (posizione, ammesso, dove tornare). """
+    status = _queue_status(request)
+    if status['admitted']:
+        request.session.pop(admission.NEXT_SESSION_KEY, None)
+    return JsonResponse(status)
+
+
+def _remember_order(request, order):
+    """ Annota in sessione l'ordine appena creato: per un ospite è l'unica prova che l'ordine è suo. """
+    orders = request.session.get(settings.ORDERS_SESSION_ID, [])
+    # Gli ultimi 20 bastano: servono solo per pagare gli ordini appena creati
+    request.session[settings.ORDERS_SESSION_ID] = (orders + [order.id])[-20:]
+
+
+def _owns_order(request, order):
+    """ True se l'ordine è dell'utente loggato o, per gli ordini da ospite, è stato creato da questa sessione. """
+    if order.user_id is not None:
+        return order.user_id == request.user.id
+    return order.id in request.session.get(settings.ORDERS_SESSION_ID, [])
+
+
+def _get_own_order(request, order_id):
+    """ Ordine dell'utente o creato da questa sessione (pagamenti); 404 per tutti gli altri, anche agli ospiti. """
+    order = get_object_or_404(Order, id=order_id)
+    if not _owns_order(request, order):
+        raise Http404
+    return order
+
+
+def _get_order_for_request(request, order_id):
+    """ Ordine visibile a chi fa la richiesta: gli utenti loggati vedono solo i propri. """
+    if request.user.is_authenticated:
+        return get_object_or_404(Order, id=order_id, user=request.user)
+    return get_object_or_404(Order, id=order_id)
 
 
 @login_required
@@ -144,31 +370,73 @@ def order_list(request):
 
 def order_detail(request, order_id):
     """ Mostra i dettagli di un singolo ordine. Gli utenti loggati possono vedere solo i loro ordini, gli ospiti possono vedere l'ordine col loro ID. """
-    if request.user.is_authenticated:
-        # Se loggato, mostra solo i propri ordini
-        order = get_object_or_404(Order, id=order_id, user=request.user)
-    else:
-        # Se non loggato, mostra l'ordine per ID (gli ospiti possono accedere ai loro ordini tramite l'ID)
-        order = get_object_or_404(Order, id=order_id)
-    return render(request, 'shop/order/detail.html', {'order': order})
+    order = _get_order_for_request(request, order_id)
+    prefetch_related_objects([order], Prefetch('items', queryset=OrderItem.objects.select_related('product')))
+    return render(request, 'shop/order/detail.html', {
+        'order': order,
+        # Ritorno dalla pagina di pagamento: Stripe ha confermato, il webhook può non essere ancora arrivato
+        'payment_processing': not order.paid and request.GET.get('redirect_status') == 'succeeded',
+    })
 
 
-@login_required
-def mark_order_paid(request, order_id):
-    # View semplice per marcare un ordine come pagato (per sviluppo/test)
-    order = get_object_or_404(Order, id=order_id, user=request.user)
-    order.paid = True
-    order.save()
-    messages.success(request, f'Ordine {order.id} marcato come pagato.')
-    return redirect('shop:order_detail', order_id=order.id)
+# --- PAGAMENTI CON CARTA (Stripe) ---
+@never_cache
+def order_pay(request, order_id):
+    """ Pagina di pagamento con carta: Stripe.js conferma il PaymentIntent dell'ordine direttamente con Stripe. """
+    # Solo il proprietario: il PaymentIntent si crea su Stripe e la pagina mostra totale e client_secret
+    order = _get_own_order(request, order_id)
+    if order.paid or order.payment_method != 'card' or order.status == 'cancelled':
+        return redirect('shop:order_detail', order_id=order.id)
+    gateway = payments.get_gateway()
+    try:
+        client_secret = payments.start_payment(order, gateway)
+    except payments.PaymentError:
+        messages.error(request, 'Il pagamento con carta non è disponibile in questo momento. Riprova tra poco.')
+        return redirect('shop:order_detail', order_id=order.id)
+    return render(request, 'shop/order/pay.html', {
+        'order': order,
+        'gateway': gateway,
+        'client_secret': client_secret,
+        # Stripe rimanda qui il cliente dopo la conferma (anche dopo l'autenticazione 3D Secure)
+        'return_url': request.build_absolute_uri(reverse('shop:order_detail', args=[order.id])),
+    })
+
+
+@require_POST
+def order_pay_fake(request, order_id):
+    """ Solo con FakeGateway: simula un pagamento riuscito inviando un webhook firmato come quelli di Stripe. """
+    if not settings.PAYMENT_FAKE_ENABLED:
+        raise Http404
+    gateway = payments.get_gateway()
+    if not gateway.fake:
+        raise Http404
+    order = _get_own_order(request, order_id)
+    payload = gateway.event('payment_intent.succeeded', order)
+    payments.receive(payload, gateway.sign(payload), gateway)
+    return redirect(reverse('shop:order_detail', args=[order.id]) + '?redirect_status=succeeded')
+
+
+@csrf_exempt
+@require_POST
+def stripe_webhook(request):
+    """
+    Endpoint dei webhook di Stripe: verifica la firma, registra l'evento e risponde subito.
+    L'elaborazione (ordine pagato, annullato) la fa il worker run_jobs (payments.process_event).
+    """
+    try:
+        payments.receive(request.body, request.META.get('HTTP_STRIPE_SIGNATURE', ''))
+    except payments.InvalidWebhook:
+        return HttpResponse(status=400)
+    return HttpResponse(status=200)
 
 """
-implementato è il doppio controllo dello stock in cart_add:
+implementato è il controllo dello stock in cart_add tramite prenotazione:
 
-Controlla se la singola aggiunta è valida.
+Calcola il totale della riga (quello già nel carrello + il nuovo).
 
-Controlla se il totale (quello già nel carrello + il nuovo) non superi il magazzino reale.
-Questo impedisce a un utente di aggiungere 5 pezzi, poi altri 10, 
-superando magari una disponibilità di soli 12 pezzi.
+Trattiene quel totale con reservations.reserve(), che fallisce se supera i pezzi
+non trattenuti da altri carrelli. Questo impedisce a un utente di aggiungere 5 pezzi,
+poi altri 10, superando magari una disponibilità di soli 12 pezzi, e fa sì che
+i pezzi nel carrello ci siano ancora al checkout (finché la prenotazione non scade).
 
 """
\ No newline at end of file
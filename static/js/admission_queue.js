@@ -0,0 +1,28 @@
+/*
+ * Pagina di attesa dei lanci: chiede ogni pochi secondi la posizione in coda
+ * all'endpoint JSON shop:admission_status (URL nell'attributo data-url) e, quando
+ * tocca all'acquirente, lo riporta alla pagina da cui era partito.
+ */
+(function () {
+    var script = document.currentScript;
+    var INTERVAL = 3000;
+
+    function poll() {
+        fetch(script.dataset.url, {credentials: 'same-origin', headers: {'Accept': 'application/json'}})
+            .then(function (response) { return response.json(); })
+            .then(function (status) {
+                if (status.admitted) {
+                    window.location.href = status.next;
+                    return;
+                }
+                document.querySelectorAll('[data-queue-position]').forEach(function (position) {
+                    position.textContent = status.position;
+                });
+                setTimeout(poll, INTERVAL);
+            })
+            // Server sotto carico o rete assente: si riprova più tardi senza perdere il posto
+            .catch(function () { setTimeout(poll, INTERVAL * 2); });
+    }
+
+    setTimeout(poll, INTERVAL);
+})();
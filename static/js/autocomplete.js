@@ -0,0 +1,70 @@
+/*
+ * Suggerimenti mentre si scrive nella barra di ricerca.
+ * Chiede all'endpoint JSON shop:product_autocomplete (URL nell'attributo data-autocomplete-url
+ * del campo) i suggerimenti per il testo scritto e li mostra in un menu a tendina Bootstrap.
+ */
+(function () {
+    document.querySelectorAll('[data-autocomplete-url]').forEach(function (input) {
+        var menu = document.createElement('ul');
+        menu.className = 'dropdown-menu';
+        input.parentNode.style.position = 'relative';
+        input.parentNode.appendChild(menu);
+        var timer = null;
+        var lastQuery = '';
+
+        function close() {
+            menu.classList.remove('show');
+        }
+
+        function render(results) {
+            menu.innerHTML = '';
+            results.forEach(function (result) {
+                var item = document.createElement('li');
+                var link = document.createElement('a');
+                link.className = 'dropdown-item';
+                link.href = result.url;
+                // textContent: i nomi dei prodotti non vengono mai interpretati come HTML
+                link.textContent = result.name;
+                if (result.type === 'category') {
+                    var icon = document.createElement('i');
+                    icon.className = 'bi bi-tag me-2';
+                    link.prepend(icon);
+                }
+                item.appendChild(link);
+                menu.appendChild(item);
+            });
+            menu.classList.toggle('show', results.length > 0);
+        }
+
+        input.addEventListener('input', function () {
+            var query = input.value.trim();
+            clearTimeout(timer);
+            if (!query) {
+                close();
+                return;
+            }
+            // Piccola attesa: chi scrive veloce non manda una richiesta per ogni lettera
+            timer = setTimeout(function () {
+                lastQuery = query;
+                fetch(input.dataset.autocompleteUrl + '?q=' + encodeURIComponent(query), {headers: {'Accept': 'application/json'}})
+                    .then(function (response) { return response.json(); })
+                    .then(function (data) {
+                        // Ignora le risposte arrivate fuori ordine
+                        if (data.query === lastQuery) {
+                            render(data.results);
+                        }
+                    });
+            }, 80);
+        });
+        input.addEventListener('keydown', function (event) {
+            if (event.key === 'Escape') {
+                close();
+            }
+        });
+        document.addEventListener('click', function (event) {
+            if (!input.parentNode.contains(event.target)) {
+                close();
+            }
+        });
+    });
+})();
@@ -0,0 +1,29 @@
+/*
+ * Riempie le parti personali delle pagine servite dalla cache pubblica
+ * (SHOP_PERSONALIZATION = 'client'): badge del carrello, menu utente e token CSRF dei form.
+ * I dati arrivano dall'endpoint JSON shop:session_state (URL nell'attributo data-url).
+ */
+(function () {
+    var script = document.currentScript;
+    fetch(script.dataset.url, {credentials: 'same-origin', headers: {'Accept': 'application/json'}})
+        .then(function (response) { return response.json(); })
+        .then(function (state) {
+            // Badge carrello: visibile solo se ci sono articoli
+            document.querySelectorAll('[data-cart-badge]').forEach(function (badge) {
+                badge.textContent = state.cart_count;
+                badge.classList.toggle('d-none', !state.cart_count);
+            });
+            // Menu utente oppure link di login
+            document.querySelectorAll('[data-auth]').forEach(function (item) {
+                var show = (item.dataset.auth === 'in') === state.authenticated;
+                item.classList.toggle('d-none', !show);
+            });
+            document.querySelectorAll('[data-username]').forEach(function (name) {
+                name.textContent = state.username;
+            });
+            // Token CSRF per i form (aggiungi al carrello, logout)
+            document.querySelectorAll('[data-csrf-token]').forEach(function (input) {
+                input.value = state.csrf_token;
+            });
+        });
+})();
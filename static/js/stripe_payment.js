@@ -0,0 +1,23 @@
+/*
+ * Pagina di pagamento: monta il Payment Element di Stripe sul PaymentIntent dell'ordine
+ * e conferma il pagamento direttamente con Stripe. Dopo la conferma Stripe rimanda alla
+ * pagina dell'ordine (data-return-url); l'ordine risulta pagato quando arriva il webhook.
+ */
+(function () {
+    var form = document.getElementById('payment-form');
+    var stripe = Stripe(form.dataset.publicKey);
+    var elements = stripe.elements({clientSecret: form.dataset.clientSecret});
+    elements.create('payment').mount('#payment-element');
+
+    form.addEventListener('submit', function (event) {
+        event.preventDefault();
+        var button = form.querySelector('button');
+        button.disabled = true;
+        stripe.confirmPayment({elements: elements, confirmParams: {return_url: form.dataset.returnUrl}})
+            .then(function (result) {
+                // Si arriva qui solo in caso di errore: altrimenti il browser è già stato rimandato
+                document.getElementById('payment-error').textContent = result.error.message;
+                button.disabled = false;
+            });
+    });
+})();